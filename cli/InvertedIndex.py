@@ -1,8 +1,25 @@
-import json, pickle, os, math
+import pickle, os, math, heapq, threading
+import multiprocessing as mp
+import numpy as np
 from keyword_search_cli import tokenize_text
-from collections import Counter, defaultdict
+from lib.wand import pruned_top_k, merge_top_k
+from lib.batch_bm25 import WeightMatrix, score_batch
+from lib.segment import Segment, TermView, DocumentView, RowView, write_segment
+from lib.index_build import build_shard, merge_shards, document_fields
+from lib.query_parser import parse_query, is_positional, query_text
+from lib.positions import match_rows, proximity_boosts
+from lib.boolean_query import filter_rows, intersect, matching_indices
+from lib.spelling import SpellingLexicon
+from lib.completion import PrefixIndex, normalize, title_keys
+from lib.document_source import DocumentStore, StoredDocumentView, RowLookup, iter_batches
+from lib.segment_set import SegmentSet, LiveTermView, manifest_lock, merge_lock, read_manifest, write_manifest, new_manifest, reserve_segment_name, segment_path, select_merge
+from functools import lru_cache
+from collections import defaultdict, deque
 from constants import *
 
+def bm25_idf(N, df):
+    return math.log((N - df + 0.5) / (df + 0.5) + 1)
+
 class InvertedIndex:
 
     def __init__(self):
@@ -11,46 +28,378 @@ class InvertedIndex:
         self.term_frequencies = {}
         self.doc_lengths = {}
 
-    def __add_document(self, doc_id, text):
-        tokens = tokenize_text(text)
-
-        for token in tokens:
-            self.index[token].add(doc_id)
-            self.term_frequencies[doc_id][token] += 1
-        
-        self.doc_lengths[doc_id] = len(tokens)
+        # Query-time statistics, derived from the structures above by
+        # __compute_statistics() whenever the index is built or loaded.
+        self.doc_ids = np.zeros(0, dtype=np.int64)
+        self.doc_rows = {}
+        self.lengths = np.zeros(0, dtype=np.int64)
+        self.avg_doc_length = 0.0
+        self.length_norms = np.zeros(0)
+        self.idfs = {}
+        self.postings = {}
+        self.max_scores = {}
+        self.block_maxima = {}
+
+        # (document count, total length, term -> df) of the whole corpus
+        # when this index is one shard of it, used in place of its own.
+        self.global_statistics = None
+
+        # Term -> word positions of each posting in turn, tf of them per
+        # document. None unless the index was built with positions.
+        self.positions = None
+
+        # Title-field statistics for BM25F: the title tf of each posting, in
+        # postings order, and the title length of each row. The description
+        # is the rest of the document. None unless the index has them.
+        self.title_tfs = None
+        self.title_lengths = None
+        self.field_norms = {}
+
+        # Unstemmed word -> number of documents it occurs in, for spelling
+        # correction. Read from the segments on first use once loaded.
+        self.word_dfs = None
+
+        # Sorted (title key, row) pairs for title completion, each title
+        # under every suffix that starts at a word.
+        self.title_keys = None
+
+        self.search_stats = {}
+        self.build_stats = {}
+
+        # CSR matrix of BM25 contributions for batch scoring, built on first
+        # use.
+        self.weight_matrix = None
+
+        # Symmetric-delete lexicon of the vocabulary for spelling
+        # correction, built on first use.
+        self.lexicon = None
+
+        # Prefix indexes over words and title keys, loaded on first use.
+        self.completions = None
+
+        # Set when the index is served from on-disk segments.
+        self.segment = None
+        self.generation = None
+        self.merge_thread = None
 
     def get_documents(self,term):
-        return sorted(self.index[term.lower()])
+        term = term.lower()
+
+        if term not in self.postings:
+            return []
+
+        rows, _ = self.postings[term]
+
+        return np.sort(self.doc_ids[rows]).tolist()
+
+    def boolean_search(self, expression, limit=None):
+
+        rows = filter_rows(self, expression)
+
+        return np.sort(self.doc_ids[rows])[:limit].tolist()
     
-    def build(self):
-        with open("data/movies.json", "r") as file:
-            data = json.load(file)
-
-            for movie in data["movies"]:
-                self.docmap[movie["id"]] = movie
-                self.term_frequencies[movie["id"]] = Counter()
-                self.__add_document(movie["id"], f"{movie['title']} {movie['description']}")
+    def build(self, workers=1, positions=False):
+        self.index_documents(iter_batches(MOVIES_PATH), workers, positions)
+
+    def index_documents(self, batches, workers=1, positions=False):
+
+        # Batches are consumed as they are read. Each one is spilled to a
+        # document store on disk and reduced to a compact run of postings,
+        # so memory does not grow with the raw corpus.
+        store = DocumentStore()
+        runs = []
+
+        if workers > 1:
+            with mp.Pool(workers) as pool:
+                pending = deque()
+
+                for batch in batches:
+                    pending.append(pool.apply_async(build_shard, (document_fields(batch), len(store), positions)))
+                    store.extend(batch)
+
+                    # Bound the batches in flight, or reading would run
+                    # ahead of the workers and queue the whole corpus.
+                    while len(pending) > workers * 2:
+                        runs.append(pending.popleft().get())
+
+                while len(pending) > 0:
+                    runs.append(pending.popleft().get())
+        else:
+            for batch in batches:
+                runs.append(build_shard(document_fields(batch), len(store), positions))
+                store.extend(batch)
+
+        merged = merge_shards(runs)
+        self.build_stats = merged["stats"]
+        term_positions = merged["positions"]
+
+        # With no batches at all there is no run to take positions from.
+        if positions and term_positions is None:
+            term_positions = {}
+
+        self.load_postings(StoredDocumentView(store, RowLookup(store.ids)), merged["lengths"], merged["postings"], term_positions, merged["title_lengths"], merged["title_tfs"], merged["word_dfs"], merged["title_keys"])
+
+    def load_postings(self, docmap, lengths, postings, positions=None, title_lengths=None, title_tfs=None, word_dfs=None, title_keys=None):
+
+        self.docmap = docmap
+        self.doc_ids = np.array(list(docmap.keys()), dtype=np.int64)
+        self.doc_rows = RowLookup(self.doc_ids)
+        self.lengths = np.array(lengths, dtype=np.int64)
+        self.postings = postings
+        self.positions = positions
+        self.title_lengths = np.array(title_lengths, dtype=np.int64) if title_lengths is not None else None
+        self.title_tfs = title_tfs
+        self.word_dfs = word_dfs
+        self.title_keys = title_keys
+
+        self.__compute_term_statistics()
     
     def save(self):
 
         if not os.path.isdir("cache"):
             os.mkdir("cache")
-        
-        with open("cache/index.pkl", "wb") as file:
-            pickle.dump(self.index, file)
 
-        with open("cache/docmap.pkl", "wb") as file:
-            pickle.dump(self.docmap, file)
+        # A full build replaces every segment written by incremental updates.
+        with manifest_lock():
+            previous = read_manifest()
+
+            write_segment(INDEX_SEGMENT_PATH, self)
+
+            manifest = new_manifest(os.path.basename(INDEX_SEGMENT_PATH), len(self.doc_ids))
+
+            # Keep counting, so names never repeat while a merge may still
+            # be writing one.
+            if previous is not None:
+                manifest["generation"] = previous["generation"]
+                manifest["next_segment"] = previous["next_segment"]
+
+            write_manifest(manifest)
+
+            if previous is not None:
+                for entry in previous["segments"]:
+                    if segment_path(entry["name"]) != INDEX_SEGMENT_PATH:
+                        os.remove(segment_path(entry["name"]))
+
+    def exists(self):
+        return os.path.isfile(INDEX_MANIFEST_PATH) or os.path.isfile(INDEX_SEGMENT_PATH)
 
-        with open("cache/term_frequencies.pkl", "wb") as file:
-            pickle.dump(self.term_frequencies, file)
-        
-        with open("cache/doc_lengths.pkl", "wb") as file:
-            pickle.dump(self.doc_lengths, file)
-    
     def load(self):
 
+        if not self.exists():
+            raise Exception(f"Index segment {INDEX_SEGMENT_PATH} not found. Run build, or convert to upgrade an existing pickle cache.")
+
+        # Hold the lock while mapping so a merge cannot remove a listed
+        # segment in between.
+        with manifest_lock():
+            manifest = read_manifest()
+            entries = manifest["segments"]
+
+            if len(entries) == 1 and len(entries[0]["deleted"]) == 0:
+                self.__load_segment(Segment(segment_path(entries[0]["name"])))
+            else:
+                self.__load_segment_set(SegmentSet(entries))
+
+        self.generation = manifest["generation"]
+
+    def refresh(self):
+
+        # Reload only if segments were added, deleted from or merged since
+        # the last load.
+        if self.generation is None or read_manifest()["generation"] != self.generation:
+            self.load()
+
+    def __load_segment(self, segment):
+
+        # Only the header is read here. Postings, lengths and documents stay
+        # in the mapped file until a query touches them.
+        self.segment = segment
+        self.docmap = DocumentView(segment)
+        self.doc_ids = segment.doc_ids
+        self.doc_rows = RowView(segment)
+        self.lengths = segment.doc_lengths
+        self.avg_doc_length = segment.total_length / segment.doc_count if segment.doc_count > 0 else 0.0
+        self.__compute_length_norms()
+
+        self.postings = TermView(segment, segment.postings)
+        self.idfs = TermView(segment, lambda i: float(segment.term_idf[i]))
+        self.max_scores = TermView(segment, lambda i: float(segment.term_max_score[i]))
+        self.block_maxima = TermView(segment, segment.blocks)
+        self.positions = TermView(segment, segment.positions) if segment.has_positions else None
+        self.title_lengths = segment.title_lengths if segment.has_fields else None
+        self.title_tfs = TermView(segment, segment.title_tfs) if segment.has_fields else None
+        self.field_norms = {}
+        self.word_dfs = None
+        self.title_keys = None
+        self.weight_matrix = None
+        self.lexicon = None
+        self.completions = None
+
+    def __load_segment_set(self, segments):
+
+        # Statistics are recomputed over the live documents of all segments,
+        # term by term as queries need them.
+        self.segment = segments
+        self.docmap = DocumentView(segments)
+        self.doc_ids = segments.doc_ids
+        self.doc_rows = RowView(segments)
+        self.lengths = segments.lengths
+        self.avg_doc_length = segments.total_length / segments.doc_count if segments.doc_count > 0 else 0.0
+        self.__compute_length_norms()
+
+        N = segments.doc_count
+        bounds = lru_cache(maxsize=TERM_CACHE_SIZE)(self.get_term_bounds)
+
+        self.postings = LiveTermView(segments, segments.postings)
+        self.idfs = LiveTermView(segments, lambda term: bm25_idf(N, len(segments.postings(term)[0])))
+        self.max_scores = LiveTermView(segments, lambda term: bounds(term)[0])
+        self.block_maxima = LiveTermView(segments, lambda term: bounds(term)[1])
+        self.positions = LiveTermView(segments, segments.positions) if segments.has_positions else None
+        self.title_lengths = segments.title_lengths if segments.has_fields else None
+        self.title_tfs = LiveTermView(segments, segments.title_tfs) if segments.has_fields else None
+        self.field_norms = {}
+        self.word_dfs = None
+        self.title_keys = None
+        self.weight_matrix = None
+        self.lexicon = None
+        self.completions = None
+
+    def add_documents(self, documents):
+        self.__apply_changes(documents, [], replace=False)
+
+    def update_documents(self, documents):
+        self.__apply_changes(documents, [document["id"] for document in documents], replace=True)
+
+    def delete_documents(self, doc_ids):
+        self.__apply_changes([], doc_ids, replace=False)
+
+    def __apply_changes(self, documents, deleted_ids, replace):
+
+        added_ids = [document["id"] for document in documents]
+
+        if len(set(added_ids)) != len(added_ids) or len(set(deleted_ids)) != len(deleted_ids):
+            raise ValueError("A change batch can only touch each document once.")
+
+        if not self.exists():
+            raise Exception("Index not found. Run build first.")
+
+        # New documents go into a new segment and replaced or deleted ones
+        # are tombstoned in theirs. Both become visible in a single manifest
+        # write.
+        with manifest_lock():
+            manifest = read_manifest()
+            segments = SegmentSet(manifest["segments"])
+
+            for doc_id in deleted_ids:
+                k = segments.find_segment(doc_id)
+
+                if k < 0:
+                    raise ValueError(f"Document {doc_id} is not in the index.")
+
+                manifest["segments"][k]["deleted"].append(doc_id)
+
+            if not replace:
+                for doc_id in added_ids:
+                    if segments.find_row(doc_id) >= 0:
+                        raise ValueError(f"Document {doc_id} is already in the index.")
+
+            if len(documents) > 0:
+                segment_index = InvertedIndex()
+                segment_index.index_documents([documents], positions=segments.has_positions)
+
+                name = reserve_segment_name(manifest)
+                write_segment(segment_path(name), segment_index)
+                manifest["segments"].append({"name": name, "doc_count": len(documents), "deleted": []})
+
+            write_manifest(manifest)
+
+        self.load()
+        self.merge_in_background()
+
+    def merge_in_background(self):
+
+        # Not a daemon thread, so a CLI process finishes the merge before it
+        # exits.
+        self.merge_thread = threading.Thread(target=self.merge_segments)
+        self.merge_thread.start()
+
+    def merge_segments(self, force=False):
+
+        merged = 0
+
+        with merge_lock() as acquired:
+            # Another merge is already running, and will pick up this work.
+            if not acquired:
+                return merged
+
+            while True:
+                with manifest_lock():
+                    manifest = read_manifest()
+                    selected = select_merge(manifest, force) if manifest is not None else None
+
+                    if selected is None:
+                        return merged
+
+                    start, end = selected
+                    entries = [dict(entry, deleted=list(entry["deleted"])) for entry in manifest["segments"][start:end]]
+                    name = reserve_segment_name(manifest)
+                    write_manifest(manifest)
+
+                # The merge itself runs unlocked, so queries and updates go on.
+                segments = SegmentSet(entries)
+                docmap = {int(doc_id): segments.document(row) for row, doc_id in enumerate(segments.doc_ids)}
+                postings = {}
+                positions = {} if segments.has_positions else None
+                title_tfs = {} if segments.has_fields else None
+
+                for term in segments.terms():
+                    rows, tfs = segments.live_postings(term)
+
+                    if len(rows) > 0:
+                        postings[term] = (rows, tfs)
+
+                        if positions is not None:
+                            positions[term] = segments.live_positions(term)
+
+                        if title_tfs is not None:
+                            title_tfs[term] = segments.live_title_tfs(term)
+
+                word_dfs = segments.word_dfs() if segments.has_words else None
+                merged_keys = sorted(title_keys([document["title"] for document in docmap.values()], 0)) if segments.has_suggestions else None
+
+                merged_index = InvertedIndex()
+                merged_index.load_postings(docmap, segments.lengths, postings, positions, segments.title_lengths if segments.has_fields else None, title_tfs, word_dfs, merged_keys)
+                write_segment(segment_path(name), merged_index)
+
+                with manifest_lock():
+                    manifest = read_manifest()
+                    names = [entry["name"] for entry in manifest["segments"]]
+
+                    # A full build replaced the segments while they were merged.
+                    if entries[0]["name"] not in names:
+                        os.remove(segment_path(name))
+                        return merged
+
+                    start = names.index(entries[0]["name"])
+                    end = start + len(entries)
+
+                    # Carry over deletions made while the merge was running.
+                    deleted = []
+                    for entry, current in zip(entries, manifest["segments"][start:end]):
+                        deleted.extend(sorted(set(current["deleted"]) - set(entry["deleted"])))
+
+                    manifest["segments"][start:end] = [{"name": name, "doc_count": len(docmap), "deleted": deleted}]
+                    write_manifest(manifest)
+
+                    for entry in entries:
+                        os.remove(segment_path(entry["name"]))
+
+                merged += 1
+                force = False
+
+    def load_pickles(self):
+
+        # The pre-segment cache format, kept so existing caches can be
+        # converted without rebuilding from data/movies.json.
         if not os.path.isfile("cache/index.pkl") or not os.path.isfile("cache/docmap.pkl"):
             raise Exception("Pickle files for index and docmap not found.")
             
@@ -65,34 +414,194 @@ class InvertedIndex:
         
         with open("cache/doc_lengths.pkl", "rb") as file:
             self.doc_lengths = pickle.load(file)
+
+        self.__compute_statistics()
+
+    def __compute_statistics(self):
+
+        # Rows follow docmap order so that ties rank exactly as they did when
+        # every document was scored in turn.
+        doc_ids = list(self.docmap.keys())
+        doc_rows = {doc_id: row for row, doc_id in enumerate(doc_ids)}
+
+        self.doc_ids = np.array(doc_ids, dtype=np.int64)
+        self.doc_rows = doc_rows
+        self.lengths = np.array([self.doc_lengths[doc_id] for doc_id in doc_ids], dtype=np.int64)
+        self.postings = {}
+
+        for term, term_doc_ids in self.index.items():
+            if len(term_doc_ids) == 0:
+                continue
+
+            rows = sorted(doc_rows[doc_id] for doc_id in term_doc_ids)
+            tfs = [self.term_frequencies[doc_ids[row]][term] for row in rows]
+
+            self.postings[term] = (np.array(rows, dtype=np.int64), np.array(tfs, dtype=np.int64))
+
+        self.__compute_term_statistics()
+
+    def __compute_term_statistics(self):
+
+        if self.global_statistics is not None:
+            N, total_length, dfs = self.global_statistics
+            self.avg_doc_length = total_length / N if N > 0 else 0.0
+        else:
+            N = len(self.doc_ids)
+            dfs = None
+            self.avg_doc_length = self.__get_avg_doc_length()
+
+        self.__compute_length_norms()
+        self.idfs = {}
+
+        for term, (rows, _) in self.postings.items():
+            self.idfs[term] = bm25_idf(N, len(rows) if dfs is None else dfs[term])
+
+        # Score upper bounds for dynamic pruning, per term and per block of
+        # BM25_BLOCK_SIZE consecutive rows the term occurs in.
+        self.max_scores = {}
+        self.block_maxima = {}
+
+        for term in self.postings:
+            self.max_scores[term], self.block_maxima[term] = self.get_term_bounds(term)
+
+        self.weight_matrix = None
+        self.lexicon = None
+        self.completions = None
+
+    def use_global_statistics(self, doc_count, total_length, dfs):
+
+        # A shard of a larger corpus scores with the statistics of the whole
+        # of it, so its scores are those one index over everything would give.
+        self.global_statistics = (doc_count, total_length, dfs)
+        self.__compute_term_statistics()
+
+    def get_term_bounds(self, term):
+        rows, scores = self.get_term_scores(term)
+        blocks = rows // BM25_BLOCK_SIZE
+        starts = np.flatnonzero(np.diff(blocks, prepend=-1))
+
+        return float(scores.max()), (blocks[starts], np.maximum.reduceat(scores, starts))
+
+    def __compute_length_norms(self):
+
+        if self.avg_doc_length > 0:
+            self.length_norms = 1 - BM25_B + BM25_B * (self.lengths.astype(np.float64) / self.avg_doc_length)
+        else:
+            self.length_norms = np.ones(len(self.doc_ids))
+
+    def get_term_scores(self, term, candidates=None):
+        rows, tfs = self.postings[term]
+
+        # Only the postings of candidate rows are scored, if there are any.
+        if candidates is not None:
+            take = matching_indices(rows, candidates)
+            rows = rows[take]
+            tfs = tfs[take]
+
+        return rows, self.score_postings(rows, tfs, self.idfs[term])
+
+    def score_postings(self, rows, tfs, idf):
+
+        # BM25 of some of a term's postings, the same for each wherever the
+        # others come from.
+        bm25tf = (tfs * (BM25_K1 + 1)) / (tfs + BM25_K1 * self.length_norms[rows])
+
+        return bm25tf * idf
+
+    def get_field_norms(self, field_b):
+
+        key = (field_b["title"], field_b["description"])
+
+        # Per-field length norms, cached per b so changing weights at query
+        # time costs nothing.
+        if key not in self.field_norms:
+            norms = []
+
+            for lengths, b in [(self.title_lengths, field_b["title"]), (self.lengths - self.title_lengths, field_b["description"])]:
+                lengths = lengths.astype(np.float64)
+                average = lengths.mean() if len(lengths) > 0 else 0.0
+                norms.append(1 - b + b * (lengths / average) if average > 0 else np.ones(len(lengths)))
+
+            self.field_norms[key] = tuple(norms)
+
+        return self.field_norms[key]
+
+    def get_field_scores(self, term, field_weights, field_b, candidates=None):
+        rows, tfs = self.postings[term]
+        title_tfs = self.title_tfs[term]
+
+        if candidates is not None:
+            take = matching_indices(rows, candidates)
+            rows = rows[take]
+            tfs = tfs[take]
+            title_tfs = title_tfs[take]
+
+        # BM25F: each field's tf is normalized by its own length and
+        # weighted, and the sum saturates once, as a single tf would.
+        title_norms, description_norms = self.get_field_norms(field_b)
+        description_tfs = tfs - title_tfs
+
+        pseudo_tfs = field_weights["title"] * np.divide(title_tfs, title_norms[rows], out=np.zeros(len(rows)), where=title_tfs > 0)
+        pseudo_tfs += field_weights["description"] * np.divide(description_tfs, description_norms[rows], out=np.zeros(len(rows)), where=description_tfs > 0)
+
+        bm25tf = (pseudo_tfs * (BM25_K1 + 1)) / (pseudo_tfs + BM25_K1)
+
+        return rows, bm25tf * self.idfs[term]
+
+    def get_field_parameters(self, field_weights, field_b):
+
+        if self.title_tfs is None:
+            raise Exception("BM25F needs per-field statistics. Rebuild the index.")
+
+        parameters = []
+
+        for given, defaults in [(field_weights, BM25F_FIELD_WEIGHTS), (field_b, BM25F_FIELD_B)]:
+            given = given or {}
+            unknown = [field for field in given if field not in defaults]
+
+            if len(unknown) > 0:
+                raise ValueError(f"Unknown field: {unknown[0]}. Fields are {', '.join(defaults)}.")
+
+            parameters.append(dict(defaults, **given))
+
+        if any(weight < 0 for weight in parameters[0].values()):
+            raise ValueError("Field weights cannot be negative.")
+
+        if any(b < 0 or b > 1 for b in parameters[1].values()):
+            raise ValueError("Field b values must be between 0 and 1.")
+
+        return parameters
     
-    def get_tf(self, doc_id, term):
+    def __get_token(self, term):
         token = tokenize_text(term)
 
         if len(token) > 1:
             raise Exception("Too Many Tokens")
-        
-        if doc_id in self.term_frequencies:
-            freq = self.term_frequencies[doc_id]
-            if token[0] in freq:
-                return freq[token[0]]
-        
+
+        return token[0]
+
+    def get_tf(self, doc_id, term):
+        token = self.__get_token(term)
+
+        if token in self.postings and doc_id in self.doc_rows:
+            rows, tfs = self.postings[token]
+            row = self.doc_rows[doc_id]
+            position = np.searchsorted(rows, row)
+
+            if position < len(rows) and rows[position] == row:
+                return int(tfs[position])
+
         return 0
     
     def get_idf(self, term):
 
-        token = tokenize_text(term)
-
-        if len(token) > 1:
-            raise Exception("Too Many Tokens")
-        
-        token = token[0]
+        token = self.__get_token(term)
 
         total_doc_count = len(self.docmap)
         term_match_doc_count = 0
 
-        if token in self.index:
-            term_match_doc_count = len(self.index[token])
+        if token in self.postings:
+            term_match_doc_count = len(self.postings[token][0])
 
         idf = math.log((total_doc_count + 1) / (term_match_doc_count + 1))
 
@@ -100,26 +609,18 @@ class InvertedIndex:
     
     def get_bm25_idf(self, term: str) -> float:
 
-        token = tokenize_text(term)
+        token = self.__get_token(term)
 
-        if len(token) > 1:
-            raise Exception("Too Many Tokens")
-        
-        token = token[0]
+        if token in self.idfs:
+            return self.idfs[token]
 
         N = len(self.docmap)
-        df = 0
 
-        if token in self.index:
-            df = len(self.index[token])
-
-        idf = math.log((N - df + 0.5) / (df + 0.5) + 1)
-
-        return idf
+        return math.log((N + 0.5) / 0.5 + 1)
     
     def get_bm25_tf(self, doc_id, term, k1=BM25_K1, b=BM25_B):
         tf = self.get_tf(doc_id, term)
-        length_norm = 1 - b + b * (self.doc_lengths[doc_id] / self.__get_avg_doc_length())
+        length_norm = 1 - b + b * (int(self.lengths[self.doc_rows[doc_id]]) / self.avg_doc_length)
 
         bm25tf = (tf * (k1 + 1)) / (tf + k1 * length_norm)
 
@@ -127,10 +628,10 @@ class InvertedIndex:
     
     def __get_avg_doc_length(self) -> float:
 
-        if len(self.doc_lengths) == 0:
+        if len(self.lengths) == 0:
             return 0.0
-        
-        return sum(self.doc_lengths.values()) / len(self.doc_lengths)
+
+        return int(self.lengths.sum()) / len(self.lengths)
     
     def bm25(self, doc_id, term):
 
@@ -139,30 +640,289 @@ class InvertedIndex:
 
         return bm25tf * bm25idf
     
-    def bm25_search(self, query, limit=5):
+    def __get_query_terms(self, query):
+
+        # bm25() analyzes each query token a second time before looking it
+        # up, and a stem is not always its own stem, so resolve terms the
+        # same way to keep rankings unchanged.
+        terms = []
+
+        for token in tokenize_text(query):
+            resolved = tokenize_text(token)
+
+            if len(resolved) == 1:
+                terms.append(resolved[0])
+
+        return terms
+
+    def __score_exhaustive(self, terms, limit):
 
-        tokens = tokenize_text(query)
         scores = {}
+        postings = 0
 
-        for doc_id in self.docmap:
-            doc_score = 0
-            for token in tokens:
-                doc_score += self.bm25(doc_id, token)
-            
-            scores[doc_id] = doc_score
-        
-        scores = dict(sorted(scores.items(), key=lambda item: item[1], reverse=True))
+        # Term-at-a-time: only documents in a query term's postings are
+        # touched, everything else keeps a score of zero.
+        for term in terms:
+            if term not in self.postings:
+                continue
+
+            rows, term_scores = self.get_term_scores(term)
+            postings += len(rows)
+
+            for row, score in zip(rows.tolist(), term_scores.tolist()):
+                scores[row] = scores.get(row, 0) + score
+
+        top = heapq.nlargest(limit, scores.items(), key=lambda item: (item[1], -item[0]))
+
+        return top, len(scores), postings
+
+    def __score_candidates(self, terms, limit, candidates=None, proximity=False, fields=None):
+
+        rows_parts = []
+        score_parts = []
+
+        # Every contribution, restricted to the candidate rows if there are
+        # any, summed per row in query order as in __score_exhaustive.
+        for term in terms:
+            if term not in self.postings:
+                continue
+
+            if fields is not None:
+                rows, term_scores = self.get_field_scores(term, *fields, candidates)
+            else:
+                rows, term_scores = self.get_term_scores(term, candidates)
+
+            rows_parts.append(rows)
+            score_parts.append(term_scores)
+
+        rows = np.concatenate(rows_parts) if len(rows_parts) > 0 else np.zeros(0, dtype=np.int64)
+
+        if len(rows) == 0:
+            return [], 0
+
+        rows, inverse = np.unique(rows, return_inverse=True)
+        scores = np.bincount(inverse, weights=np.concatenate(score_parts))
+
+        if proximity:
+            boost_rows, boosts = proximity_boosts(self, terms)
+            keep = np.isin(boost_rows, rows, assume_unique=True)
+            scores[np.searchsorted(rows, boost_rows[keep])] += boosts[keep]
+
+        if limit <= 0:
+            return [], len(rows)
+
+        top_rows, top_scores = merge_top_k(np.zeros(0, dtype=np.int64), np.zeros(0), rows, scores, limit)
+
+        return list(zip(top_rows.tolist(), top_scores.tolist())), len(rows)
+
+    def bm25_search(self, query, limit=5, mode="exhaustive", proximity=False, filter_query=None, field_weights=None, field_b=None):
+
+        if mode not in BM25_MODES:
+            raise ValueError(f"Unknown BM25 mode: {mode}")
+
+        # Field weights or b values switch scoring to BM25F. Its scores have
+        # no precomputed bounds, so it is never pruned.
+        fields = None
+
+        if field_weights is not None or field_b is not None:
+            fields = self.get_field_parameters(field_weights, field_b)
+
+        if proximity and self.positions is None:
+            raise Exception("Proximity ranking needs positions. Rebuild the index with --positions.")
+
+        clauses = parse_query(query)
+        terms = self.__get_query_terms(query_text(clauses))
+
+        # Phrases and NEAR/k restrict the documents that can match. Without
+        # positions they are left as the keywords they contain.
+        candidates = None
 
-        result_len = limit
+        if self.positions is not None and any(is_positional(clause) for clause in clauses):
+            candidates = match_rows(self, clauses)
 
-        if limit > len(scores):
-            result_len = len(scores)
+        # A boolean filter narrows the candidates before anything is scored.
+        if filter_query is not None:
+            filtered = filter_rows(self, filter_query)
+            candidates = filtered if candidates is None else intersect(candidates, filtered)
+
+        # Documents scored, and the postings whose BM25 scores it took where
+        # the mode prunes them.
+        postings = None
+
+        if candidates is not None or proximity or fields is not None:
+            top, scored = self.__score_candidates(terms, limit, candidates, proximity, fields)
+        else:
+            match mode:
+                case "exhaustive":
+                    top, scored, postings = self.__score_exhaustive(terms, limit)
+                case "wand":
+                    top, scored, postings = pruned_top_k(self, terms, limit)
+                case "bmw":
+                    top, scored, postings = pruned_top_k(self, terms, limit, block_max=True)
+
+        self.search_stats = {"mode": "bm25f" if fields is not None else mode, "scored": scored, "postings": postings}
+
+        return self.__get_results(top, terms, limit, candidates)
+
+    def get_vocabulary(self):
+
+        # Unstemmed words and their document frequencies, so corrections
+        # read like what was typed. Indexes written before words were kept
+        # fall back to the terms themselves.
+        if self.word_dfs is None and self.segment is not None and self.segment.has_words:
+            if isinstance(self.segment, Segment):
+                self.word_dfs = dict(zip(self.segment.words(), self.segment.word_df.tolist()))
+            else:
+                self.word_dfs = self.segment.word_dfs()
+
+        if self.word_dfs is not None:
+            return list(self.word_dfs), list(self.word_dfs.values())
+
+        if isinstance(self.segment, Segment):
+            return list(self.segment.terms()), self.segment.term_df
+
+        terms = list(self.postings)
+
+        return terms, [len(self.postings[term][0]) for term in terms]
+
+    def correct_spelling(self, query):
+
+        if self.lexicon is None:
+            self.lexicon = SpellingLexicon(*self.get_vocabulary(), self.postings)
+
+        return self.lexicon.correct(query)
+
+    def __load_completions(self):
+
+        # Words complete by document frequency. Titles complete by the
+        # length of their description: the corpus has no popularity signal,
+        # and better known films tend to have longer synopses.
+        if isinstance(self.segment, Segment) and self.segment.has_words:
+            words = PrefixIndex(self.segment.word, len(self.segment.word_df), self.segment.word_df)
+        else:
+            terms, dfs = self.get_vocabulary()
+            words = PrefixIndex(terms.__getitem__, len(terms), dfs)
+
+        popularity = self.lengths - self.title_lengths if self.title_lengths is not None else self.lengths
+        sources = []
+
+        # Title keys stay in the segments, with rows mapped to live rows and
+        # -1 for deleted documents.
+        if isinstance(self.segment, Segment) and self.segment.has_suggestions:
+            sources.append((self.segment.suggestion, self.segment.suggest_rows))
+        elif isinstance(self.segment, SegmentSet) and self.segment.has_suggestions:
+            for segment, remap in zip(self.segment.segments, self.segment.remaps):
+                sources.append((segment.suggestion, remap[segment.suggest_rows]))
+        elif self.title_keys is not None:
+            keys = [key for key, _ in self.title_keys]
+            sources.append((keys.__getitem__, np.array([row for _, row in self.title_keys], dtype=np.int64)))
+
+        titles = [(PrefixIndex(key, len(rows), np.where(rows >= 0, popularity[np.maximum(rows, 0)], -1)), rows) for key, rows in sources]
+
+        self.completions = (words, titles)
+
+    def suggest(self, prefix, limit=5):
+
+        if self.completions is None:
+            self.__load_completions()
+
+        words, titles = self.completions
+        text = normalize(prefix)
+
+        if text == "" or limit <= 0:
+            return {"words": [], "titles": []}
+
+        # The word being typed completes on its own, the whole prefix
+        # completes titles.
+        word_results = [(words.key(i), int(words.weights[i])) for i in words.top(text.split()[-1], limit).tolist()]
+        candidates = []
+
+        for title_index, rows in titles:
+            fetch = limit
+
+            # A title can match through more than one of its words, so
+            # fetch more keys until duplicates are out of the way.
+            while True:
+                fetch *= 2
+                entries = title_index.top(text, fetch)
+
+                if len(entries) < fetch or len(np.unique(rows[entries])) >= limit:
+                    break
+
+            for i in entries.tolist():
+                candidates.append((-int(title_index.weights[i]), title_index.key(i), int(rows[i])))
+
+        title_results = []
+        seen = set()
+
+        for _, _, row in sorted(candidates):
+            if row in seen:
+                continue
+
+            seen.add(row)
+            doc_id = int(self.doc_ids[row])
+            title_results.append((doc_id, self.docmap[doc_id]["title"]))
+
+            if len(title_results) >= limit:
+                break
+
+        return {"words": word_results, "titles": title_results}
+
+    def bm25_search_batch(self, queries, limit=5):
+
+        if self.weight_matrix is None:
+            self.weight_matrix = WeightMatrix(self)
+
+        # Queries with phrases or NEAR/k are filtered by position, so they
+        # go through bm25_search one by one.
+        positional = {}
+        query_terms = []
+        scored = 0
+
+        for i, query in enumerate(queries):
+            clauses = parse_query(query)
+
+            if self.positions is not None and any(is_positional(clause) for clause in clauses):
+                positional[i] = self.bm25_search(query, limit)
+                scored += self.search_stats["scored"]
+                query_terms.append([])
+            else:
+                query_terms.append(self.__get_query_terms(query_text(clauses)))
+
+        results = []
+
+        for i, (terms, (top, count)) in enumerate(zip(query_terms, score_batch(self.weight_matrix, query_terms, limit))):
+            if i in positional:
+                results.append(positional[i])
+                continue
+
+            results.append(self.__get_results(top, terms, limit))
+            scored += count
+
+        self.search_stats = {"mode": "batch", "scored": scored}
+
+        return results
+
+    def __get_results(self, top, terms, limit, candidates=None):
 
-        result_ids = list(scores.keys())
-        result_scores = list(scores.values())
         result_dict = {}
 
-        for i in range(result_len):
-            result_dict[result_ids[i]] = result_scores[i]
+        for row, score in top:
+            result_dict[int(self.doc_ids[row])] = score
+
+        # Like the exhaustive scorer, fill any remaining slots with
+        # zero-scored documents in docmap order, or only with candidates if
+        # the query restricted them. Every matching document is already in
+        # `top` when this happens.
+        rows = candidates if candidates is not None else range(len(self.doc_ids))
+        zero = 0.0 if len(terms) > 0 else 0
+
+        for row in rows:
+            if len(result_dict) >= limit:
+                break
+
+            doc_id = int(self.doc_ids[row])
+            if doc_id not in result_dict:
+                result_dict[doc_id] = zero
 
-        return result_dict
\ No newline at end of file
+        return result_dict
@@ -1,5 +1,6 @@
-import argparse, json
+import argparse
 import lib.hybrid_search as hybrid_search
+from lib.document_source import load_documents
 
 
 def main():
@@ -33,11 +34,9 @@ def main():
     args = parser.parse_args()
 
     query = args.query
-    data = None
-    with open("data/movies.json") as f:
-        data = json.load(f)
+    documents = load_documents()
 
-    searcher = hybrid_search.HybridSearch(data["movies"])
+    searcher = hybrid_search.HybridSearch(documents)
 
     results = None
 
@@ -0,0 +1,1337 @@
+#!/usr/bin/env python3
+
+import argparse, json, os, random, resource, tempfile, time, InvertedIndex
+import multiprocessing as mp
+import numpy as np
+from lib.document_source import iter_batches, iter_documents, load_documents
+from lib.analyzer import get_analyzer
+from lib.query_parser import Phrase
+from lib.positions import match_rows
+from lib.completion import normalize
+from lib.cluster import start_local_cluster
+from lib.vectors import cosine_similarity, normalize_rows, cosine_scores, top_indices, chunk_movie_scores, chunk_movie_scores_batch, cosine_top, cosine_top_batch, best_per_movie
+from lib.hnsw import HNSWIndex
+from lib.ivfpq import IVFPQIndex, exact_scores
+from lib.quantization import QuantizedMatrix, quantized_top
+from lib.pca import PCAProjection, pca_top
+from lib.embedding_manifest import refresh_embeddings
+from lib.models import get_model
+from lib.semantic_search import document_text, document_chunks
+from lib.chunk_metadata import ChunkMetadata
+from lib.encoding import embedding_dimensions, open_output, encode_rows
+from constants import *
+
+
+def load_queries(path):
+    with open(path, "r") as file:
+        if path.endswith(".json"):
+            return [test_case["query"] for test_case in json.load(file)["test_cases"]]
+
+        return [line.strip() for line in file if line.strip() != ""]
+
+def random_queries(index, count, length, seed=0):
+    # Terms are drawn in proportion to their document frequency so that the
+    # queries lean on long postings lists.
+    rng = random.Random(seed)
+    terms = sorted(index.postings)
+    weights = [len(index.postings[term][0]) for term in terms]
+
+    return [" ".join(rng.choices(terms, weights, k=length)) for _ in range(count)]
+
+def bench_bm25_modes(index, queries, limit):
+
+    timings = {}
+    scored = {}
+    postings = {}
+    results = {}
+
+    for mode in BM25_MODES:
+        scored[mode] = 0
+        postings[mode] = 0
+        results[mode] = []
+
+        start = time.perf_counter()
+
+        for query in queries:
+            results[mode].append(list(index.bm25_search(query, limit, mode).items()))
+            scored[mode] += index.search_stats["scored"]
+            postings[mode] += index.search_stats["postings"]
+
+        timings[mode] = time.perf_counter() - start
+
+    print(f"{len(queries)} queries, top {limit}, {len(index.doc_ids)} documents")
+    print()
+    # Scored counts documents, Postings the BM25 term scores computed.
+    print(f"{'Mode':<12}{'Time (ms)':>12}{'Scored':>12}{'Skipped':>12}{'Postings':>12}{'Speedup':>10}  Identical")
+
+    for mode in BM25_MODES:
+        skipped = scored["exhaustive"] - scored[mode]
+        speedup = timings["exhaustive"] / timings[mode] if timings[mode] > 0 else float("inf")
+        identical = results[mode] == results["exhaustive"]
+
+        print(f"{mode:<12}{timings[mode] * 1000:>12.2f}{scored[mode]:>12}{skipped:>12}{postings[mode]:>12}{speedup:>9.2f}x  {identical}")
+
+def bench_bm25_batch(index, queries, limit):
+
+    start = time.perf_counter()
+    scalar = [list(index.bm25_search(query, limit).items()) for query in queries]
+    scalar_time = time.perf_counter() - start
+
+    # The weight matrix is built once per index, so time it apart from the
+    # queries.
+    start = time.perf_counter()
+    index.bm25_search_batch([], limit)
+    build_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    batch = [list(result.items()) for result in index.bm25_search_batch(queries, limit)]
+    batch_time = time.perf_counter() - start
+
+    speedup = scalar_time / batch_time if batch_time > 0 else float("inf")
+
+    print(f"{len(queries)} queries, top {limit}, {len(index.doc_ids)} documents")
+    print()
+    print(f"{'Path':<12}{'Time (ms)':>12}{'Per query':>12}{'Speedup':>10}")
+    print(f"{'scalar':<12}{scalar_time * 1000:>12.2f}{scalar_time * 1000 / max(1, len(queries)):>12.3f}{1:>9.2f}x")
+    print(f"{'batch':<12}{batch_time * 1000:>12.2f}{batch_time * 1000 / max(1, len(queries)):>12.3f}{speedup:>9.2f}x")
+    print()
+    print(f"Weight matrix build: {build_time * 1000:.2f} ms")
+    print(f"Identical: {batch == scalar}")
+
+def load_test_cases(path):
+    with open(path, "r") as file:
+        return json.load(file)["test_cases"]
+
+def evaluate_bm25f(index, test_cases, limit, field_weights=None, field_b=None):
+
+    precision = 0.0
+    recall = 0.0
+    reciprocal_rank = 0.0
+
+    # Relevant documents are matched by title, as in evaluation_cli.
+    start = time.perf_counter()
+
+    for test_case in test_cases:
+        results = index.bm25_search(test_case["query"], limit, field_weights=field_weights, field_b=field_b)
+        titles = [index.docmap[doc_id]["title"] for doc_id in results]
+        relevant = set(test_case["relevant_docs"])
+        hits = [title in relevant for title in titles]
+
+        precision += sum(hits) / max(1, len(titles))
+        recall += sum(hits) / max(1, len(relevant))
+        reciprocal_rank += 1 / (hits.index(True) + 1) if True in hits else 0.0
+
+    elapsed = time.perf_counter() - start
+    count = max(1, len(test_cases))
+
+    return precision / count, recall / count, reciprocal_rank / count, elapsed * 1000 / count
+
+def bench_bm25f(index, test_cases, limit, title_weights, title_bs):
+
+    print(f"{len(test_cases)} test cases, top {limit}, {len(index.doc_ids)} documents")
+    print()
+    print(f"{'Scoring':<28}{f'P@{limit}':>10}{f'R@{limit}':>10}{'MRR':>10}{'ms/query':>10}")
+
+    rows = [("bm25", None, None)]
+
+    for weight in title_weights:
+        for b in title_bs:
+            rows.append((f"bm25f title={weight:g} b={b:g}", {"title": weight, "description": 1.0}, {"title": b}))
+
+    best = None
+
+    for name, field_weights, field_b in rows:
+        precision, recall, mrr, latency = evaluate_bm25f(index, test_cases, limit, field_weights, field_b)
+
+        print(f"{name:<28}{precision:>10.4f}{recall:>10.4f}{mrr:>10.4f}{latency:>10.3f}")
+
+        if field_weights is not None and (best is None or (mrr, precision) > best[1]):
+            best = (name, (mrr, precision))
+
+    if best is not None:
+        print()
+        print(f"Best by MRR: {best[0]}")
+
+def record_spell_responses(queries, path):
+
+    # Imported here, as only recording needs the LLM client and its
+    # dependencies.
+    from lib.hybrid_search import llm_query, spell_prompt
+
+    responses = []
+
+    for query in queries:
+        start = time.perf_counter()
+        response = llm_query(spell_prompt(query))
+        responses.append({"query": query, "response": response, "seconds": time.perf_counter() - start})
+
+    with open(path, "w") as file:
+        json.dump({"responses": responses}, file, indent=2)
+
+def load_spell_responses(path):
+    with open(path, "r") as file:
+        return json.load(file)["responses"]
+
+def bench_spell(index, responses, repeat):
+
+    analyzer = get_analyzer()
+
+    start = time.perf_counter()
+    index.correct_spelling("")
+    build_time = time.perf_counter() - start
+
+    # The LLM answers in free text, sometimes quoted, so corrections are
+    # compared as the terms they search for.
+    llm_changed = 0
+    corrected = 0
+    false_corrections = 0
+    agreed = 0
+    local_time = 0.0
+
+    for response in responses:
+        query = response["query"]
+        expected = response["response"].strip().strip('"').strip()
+
+        start = time.perf_counter()
+
+        for _ in range(repeat):
+            local = index.correct_spelling(query)
+
+        local_time += (time.perf_counter() - start) / repeat
+
+        query_terms = analyzer.analyze(query)
+        local_terms = analyzer.analyze(local)
+        expected_terms = analyzer.analyze(expected)
+
+        agreed += local_terms == expected_terms
+
+        if expected_terms != query_terms:
+            llm_changed += 1
+            corrected += local_terms == expected_terms
+        elif local_terms != query_terms:
+            false_corrections += 1
+
+    count = max(1, len(responses))
+    llm_times = [response["seconds"] for response in responses if "seconds" in response]
+
+    print(f"{len(responses)} recorded queries, {llm_changed} corrected by the LLM, vocabulary of {len(index.lexicon.terms)} words")
+    print()
+    print(f"Lexicon build: {build_time * 1000:.2f} ms")
+    print(f"Local latency: {local_time * 1e6 / count:.1f} us per query")
+
+    if len(llm_times) > 0:
+        llm_latency = sum(llm_times) / len(llm_times)
+        print(f"LLM latency:   {llm_latency * 1e6:.1f} us per query ({llm_latency / max(local_time / count, 1e-12):.0f}x)")
+
+    print()
+    print(f"Same terms as the LLM:   {agreed}/{len(responses)} ({agreed / count:.0%})")
+    print(f"LLM corrections matched: {corrected}/{llm_changed} ({corrected / max(1, llm_changed):.0%})")
+    print(f"Changed, LLM did not:    {false_corrections}")
+
+def typed_prefixes(index, count, seed=0):
+
+    # Every prefix of random titles, as if typed one key at a time.
+    rng = random.Random(seed)
+    prefixes = []
+
+    for _ in range(count):
+        title = index.docmap[int(index.doc_ids[rng.randrange(len(index.doc_ids))])]["title"]
+        prefixes.extend(title[:i] for i in range(1, len(title) + 1))
+
+    return [prefix for prefix in prefixes if normalize(prefix) != ""]
+
+def scan_suggestions(words, titles, prefix, limit):
+
+    # What suggest() would take without a prefix index: a pass over every
+    # word and every title key.
+    text = normalize(prefix)
+    last = text.split()[-1]
+    word_results = sorted((-df, word) for word, df in words if word.startswith(last))[:limit]
+    matches = []
+
+    for row, (doc_id, title, keys, popularity) in enumerate(titles):
+        matching = [key for key in keys if key.startswith(text)]
+
+        if len(matching) > 0:
+            matches.append((-popularity, min(matching), row, doc_id, title))
+
+    title_results = [(doc_id, title) for _, _, _, doc_id, title in sorted(matches)[:limit]]
+
+    return {"words": [(word, -df) for df, word in word_results], "titles": title_results}
+
+def bench_suggest(index, count, limit, scan_count):
+
+    prefixes = typed_prefixes(index, count)
+
+    # The first call maps the prefix indexes and computes block maxima.
+    start = time.perf_counter()
+    index.suggest("a", limit)
+    warm_time = time.perf_counter() - start
+
+    timings = []
+    results = []
+
+    for prefix in prefixes:
+        start = time.perf_counter()
+        results.append(index.suggest(prefix, limit))
+        timings.append(time.perf_counter() - start)
+
+    timings = np.array(timings) * 1e6
+
+    words, dfs = index.get_vocabulary()
+    popularity = index.lengths - index.title_lengths if index.title_lengths is not None else index.lengths
+    titles = []
+
+    for row, doc_id in enumerate(index.doc_ids.tolist()):
+        title = index.docmap[doc_id]["title"]
+        title_words = normalize(title).split()
+        titles.append((doc_id, title, [" ".join(title_words[i:]) for i in range(len(title_words))], int(popularity[row])))
+
+    words = list(zip(words, [int(df) for df in dfs]))
+    scan_prefixes = prefixes[:scan_count]
+
+    start = time.perf_counter()
+    scanned = [scan_suggestions(words, titles, prefix, limit) for prefix in scan_prefixes]
+    scan_time = (time.perf_counter() - start) / max(1, len(scan_prefixes))
+
+    print(f"{len(prefixes)} keystrokes over {count} titles, top {limit}, {len(words)} words, {len(index.doc_ids)} documents")
+    print()
+    print(f"First call: {warm_time * 1000:.2f} ms")
+    print(f"{'Path':<12}{'Mean (us)':>12}{'p50 (us)':>12}{'p99 (us)':>12}{'Max (us)':>12}")
+    print(f"{'prefix':<12}{timings.mean():>12.1f}{np.percentile(timings, 50):>12.1f}{np.percentile(timings, 99):>12.1f}{timings.max():>12.1f}")
+    print(f"{'scan':<12}{scan_time * 1e6:>12.1f}")
+    print()
+    print(f"Identical to scan: {scanned == results[:len(scan_prefixes)]} ({len(scan_prefixes)} keystrokes)")
+
+def phrase_queries(index, count, length, seed=0):
+
+    # Runs of consecutive words from random documents, so every phrase
+    # matches at least once. Runs of stopwords only are skipped.
+    rng = random.Random(seed)
+    analyzer = get_analyzer()
+    phrases = []
+
+    while len(phrases) < count:
+        document = index.docmap[int(index.doc_ids[rng.randrange(len(index.doc_ids))])]
+        words = f"{document['title']} {document['description']}".split()
+        start = rng.randrange(max(1, len(words) - length + 1))
+        phrase = " ".join(words[start:start + length])
+
+        if len(analyzer.analyze(phrase)) > 0:
+            phrases.append(phrase)
+
+    return phrases
+
+def scan_phrase(index, phrase):
+
+    # The alternative without positions: documents holding every term, then
+    # the phrase checked against each document's text.
+    analyzer = get_analyzer()
+    tokens, positions = analyzer.analyze_positions(phrase)
+    offsets = [position - positions[0] for position in positions]
+
+    if any(term not in index.postings for term in tokens):
+        return []
+
+    rows = index.postings[tokens[0]][0]
+    for term in tokens[1:]:
+        rows = np.intersect1d(rows, index.postings[term][0], assume_unique=True)
+
+    matches = []
+
+    for row in rows.tolist():
+        document = index.docmap[int(index.doc_ids[row])]
+        text_tokens, text_positions = analyzer.analyze_positions(f"{document['title']} {document['description']}")
+        occurrences = set(zip(text_tokens, text_positions))
+
+        for term, position in occurrences:
+            if term == tokens[0] and all((tokens[i], position + offsets[i]) in occurrences for i in range(len(tokens))):
+                matches.append(row)
+                break
+
+    return matches
+
+def segment_bytes(index, names):
+
+    segments = index.segment.segments if hasattr(index.segment, "segments") else [index.segment]
+
+    return sum(segment.sections[name][1] for segment in segments for name in names if segment.has_section(name))
+
+def bench_phrase(index, count, length, limit):
+
+    if index.positions is None:
+        print("The index has no positions. Rebuild it with build --positions.")
+        return
+
+    phrases = phrase_queries(index, count, length)
+
+    start = time.perf_counter()
+    positional = [match_rows(index, [Phrase(phrase)]).tolist() for phrase in phrases]
+    positional_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    scanned = [scan_phrase(index, phrase) for phrase in phrases]
+    scan_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for phrase in phrases:
+        index.bm25_search(f'"{phrase}"', limit)
+    search_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for phrase in phrases:
+        index.bm25_search(phrase, limit, proximity=True)
+    proximity_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for phrase in phrases:
+        index.bm25_search(phrase, limit)
+    plain_time = time.perf_counter() - start
+
+    position_size = segment_bytes(index, ["positions", "position_offsets"])
+    posting_size = segment_bytes(index, ["postings", "posting_offsets", "term_df"])
+    total_size = sum(os.path.getsize(segment.path) for segment in (index.segment.segments if hasattr(index.segment, "segments") else [index.segment]))
+
+    print(f"{len(phrases)} phrases of {length} words, {len(index.doc_ids)} documents")
+    print()
+    print(f"Index size: {total_size / 2**20:.1f} MB, postings {posting_size / 2**20:.1f} MB, positions {position_size / 2**20:.1f} MB (+{position_size / max(1, total_size - position_size):.0%})")
+    print()
+    print(f"{'Query':<24}{'Time (ms)':>12}{'Per query':>12}")
+
+    for name, elapsed in [("phrase, positions", positional_time), ("phrase, text scan", scan_time), ("bm25 \"phrase\"", search_time), ("bm25 proximity", proximity_time), ("bm25 keywords", plain_time)]:
+        print(f"{name:<24}{elapsed * 1000:>12.2f}{elapsed * 1000 / len(phrases):>12.3f}")
+
+    print()
+    print(f"Identical matches: {positional == scanned}")
+
+def legacy_movie_scores(embedded_query, chunk_embeddings, chunk_movies, limit):
+
+    movie_scores = {}
+
+    # The per-chunk loop search_chunks used to run, for comparison.
+    for i in range(len(chunk_embeddings)):
+        score = cosine_similarity(embedded_query, chunk_embeddings[i])
+        movie = chunk_movies[i]
+
+        if movie not in movie_scores or score > movie_scores[movie]:
+            movie_scores[movie] = score
+
+    return sorted(movie_scores.items(), key=lambda item: item[1], reverse=True)[:limit]
+
+def bench_semantic(chunk_count, dimensions, query_count, legacy_count, limit, seed=0):
+
+    # Random chunks, about three per movie and grouped by movie as
+    # build_chunk_embeddings writes them.
+    rng = np.random.default_rng(seed)
+    embeddings = rng.standard_normal((chunk_count, dimensions), dtype=np.float32)
+    movies = np.sort(rng.integers(0, max(1, chunk_count // 3), chunk_count))
+    queries = rng.standard_normal((query_count, dimensions), dtype=np.float32)
+
+    start = time.perf_counter()
+    matrix = normalize_rows(embeddings)
+    normalize_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    results = [chunk_movie_scores(query, matrix, movies, limit) for query in queries]
+    vectorized_time = (time.perf_counter() - start) / max(1, query_count)
+
+    chunk_movies = movies.tolist()
+    legacy_count = min(legacy_count, query_count)
+
+    start = time.perf_counter()
+    legacy = [legacy_movie_scores(query, embeddings, chunk_movies, limit) for query in queries[:legacy_count]]
+    legacy_time = (time.perf_counter() - start) / max(1, legacy_count)
+
+    identical = all([movie for movie, _ in expected] == found.tolist() for expected, (found, _) in zip(legacy, results))
+    speedup = legacy_time / vectorized_time if vectorized_time > 0 else float("inf")
+
+    print(f"{chunk_count} chunks of {dimensions} dimensions, {len(np.unique(movies))} movies, top {limit}")
+    print(f"Normalized once in {normalize_time:.2f}s")
+    print()
+    print(f"{'Path':<12}{'Queries':>10}{'Per query (ms)':>16}{'Speedup':>10}")
+    print(f"{'loop':<12}{legacy_count:>10}{legacy_time * 1000:>16.2f}{1:>9.2f}x")
+    print(f"{'vectorized':<12}{query_count:>10}{vectorized_time * 1000:>16.2f}{speedup:>9.2f}x")
+    print()
+    print(f"Same movies in the same order: {identical}")
+
+def bench_semantic_batch(chunk_count, dimensions, query_count, limit, seed=0):
+
+    # Random chunks grouped by movie, as in bench_semantic, and one row per
+    # movie for the movie search.
+    rng = np.random.default_rng(seed)
+    chunk_matrix = normalize_rows(rng.standard_normal((chunk_count, dimensions), dtype=np.float32))
+    chunk_movies = np.sort(rng.integers(0, max(1, chunk_count // 3), chunk_count))
+    movie_matrix = chunk_matrix[np.flatnonzero(np.diff(chunk_movies, prepend=-1))]
+    queries = rng.standard_normal((query_count, dimensions), dtype=np.float32)
+
+    # The scan alone is what a single query cost before its best rows were
+    # scored again.
+    searches = [
+        ("movies", [
+            ("scan only", lambda: [top_indices(cosine_scores(movie_matrix, query), limit) for query in queries]),
+            ("single", lambda: [cosine_top(movie_matrix, query, limit) for query in queries]),
+            ("batch", lambda: cosine_top_batch(movie_matrix, queries, limit)),
+        ]),
+        ("chunks", [
+            ("scan only", lambda: [best_per_movie(chunk_movies, cosine_scores(chunk_matrix, query), limit) for query in queries]),
+            ("single", lambda: [chunk_movie_scores(query, chunk_matrix, chunk_movies, limit) for query in queries]),
+            ("batch", lambda: chunk_movie_scores_batch(queries, chunk_matrix, chunk_movies, limit)),
+        ]),
+    ]
+
+    print(f"{query_count} queries, top {limit}, {len(movie_matrix)} movies, {chunk_count} chunks of {dimensions} dimensions")
+    print()
+    print(f"{'Search':<10}{'Path':<12}{'Time (ms)':>12}{'Per query':>12}{'Speedup':>10}")
+
+    identical = {}
+
+    for name, paths in searches:
+        timings = {}
+        results = {}
+
+        for label, search in paths:
+            start = time.perf_counter()
+            results[label] = search()
+            timings[label] = time.perf_counter() - start
+
+        for label, _ in paths:
+            speedup = timings["single"] / timings[label] if timings[label] > 0 else float("inf")
+
+            print(f"{name:<10}{label:<12}{timings[label] * 1000:>12.2f}{timings[label] * 1000 / max(1, query_count):>12.3f}{speedup:>9.2f}x")
+
+        identical[name] = all(np.array_equal(a[0], b[0]) and np.array_equal(a[1], b[1]) for a, b in zip(results["single"], results["batch"]))
+
+    print()
+
+    for name, same in identical.items():
+        print(f"Identical {name}: {same}")
+
+def clustered_vectors(count, dimensions, seed=0):
+
+    # Points around a few hundred centres, loosely like embeddings of
+    # texts on a few hundred topics. Uniform noise has no neighbourhoods
+    # for a graph to follow.
+    rng = np.random.default_rng(seed)
+    centres = rng.standard_normal((max(1, count // 100), dimensions)).astype(np.float32)
+
+    return centres[rng.integers(0, len(centres), count)] + 0.6 * rng.standard_normal((count, dimensions), dtype=np.float32)
+
+def bench_hnsw(vectors, query_count, k, m, ef_construction, efs, seed=0):
+
+    # Queries are held out of the graph, so none is its own nearest
+    # neighbour.
+    rng = np.random.default_rng(seed)
+    order = rng.permutation(len(vectors))
+    matrix = normalize_rows(vectors[np.sort(order[query_count:])])
+    queries = normalize_rows(vectors[order[:query_count]])
+
+    start = time.perf_counter()
+    index = HNSWIndex(matrix, m, ef_construction).build()
+    build_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    exact = [top_indices(cosine_scores(matrix, query), k) for query in queries]
+    exact_time = time.perf_counter() - start
+
+    print(f"{len(matrix)} vectors of {matrix.shape[1]} dimensions, {len(queries)} queries, recall@{k}")
+    print(f"Built with M={m}, efConstruction={ef_construction} in {build_time:.2f}s ({build_time * 1000 / max(1, len(matrix)):.2f} ms per vector), {index.max_level + 1} levels")
+    print()
+    print(f"{'Search':<12}{'Recall':>10}{'QPS':>12}{'Speedup':>10}")
+    print(f"{'exact':<12}{1:>10.4f}{len(queries) / exact_time:>12.1f}{1:>9.2f}x")
+
+    for ef in efs:
+        start = time.perf_counter()
+        found = [index.search(query, k, ef)[0] for query in queries]
+        elapsed = time.perf_counter() - start
+
+        recall = sum(len(np.intersect1d(expected, result)) for expected, result in zip(exact, found)) / max(1, len(queries) * k)
+
+        print(f"{f'ef={ef}':<12}{recall:>10.4f}{len(queries) / elapsed:>12.1f}{exact_time / elapsed:>9.2f}x")
+
+def bench_ivfpq(vectors, query_count, k, nlist, subquantizers, nprobes, rerank, seed=0):
+
+    # Queries are held out, and the rest is written to disk and mapped, as
+    # the chunk embeddings are.
+    rng = np.random.default_rng(seed)
+    order = rng.permutation(len(vectors))
+    queries = normalize_rows(vectors[order[:query_count]])
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "vectors.npy")
+        np.save(path, np.asarray(vectors[np.sort(order[query_count:])], dtype=np.float32))
+        mapped = np.load(path, mmap_mode="r")
+
+        start = time.perf_counter()
+        index = IVFPQIndex.build(mapped, nlist, subquantizers)
+        build_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        exact = [top_indices(exact_scores(mapped, index.norms, query), k) for query in queries]
+        exact_time = time.perf_counter() - start
+
+        print(f"{len(mapped)} vectors of {mapped.shape[1]} dimensions, {len(queries)} queries, recall@{k}")
+        print(f"Built with nlist={len(index.centroids)}, {subquantizers} subquantizers in {build_time:.2f}s")
+        print(f"Index {index.nbytes() / 2 ** 20:.2f} MB against {mapped.nbytes / 2 ** 20:.2f} MB of float32 vectors: {mapped.nbytes / index.nbytes():.1f}x compression")
+        print()
+        print(f"{'Search':<24}{'Recall':>10}{'ms/query':>12}{'Speedup':>10}")
+        print(f"{'exact':<24}{1:>10.4f}{exact_time * 1000 / len(queries):>12.3f}{1:>9.2f}x")
+
+        for nprobe in nprobes:
+            # Codes alone, then with the best k * rerank re-scored exactly.
+            for label, mapped_vectors in [("codes", None), (f"rerank x{rerank}", mapped)]:
+                start = time.perf_counter()
+                found = [index.search(query, k, nprobe, mapped_vectors, rerank)[0] for query in queries]
+                elapsed = time.perf_counter() - start
+
+                recall = sum(len(np.intersect1d(expected, result)) for expected, result in zip(exact, found)) / max(1, len(queries) * k)
+
+                print(f"{f'nprobe={nprobe} {label}':<24}{recall:>10.4f}{elapsed * 1000 / len(queries):>12.3f}{exact_time / elapsed:>9.2f}x")
+
+        del mapped
+
+def bench_codecs(vectors, query_count, k, codecs, rerank, seed=0):
+
+    # Queries are held out, and the rest is written to disk and mapped, as
+    # the embeddings are.
+    rng = np.random.default_rng(seed)
+    order = rng.permutation(len(vectors))
+    queries = normalize_rows(vectors[order[:query_count]])
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "vectors.npy")
+        np.save(path, np.asarray(vectors[np.sort(order[query_count:])], dtype=np.float32))
+        mapped = np.load(path, mmap_mode="r")
+        matrix = normalize_rows(mapped)
+
+        start = time.perf_counter()
+        exact = [top_indices(cosine_scores(matrix, query), k) for query in queries]
+        exact_time = time.perf_counter() - start
+
+        print(f"{len(matrix)} vectors of {matrix.shape[1]} dimensions, {len(queries)} queries, recall@{k}, shortlist {k * rerank}")
+        print()
+        print(f"{'Codec':<20}{'MB':>10}{'Recall':>10}{'ms/query':>12}{'Speedup':>10}")
+        print(f"{'float32':<20}{matrix.nbytes / 2 ** 20:>10.2f}{1:>10.4f}{exact_time * 1000 / len(queries):>12.3f}{1:>9.2f}x")
+
+        for codec in codecs:
+            quantized = QuantizedMatrix.encode(mapped, codec)
+
+            # The codes alone, then with the shortlist rescored in float32.
+            searches = [
+                (codec, lambda query: top_indices(quantized.scores(query), k)),
+                (f"{codec} rescored", lambda query: quantized_top(quantized, mapped, query, k, rerank)[0]),
+            ]
+
+            for label, search in searches:
+                start = time.perf_counter()
+                found = [search(query) for query in queries]
+                elapsed = time.perf_counter() - start
+
+                recall = sum(len(np.intersect1d(expected, result)) for expected, result in zip(exact, found)) / max(1, len(queries) * k)
+
+                print(f"{label:<20}{quantized.nbytes() / 2 ** 20:>10.2f}{recall:>10.4f}{elapsed * 1000 / len(queries):>12.3f}{exact_time / elapsed:>9.2f}x")
+
+        del mapped
+
+def spectral_vectors(count, dimensions, seed=0):
+
+    # Sentence embeddings put most of their variance in a few directions.
+    # Clustered vectors scaled down dimension by dimension have a falling
+    # spectrum too; isotropic ones would leave PCA nothing to keep.
+    return clustered_vectors(count, dimensions, seed) / np.sqrt(np.arange(1, dimensions + 1, dtype=np.float32))
+
+def bench_pca(vectors, query_count, k, projections, reranks, seed=0):
+
+    # Held-out queries against the rest, mapped from disk, as in
+    # bench_codecs.
+    rng = np.random.default_rng(seed)
+    order = rng.permutation(len(vectors))
+    queries = normalize_rows(vectors[order[:query_count]])
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "vectors.npy")
+        np.save(path, np.asarray(vectors[np.sort(order[query_count:])], dtype=np.float32))
+        mapped = np.load(path, mmap_mode="r")
+        matrix = normalize_rows(mapped)
+
+        start = time.perf_counter()
+        exact = [top_indices(cosine_scores(matrix, query), k) for query in queries]
+        exact_time = time.perf_counter() - start
+
+        print(f"{len(matrix)} vectors of {matrix.shape[1]} dimensions, {len(queries)} queries, recall@{k}")
+        print()
+        print(f"{'Search':<24}{'MB':>10}{'Fit (s)':>10}{'Recall':>10}{'ms/query':>12}{'Speedup':>10}")
+        print(f"{'float32':<24}{matrix.nbytes / 2 ** 20:>10.2f}{'':>10}{1:>10.4f}{exact_time * 1000 / len(queries):>12.3f}{1:>9.2f}x")
+
+        for dimensions in projections:
+            start = time.perf_counter()
+            projection = PCAProjection.fit(mapped, dimensions)
+            fit_time = time.perf_counter() - start
+
+            # The projected rows alone, then shortlists of several sizes
+            # rescored in float32.
+            searches = [(f"{dimensions}-d", lambda query: top_indices(projection.scores(query), k))]
+            searches += [(f"{dimensions}-d x{rerank} rescored", lambda query, rerank=rerank: pca_top(projection, mapped, query, k, rerank)[0]) for rerank in reranks]
+
+            for label, search in searches:
+                start = time.perf_counter()
+                found = [search(query) for query in queries]
+                elapsed = time.perf_counter() - start
+
+                recall = sum(len(np.intersect1d(expected, result)) for expected, result in zip(exact, found)) / max(1, len(queries) * k)
+
+                print(f"{label:<24}{projection.nbytes() / 2 ** 20:>10.2f}{fit_time:>10.2f}{recall:>10.4f}{elapsed * 1000 / len(queries):>12.3f}{exact_time / elapsed:>9.2f}x")
+
+        del mapped
+
+def bench_refresh(documents, percent, seed=0):
+
+    model = get_model(EMBEDDING_MODEL)
+    rng = random.Random(seed)
+
+    # The same documents with a few descriptions edited.
+    changed = [dict(document) for document in documents]
+    edited = rng.sample(range(len(changed)), max(1, round(len(changed) * percent / 100)) if len(changed) > 0 else 0)
+
+    for i in edited:
+        changed[i]["description"] = f"{changed[i]['description']} (edited)"
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "movie_embeddings.npy")
+
+        start = time.perf_counter()
+        refresh_embeddings(EMBEDDING_MODEL, model, documents, document_text, path, reuse=False)
+        first_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        _, unchanged = refresh_embeddings(EMBEDDING_MODEL, model, documents, document_text, path)
+        unchanged_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        refreshed, stats = refresh_embeddings(EMBEDDING_MODEL, model, changed, document_text, path)
+        refresh_time = time.perf_counter() - start
+        refreshed = np.array(refreshed)
+
+        start = time.perf_counter()
+        rebuilt, _ = refresh_embeddings(EMBEDDING_MODEL, model, changed, document_text, path, reuse=False)
+        rebuild_time = time.perf_counter() - start
+
+        difference = float(np.abs(refreshed - rebuilt).max()) if refreshed.size > 0 else 0.0
+        del rebuilt
+
+    print(f"{len(documents)} documents, {len(edited)} edited ({percent}%)")
+    print()
+    print(f"{'Build':<24}{'Encoded':>10}{'Time (s)':>12}{'Speedup':>10}")
+    print(f"{'first build':<24}{len(documents):>10}{first_time:>12.2f}")
+    print(f"{'unchanged refresh':<24}{unchanged['encoded']:>10}{unchanged_time:>12.2f}{rebuild_time / unchanged_time:>9.2f}x")
+    print(f"{f'{percent}% refresh':<24}{stats['encoded']:>10}{refresh_time:>12.2f}{rebuild_time / refresh_time:>9.2f}x")
+    print(f"{'full rebuild':<24}{len(changed):>10}{rebuild_time:>12.2f}{1:>9.2f}x")
+    print()
+    print(f"Largest difference from the full rebuild: {difference:.2e}")
+
+def random_descriptions(count, seed=0):
+
+    # A few short sentences each, as movie descriptions are.
+    rng = random.Random(seed)
+    words = ["the", "a", "man", "woman", "city", "war", "love", "finds", "returns", "secret", "family", "night"]
+
+    for i in range(count):
+        sentences = [" ".join(rng.choices(words, k=rng.randint(4, 12))).capitalize() + "." for _ in range(rng.randint(1, 10))]
+        yield {"id": i, "title": f"Movie {i}", "description": " ".join(sentences)}
+
+def bench_chunk_metadata(documents):
+
+    # Chunking and metadata only: encoding costs the same either way.
+    start = time.perf_counter()
+    chunk_data = []
+
+    for movie_idx, doc in enumerate(documents):
+        chunks = document_chunks(doc)
+
+        for i in range(len(chunks)):
+            chunk_data.append({"movie_idx": movie_idx, "chunk_idx": i, "total_chunks": len(chunks)})
+
+    legacy_build = time.perf_counter() - start
+
+    start = time.perf_counter()
+    metadata = ChunkMetadata.from_counts([len(document_chunks(doc)) for doc in documents])
+    columnar_build = time.perf_counter() - start
+
+    with tempfile.TemporaryDirectory() as directory:
+        legacy_path = os.path.join(directory, "chunk_metadata.json")
+        columnar_path = os.path.join(directory, "chunk_metadata.npz")
+
+        start = time.perf_counter()
+
+        with open(legacy_path, "w") as file:
+            json.dump({"chunks": chunk_data, "total_chunks": len(chunk_data)}, file, indent=2)
+
+        legacy_save = time.perf_counter() - start
+
+        start = time.perf_counter()
+        metadata.save(columnar_path)
+        columnar_save = time.perf_counter() - start
+
+        start = time.perf_counter()
+
+        with open(legacy_path, "r") as file:
+            loaded = json.load(file)["chunks"]
+
+        legacy_load = time.perf_counter() - start
+
+        start = time.perf_counter()
+        reloaded = ChunkMetadata.load(columnar_path)
+        columnar_load = time.perf_counter() - start
+
+        identical = len(loaded) == len(reloaded) and all(loaded[i] == reloaded[i] for i in range(0, len(loaded), max(1, len(loaded) // 10000)))
+
+        print(f"{len(documents)} documents, {len(metadata)} chunks")
+        print()
+        print(f"{'Metadata':<12}{'Build (s)':>12}{'Save (s)':>12}{'Load (s)':>12}{'Size (MB)':>12}")
+        print(f"{'json':<12}{legacy_build:>12.2f}{legacy_save:>12.2f}{legacy_load:>12.3f}{os.path.getsize(legacy_path) / 2 ** 20:>12.1f}")
+        print(f"{'columnar':<12}{columnar_build:>12.2f}{columnar_save:>12.2f}{columnar_load:>12.3f}{os.path.getsize(columnar_path) / 2 ** 20:>12.1f}")
+        print()
+        print(f"Same metadata: {identical}")
+
+def bench_encode(texts, worker_counts, batch_size, window):
+
+    model = get_model(EMBEDDING_MODEL)
+
+    # The single call the builds used to make.
+    start = time.perf_counter()
+    single = np.asarray(model.encode(texts, batch_size=batch_size, show_progress_bar=False), dtype=np.float32)
+    single_time = time.perf_counter() - start
+
+    runs = [(1, 1, "unbucketed")] + [(workers, window, f"{workers} workers") for workers in worker_counts]
+    results = []
+
+    with tempfile.TemporaryDirectory() as directory:
+        for workers, run_window, label in runs:
+            path = os.path.join(directory, f"{label}.npy")
+            output = open_output(path, (len(texts), embedding_dimensions(model)))
+
+            start = time.perf_counter()
+            encode_rows(EMBEDDING_MODEL, texts, len(texts), output, workers=workers, batch_size=batch_size, window=run_window)
+            elapsed = time.perf_counter() - start
+
+            difference = float(np.abs(np.asarray(output) - single).max()) if len(texts) > 0 else 0.0
+            results.append((label, elapsed, difference))
+            del output
+
+    print(f"{len(texts)} texts, batches of {batch_size}, sorted by length {batch_size * window} at a time, {os.cpu_count()} CPUs")
+    print()
+    print(f"{'Pipeline':<16}{'Time (s)':>12}{'Docs/s':>12}{'Speedup':>10}{'Max diff':>12}")
+    print(f"{'single call':<16}{single_time:>12.2f}{len(texts) / single_time:>12.1f}{1:>9.2f}x{0:>12.2e}")
+
+    for label, elapsed, difference in results:
+        print(f"{label:<16}{elapsed:>12.2f}{len(texts) / elapsed:>12.1f}{single_time / elapsed:>9.2f}x{difference:>12.2e}")
+
+def bench_cluster(index, queries, limit, mode, shard_counts, path):
+
+    start = time.perf_counter()
+    single = [list(index.bm25_search(query, limit, mode).items()) for query in queries]
+    single_time = time.perf_counter() - start
+
+    print(f"{len(queries)} queries, top {limit}, {mode}, {len(index.doc_ids)} documents, {os.cpu_count()} CPUs")
+    print()
+    print(f"{'Shards':<8}{'Start (s)':>12}{'Time (ms)':>12}{'Queries/s':>12}{'Speedup':>10}  Identical")
+    print(f"{'single':<8}{'':>12}{single_time * 1000:>12.2f}{len(queries) / single_time:>12.1f}{1:>9.2f}x  True")
+
+    for shards in shard_counts:
+        # Shards are local processes, so they only scale up to the cores
+        # of this host.
+        start = time.perf_counter()
+        cluster = start_local_cluster(shards, path)
+        start_time = time.perf_counter() - start
+
+        try:
+            start = time.perf_counter()
+            results = [list(cluster.bm25_search(query, limit, mode).items()) for query in queries]
+            elapsed = time.perf_counter() - start
+        finally:
+            cluster.close()
+
+        speedup = single_time / elapsed if elapsed > 0 else float("inf")
+
+        print(f"{shards:<8}{start_time:>12.2f}{elapsed * 1000:>12.2f}{len(queries) / elapsed:>12.1f}{speedup:>9.2f}x  {results == single}")
+
+def measure_load(index_format, query, queue):
+
+    # Runs in a fresh process so that peak RSS only covers this load.
+    try:
+        rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        start = time.perf_counter()
+
+        index = InvertedIndex.InvertedIndex()
+
+        if index_format == "pickle":
+            index.load_pickles()
+        else:
+            index.load()
+
+        load_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        index.bm25_search(query)
+        query_time = time.perf_counter() - start
+
+        rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+        queue.put((load_time, query_time, (rss_after - rss_before) / 1024))
+    except Exception as e:
+        queue.put(e)
+
+def run_isolated(target, args):
+
+    context = mp.get_context("spawn")
+    queue = context.Queue()
+    process = context.Process(target=target, args=args + (queue,))
+    process.start()
+    result = queue.get()
+    process.join()
+
+    return result
+
+def bench_load(query, repeat):
+
+    print(f"First query: '{query}', best of {repeat} runs")
+    print()
+    print(f"{'Format':<12}{'Load (ms)':>12}{'Query (ms)':>12}{'RSS (MB)':>12}")
+
+    for index_format in ["pickle", "segment"]:
+        runs = []
+
+        for _ in range(repeat):
+            result = run_isolated(measure_load, (index_format, query))
+
+            if isinstance(result, Exception):
+                print(f"{index_format:<12}{result}")
+                break
+
+            runs.append(result)
+
+        if len(runs) > 0:
+            load_time = min(run[0] for run in runs)
+            query_time = min(run[1] for run in runs)
+            rss = min(run[2] for run in runs)
+
+            print(f"{index_format:<12}{load_time * 1000:>12.2f}{query_time * 1000:>12.2f}{rss:>12.1f}")
+
+def measure_ingest(mode, path, queue):
+
+    try:
+        rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        start = time.perf_counter()
+
+        match mode:
+            case "json":
+                # Whole-file load, as every caller did before streaming.
+                with open(path, "r") as file:
+                    if path.endswith(".jsonl"):
+                        documents = [json.loads(line) for line in file if line.strip() != ""]
+                    else:
+                        documents = json.load(file)["movies"]
+                count = len(documents)
+            case "stream":
+                documents = load_documents(path)
+                count = len(documents)
+            case "build":
+                index = InvertedIndex.InvertedIndex()
+                index.index_documents(iter_batches(path))
+                count = len(index.doc_ids)
+
+        seconds = time.perf_counter() - start
+        rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+        queue.put((count, seconds, rss_before / 1024, rss_after / 1024))
+    except Exception as e:
+        queue.put(e)
+
+def write_synthetic_corpus(source, path, count):
+
+    # Cycles through the source documents under fresh ids, written one
+    # document at a time so the generator itself stays small.
+    written = 0
+
+    with open(path, "w") as file:
+        file.write('{"movies": [')
+
+        while written < count:
+            for document in iter_documents(source):
+                if written >= count:
+                    break
+
+                file.write((", " if written > 0 else "") + json.dumps(dict(document, id=written + 1)))
+                written += 1
+
+            if written == 0:
+                break
+
+        file.write("]}")
+
+def bench_ingest(path, modes):
+
+    print(f"Corpus: {path} ({os.path.getsize(path) / 1024 ** 2:.1f} MB)")
+    print()
+    print(f"{'Mode':<12}{'Documents':>12}{'Time (s)':>12}{'Base (MB)':>12}{'Peak (MB)':>12}")
+
+    for mode in modes:
+        result = run_isolated(measure_ingest, (mode, path))
+
+        if isinstance(result, Exception):
+            print(f"{mode:<12}{result}")
+            continue
+
+        count, seconds, base, peak = result
+        print(f"{mode:<12}{count:>12}{seconds:>12.2f}{base:>12.1f}{peak:>12.1f}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Search Benchmark CLI")
+    subparsers = parser.add_subparsers(dest="command", help="Available commands")
+
+    wand_parser = subparsers.add_parser("wand", help="Compare exhaustive BM25 scoring against WAND and Block-Max WAND pruning.")
+    wand_parser.add_argument("--queries", type=str, default="data/golden_dataset.json", help="Golden dataset JSON or a text file with one query per line.")
+    wand_parser.add_argument("--random", type=int, default=0, help="Optional number of random queries to generate from the index vocabulary instead.")
+    wand_parser.add_argument("--length", type=int, default=8, help="Number of terms in each random query.")
+    wand_parser.add_argument("--limit", type=int, default=10, help="Number of results per query.")
+
+    batch_parser = subparsers.add_parser("batch", help="Compare scalar BM25 search against batched sparse scoring.")
+    batch_parser.add_argument("--queries", type=str, default="data/golden_dataset.json", help="Golden dataset JSON or a text file with one query per line.")
+    batch_parser.add_argument("--random", type=int, default=0, help="Optional number of random queries to generate from the index vocabulary instead.")
+    batch_parser.add_argument("--length", type=int, default=8, help="Number of terms in each random query.")
+    batch_parser.add_argument("--limit", type=int, default=10, help="Number of results per query.")
+
+    phrase_parser = subparsers.add_parser("phrase", help="Measure phrase query latency and the size of the positional index.")
+    phrase_parser.add_argument("--count", type=int, default=200, help="Number of phrase queries, taken from random documents.")
+    phrase_parser.add_argument("--length", type=int, default=3, help="Number of words in each phrase.")
+    phrase_parser.add_argument("--limit", type=int, default=10, help="Number of results per BM25 query.")
+
+    suggest_parser = subparsers.add_parser("suggest", help="Measure prefix completion latency, one keystroke at a time.")
+    suggest_parser.add_argument("--count", type=int, default=200, help="Number of random titles typed out.")
+    suggest_parser.add_argument("--limit", type=int, default=5, help="Number of words and of titles suggested.")
+    suggest_parser.add_argument("--scan", type=int, default=100, help="Number of keystrokes also answered by a full scan, to compare.")
+
+    spell_parser = subparsers.add_parser("spell", help="Compare local spelling correction against recorded LLM corrections.")
+    spell_parser.add_argument("--responses", type=str, default="data/spell_responses.json", help='Recorded LLM corrections: {"responses": [{"query", "response", "seconds"}]}.')
+    spell_parser.add_argument("--record", type=str, help="Query file, golden dataset JSON or one query per line, to send to the LLM first and record into --responses.")
+    spell_parser.add_argument("--repeat", type=int, default=100, help="Local corrections per query, averaged for latency.")
+
+    bm25f_parser = subparsers.add_parser("bm25f", help="Tune BM25F field weights against the golden dataset, with plain BM25 as the baseline.")
+    bm25f_parser.add_argument("--dataset", type=str, default="data/golden_dataset.json", help="Golden dataset JSON with queries and relevant titles.")
+    bm25f_parser.add_argument("--limit", type=int, default=5, help="Number of results per query, k for P@k and R@k.")
+    bm25f_parser.add_argument("--title-weights", type=float, nargs="+", default=[1.0, 2.0, 3.0, 5.0, 8.0], help="Title weights to try, against a description weight of 1.")
+    bm25f_parser.add_argument("--title-b", type=float, nargs="+", default=[0.3, 0.75], help="Title length normalization values to try.")
+
+    semantic_parser = subparsers.add_parser("semantic", help="Compare the per-chunk cosine loop against vectorized chunk search on random embeddings.")
+    semantic_parser.add_argument("--chunks", type=int, default=1000000, help="Number of chunk embeddings.")
+    semantic_parser.add_argument("--dimensions", type=int, default=384, help="Embedding dimensions, 384 for all-MiniLM-L6-v2.")
+    semantic_parser.add_argument("--queries", type=int, default=20, help="Number of queries for the vectorized search.")
+    semantic_parser.add_argument("--loop-queries", type=int, default=2, help="Number of those queries also run through the loop, which is slow.")
+    semantic_parser.add_argument("--limit", type=int, default=10, help="Number of movies per query.")
+
+    semantic_batch_parser = subparsers.add_parser("semantic_batch", help="Compare semantic search one query at a time against batched matrix-matrix scoring on random embeddings.")
+    semantic_batch_parser.add_argument("--chunks", type=int, default=200000, help="Number of chunk embeddings.")
+    semantic_batch_parser.add_argument("--dimensions", type=int, default=384, help="Embedding dimensions, 384 for all-MiniLM-L6-v2.")
+    semantic_batch_parser.add_argument("--queries", type=int, default=256, help="Number of queries.")
+    semantic_batch_parser.add_argument("--limit", type=int, default=10, help="Number of results per query.")
+
+    hnsw_parser = subparsers.add_parser("hnsw", help="Measure HNSW recall against the exact scan, and queries per second at several ef values.")
+    hnsw_parser.add_argument("--embeddings", type=str, default="cache/chunk_embeddings.npy", help="Embeddings to index. Clustered random vectors are used if the file does not exist.")
+    hnsw_parser.add_argument("--count", type=int, default=20000, help="Number of random vectors, without --embeddings.")
+    hnsw_parser.add_argument("--dimensions", type=int, default=384, help="Dimensions of the random vectors.")
+    hnsw_parser.add_argument("--queries", type=int, default=200, help="Number of vectors held out as queries.")
+    hnsw_parser.add_argument("--k", type=int, default=10, help="Neighbours per query.")
+    hnsw_parser.add_argument("--m", type=int, default=HNSW_M, help="HNSW M.")
+    hnsw_parser.add_argument("--ef-construction", type=int, default=HNSW_EF_CONSTRUCTION, help="HNSW efConstruction.")
+    hnsw_parser.add_argument("--ef", type=int, nargs="+", default=[16, 32, 64, 128, 256], help="efSearch values to try.")
+
+    ivfpq_parser = subparsers.add_parser("ivfpq", help="Measure IVF-PQ compression, and recall and latency against the exact scan at several nprobe values.")
+    ivfpq_parser.add_argument("--embeddings", type=str, default="cache/chunk_embeddings.npy", help="Embeddings to index. Clustered random vectors are used if the file does not exist.")
+    ivfpq_parser.add_argument("--count", type=int, default=100000, help="Number of random vectors, without --embeddings.")
+    ivfpq_parser.add_argument("--dimensions", type=int, default=384, help="Dimensions of the random vectors.")
+    ivfpq_parser.add_argument("--queries", type=int, default=200, help="Number of vectors held out as queries.")
+    ivfpq_parser.add_argument("--k", type=int, default=10, help="Neighbours per query.")
+    ivfpq_parser.add_argument("--nlist", type=int, default=IVF_NLIST, help="Number of k-means lists.")
+    ivfpq_parser.add_argument("--subquantizers", type=int, default=IVF_SUBQUANTIZERS, help="Bytes per vector.")
+    ivfpq_parser.add_argument("--nprobe", type=int, nargs="+", default=[1, 4, 16, 64], help="nprobe values to try.")
+    ivfpq_parser.add_argument("--rerank", type=int, default=IVF_RERANK, help="Candidates re-scored exactly per result.")
+
+    pca_parser = subparsers.add_parser("pca", help="Measure memory, latency and recall of PCA-projected search with float32 rescoring at several dimensions and shortlist sizes.")
+    pca_parser.add_argument("--embeddings", type=str, default="cache/chunk_embeddings.npy", help="Embeddings to project. Random vectors with a falling spectrum are used if the file does not exist.")
+    pca_parser.add_argument("--count", type=int, default=200000, help="Number of random vectors, without --embeddings.")
+    pca_parser.add_argument("--dimensions", type=int, default=384, help="Dimensions of the random vectors.")
+    pca_parser.add_argument("--queries", type=int, default=200, help="Number of vectors held out as queries.")
+    pca_parser.add_argument("--k", type=int, default=10, help="Neighbours per query.")
+    pca_parser.add_argument("--projections", type=int, nargs="+", default=[16, 32, 64, 128], help="Dimensions to project onto.")
+    pca_parser.add_argument("--rerank", type=int, nargs="+", default=[2, 5, PCA_RERANK, 20], help="Shortlist sizes to try, in candidates per result.")
+
+    codecs_parser = subparsers.add_parser("codecs", help="Measure memory, latency and recall of each embedding codec against the float32 scan.")
+    codecs_parser.add_argument("--embeddings", type=str, default="cache/chunk_embeddings.npy", help="Embeddings to encode. Clustered random vectors are used if the file does not exist.")
+    codecs_parser.add_argument("--count", type=int, default=200000, help="Number of random vectors, without --embeddings.")
+    codecs_parser.add_argument("--dimensions", type=int, default=384, help="Dimensions of the random vectors.")
+    codecs_parser.add_argument("--queries", type=int, default=100, help="Number of vectors held out as queries.")
+    codecs_parser.add_argument("--k", type=int, default=10, help="Neighbours per query.")
+    codecs_parser.add_argument("--codecs", type=str, nargs="+", choices=EMBEDDING_CODECS[1:], default=EMBEDDING_CODECS[1:], help="Codecs to try.")
+    codecs_parser.add_argument("--rerank", type=int, default=CODEC_RERANK, help="Shortlist size per result, rescored in float32.")
+
+    refresh_parser = subparsers.add_parser("refresh", help="Measure refreshing movie embeddings after editing a share of the documents against a full rebuild.")
+    refresh_parser.add_argument("--path", type=str, default=MOVIES_PATH, help="Corpus to embed.")
+    refresh_parser.add_argument("--percent", type=float, default=1.0, help="Percentage of documents to edit.")
+    refresh_parser.add_argument("--limit", type=int, default=0, help="Optional number of documents to use, 0 for all.")
+
+    chunk_metadata_parser = subparsers.add_parser("chunk_metadata", help="Measure building, saving and loading chunk metadata as JSON and as columns.")
+    chunk_metadata_parser.add_argument("--documents", type=int, default=1000000, help="Number of random documents.")
+    chunk_metadata_parser.add_argument("--path", type=str, default=None, help="Optional corpus to chunk instead of random documents.")
+
+    encode_parser = subparsers.add_parser("encode", help="Measure encoding throughput of the bucketed, multi-process pipeline against a single encode call.")
+    encode_parser.add_argument("--path", type=str, default=MOVIES_PATH, help="Corpus whose descriptions are encoded.")
+    encode_parser.add_argument("--limit", type=int, default=2000, help="Number of documents to encode, 0 for all.")
+    encode_parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4], help="Worker counts to try.")
+    encode_parser.add_argument("--batch-size", type=int, default=ENCODE_BATCH_SIZE, help="Texts per batch.")
+    encode_parser.add_argument("--window", type=int, default=ENCODE_WINDOW, help="Batches sorted by length together.")
+
+    cluster_parser = subparsers.add_parser("cluster", help="Measure BM25 query throughput of local sharded clusters against a single index.")
+    cluster_parser.add_argument("--path", type=str, default=MOVIES_PATH, help="Corpus to index, on a single node and across the shards.")
+    cluster_parser.add_argument("--shards", type=int, nargs="+", default=[1, 2, 4], help="Shard counts to try.")
+    cluster_parser.add_argument("--queries", type=str, default="data/golden_dataset.json", help="Golden dataset JSON or a text file with one query per line.")
+    cluster_parser.add_argument("--random", type=int, default=0, help="Optional number of random queries to generate from the index vocabulary instead.")
+    cluster_parser.add_argument("--length", type=int, default=8, help="Number of terms in each random query.")
+    cluster_parser.add_argument("--limit", type=int, default=10, help="Number of results per query.")
+    cluster_parser.add_argument("--mode", type=str, choices=BM25_MODES, default="exhaustive", help="Query evaluation strategy, on the single index and on each shard.")
+
+    load_parser = subparsers.add_parser("load", help="Compare index load time and memory of the pickle cache against the memory-mapped segment.")
+    load_parser.add_argument("--query", type=str, default="dark knight", help="Query to run right after loading.")
+    load_parser.add_argument("--repeat", type=int, default=3, help="Number of runs per format, the best is reported.")
+
+    ingest_parser = subparsers.add_parser("ingest", help="Compare peak memory of whole-file JSON loading against streaming ingestion.")
+    ingest_parser.add_argument("--path", type=str, default=MOVIES_PATH, help="Corpus to ingest, a JSON file like data/movies.json or JSONL.")
+    ingest_parser.add_argument("--synthetic", type=int, default=0, help="Optional number of documents for a synthetic corpus generated from --path and ingested instead.")
+    ingest_parser.add_argument("--modes", type=str, nargs="+", choices=["json", "stream", "build"], default=["json", "stream", "build"], help="Ingestion paths to measure.")
+
+    args = parser.parse_args()
+
+    match args.command:
+        case "wand":
+            index = InvertedIndex.InvertedIndex()
+
+            try:
+                index.load()
+            except Exception as e:
+                print(e)
+                return
+
+            if args.random > 0:
+                queries = random_queries(index, args.random, args.length)
+            else:
+                queries = load_queries(args.queries)
+
+            bench_bm25_modes(index, queries, args.limit)
+
+            pass
+
+        case "batch":
+            index = InvertedIndex.InvertedIndex()
+
+            try:
+                index.load()
+            except Exception as e:
+                print(e)
+                return
+
+            if args.random > 0:
+                queries = random_queries(index, args.random, args.length)
+            else:
+                queries = load_queries(args.queries)
+
+            bench_bm25_batch(index, queries, args.limit)
+
+            pass
+
+        case "phrase":
+            index = InvertedIndex.InvertedIndex()
+
+            try:
+                index.load()
+            except Exception as e:
+                print(e)
+                return
+
+            bench_phrase(index, args.count, args.length, args.limit)
+
+            pass
+
+        case "suggest":
+            index = InvertedIndex.InvertedIndex()
+
+            try:
+                index.load()
+            except Exception as e:
+                print(e)
+                return
+
+            bench_suggest(index, args.count, args.limit, args.scan)
+
+            pass
+
+        case "spell":
+            index = InvertedIndex.InvertedIndex()
+
+            try:
+                if args.record is not None:
+                    record_spell_responses(load_queries(args.record), args.responses)
+
+                index.load()
+                bench_spell(index, load_spell_responses(args.responses), args.repeat)
+            except Exception as e:
+                print(e)
+                return
+
+            pass
+
+        case "bm25f":
+            index = InvertedIndex.InvertedIndex()
+
+            try:
+                index.load()
+                bench_bm25f(index, load_test_cases(args.dataset), args.limit, args.title_weights, args.title_b)
+            except Exception as e:
+                print(e)
+                return
+
+            pass
+
+        case "semantic":
+            bench_semantic(args.chunks, args.dimensions, args.queries, args.loop_queries, args.limit)
+
+            pass
+
+        case "semantic_batch":
+            bench_semantic_batch(args.chunks, args.dimensions, args.queries, args.limit)
+
+            pass
+
+        case "hnsw":
+            if os.path.isfile(args.embeddings):
+                vectors = np.load(args.embeddings)
+            else:
+                print(f"{args.embeddings} not found, using clustered random vectors")
+                vectors = clustered_vectors(args.count, args.dimensions)
+
+            bench_hnsw(vectors, args.queries, args.k, args.m, args.ef_construction, args.ef)
+
+            pass
+
+        case "ivfpq":
+            if os.path.isfile(args.embeddings):
+                vectors = np.load(args.embeddings, mmap_mode="r")
+            else:
+                print(f"{args.embeddings} not found, using clustered random vectors")
+                vectors = clustered_vectors(args.count, args.dimensions)
+
+            try:
+                bench_ivfpq(vectors, args.queries, args.k, args.nlist, args.subquantizers, args.nprobe, args.rerank)
+            except ValueError as e:
+                print(e)
+                return
+
+            pass
+
+        case "codecs":
+            if os.path.isfile(args.embeddings):
+                vectors = np.load(args.embeddings, mmap_mode="r")
+            else:
+                print(f"{args.embeddings} not found, using clustered random vectors")
+                vectors = clustered_vectors(args.count, args.dimensions)
+
+            bench_codecs(vectors, args.queries, args.k, args.codecs, args.rerank)
+
+            pass
+
+        case "pca":
+            if os.path.isfile(args.embeddings):
+                vectors = np.load(args.embeddings, mmap_mode="r")
+            else:
+                print(f"{args.embeddings} not found, using random vectors")
+                vectors = spectral_vectors(args.count, args.dimensions)
+
+            try:
+                bench_pca(vectors, args.queries, args.k, args.projections, args.rerank)
+            except ValueError as e:
+                print(e)
+                return
+
+            pass
+
+        case "refresh":
+            documents = list(iter_documents(args.path))
+
+            if args.limit > 0:
+                documents = documents[:args.limit]
+
+            bench_refresh(documents, args.percent)
+
+            pass
+
+        case "chunk_metadata":
+            documents = list(iter_documents(args.path) if args.path is not None else random_descriptions(args.documents))
+
+            bench_chunk_metadata(documents)
+
+            pass
+
+        case "encode":
+            texts = [document_text(document) for document in iter_documents(args.path)]
+
+            if args.limit > 0:
+                texts = texts[:args.limit]
+
+            bench_encode(texts, args.workers, args.batch_size, args.window)
+
+            pass
+
+        case "cluster":
+            index = InvertedIndex.InvertedIndex()
+            index.index_documents(iter_batches(args.path))
+
+            if args.random > 0:
+                queries = random_queries(index, args.random, args.length)
+            else:
+                queries = load_queries(args.queries)
+
+            try:
+                bench_cluster(index, queries, args.limit, args.mode, args.shards, args.path)
+            except Exception as e:
+                print(e)
+                return
+
+            pass
+
+        case "load":
+            bench_load(args.query, args.repeat)
+
+            pass
+
+        case "ingest":
+            path = args.path
+
+            if args.synthetic > 0:
+                if not os.path.isdir("cache"):
+                    os.mkdir("cache")
+
+                path = "cache/synthetic_movies.json"
+                write_synthetic_corpus(args.path, path, args.synthetic)
+
+            try:
+                bench_ingest(path, args.modes)
+            finally:
+                if args.synthetic > 0:
+                    os.remove(path)
+
+            pass
+
+        case _:
+            parser.print_help()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+
+import argparse
+from lib.cluster import serve_shard, start_local_cluster, parse_address, read_authkey, ClusterSearch
+from constants import *
+
+
+def connect(args):
+
+    # Shards already serving elsewhere, or local ones started for this run.
+    if args.workers is not None:
+        return ClusterSearch([parse_address(worker) for worker in args.workers], read_authkey(args.authkey_file))
+
+    return start_local_cluster(args.shards, args.path, args.positions)
+
+def main():
+    parser = argparse.ArgumentParser(description="Sharded Search CLI")
+    subparsers = parser.add_subparsers(dest="command", help="Available commands")
+
+    serve_parser = subparsers.add_parser("serve", help="Serve one shard of the corpus until a coordinator closes it")
+    serve_parser.add_argument("shard", type=int, help="Shard number, from 0")
+    serve_parser.add_argument("shards", type=int, help="Total number of shards")
+    serve_parser.add_argument("--host", type=str, default="localhost", help="Address to listen on.")
+    serve_parser.add_argument("--authkey-file", type=str, help=f"File holding the secret coordinators authenticate with. Without it, ${CLUSTER_AUTHKEY_ENV} must be set.")
+    serve_parser.add_argument("--port", type=int, default=0, help="Port to listen on. 0 picks a free one.")
+    serve_parser.add_argument("--path", type=str, default=MOVIES_PATH, help="Corpus the shard takes its documents from.")
+    serve_parser.add_argument("--positions", action="store_true", help="Also store word positions, for phrase and NEAR/k queries and proximity ranking.")
+
+    for name, help in [("bm25search", "Search movies with BM25 across all shards"), ("search_chunked", "Search movies with chunked semantic search across all shards")]:
+        search_parser = subparsers.add_parser(name, help=help)
+        search_parser.add_argument("query", type=str, help="Search query")
+        search_parser.add_argument("limit", type=int, nargs='?', default=5, help="Optional maximum number of results.")
+        search_parser.add_argument("--workers", type=str, nargs="+", metavar="HOST:PORT", help="Shards started with serve, in shard order. Without it, local shards are started for this search.")
+        search_parser.add_argument("--authkey-file", type=str, help=f"File holding the secret the --workers were started with. Without it, ${CLUSTER_AUTHKEY_ENV} must be set.")
+        search_parser.add_argument("--shards", type=int, default=CLUSTER_SHARDS, help="Number of local shards to start.")
+        search_parser.add_argument("--path", type=str, default=MOVIES_PATH, help="Corpus the local shards take their documents from.")
+        search_parser.add_argument("--positions", action="store_true", help="Build the local shards with word positions.")
+
+        if name == "bm25search":
+            search_parser.add_argument("--mode", type=str, choices=BM25_MODES, default="exhaustive", help="Query evaluation strategy on each shard.")
+            search_parser.add_argument("--filter", type=str, help="Optional boolean query that documents must match before they are scored.")
+            search_parser.add_argument("--proximity", action="store_true", help="Boost documents where neighbouring query terms occur close together. Needs --positions.")
+
+    args = parser.parse_args()
+
+    match args.command:
+        case "serve":
+            try:
+                authkey = read_authkey(args.authkey_file)
+            except Exception as e:
+                print(e)
+                return
+
+            print(f"Indexing shard {args.shard} of {args.shards} from {args.path}")
+
+            try:
+                serve_shard((args.host, args.port), args.path, args.shard, args.shards, args.positions, authkey=authkey)
+            except Exception as e:
+                print(e)
+                return
+
+            pass
+
+        case "bm25search":
+            try:
+                cluster = connect(args)
+                results = cluster.bm25_search(args.query, args.limit, args.mode, args.proximity, args.filter)
+                cluster.close()
+            except Exception as e:
+                print(e)
+                return
+
+            i = 1
+            for key in results:
+                print(f"{i}. ({key}) - {results[key]:.2f}")
+                i += 1
+
+            pass
+
+        case "search_chunked":
+            try:
+                cluster = connect(args)
+                results = cluster.search_chunks(args.query, args.limit)
+                cluster.close()
+            except Exception as e:
+                print(e)
+                return
+
+            i = 1
+            for result in results:
+                print(f"\n{i}. {result['title']} (score: {result['score']:.4f})")
+                print(f"   {result['document']}...")
+                i += 1
+
+            pass
+
+        case _:
+            parser.print_help()
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,62 @@
 BM25_K1 = 1.5
 BM25_B = 0.75
-SCORE_PRECISION = 4
\ No newline at end of file
+SCORE_PRECISION = 4
+BM25_MODES = ["exhaustive", "wand", "bmw"]
+BM25_BLOCK_SIZE = 64
+STEM_CACHE_SIZE = 100000
+DOCUMENT_BATCH_SIZE = 1000
+INDEX_SEGMENT_PATH = "cache/index.seg"
+INDEX_MANIFEST_PATH = "cache/segments.json"
+SEGMENT_MERGE_LIMIT = 8
+SEGMENT_MERGE_FACTOR = 4
+SEGMENT_DELETE_RATIO = 0.25
+TERM_CACHE_SIZE = 10000
+MOVIES_PATH = "data/movies.json"
+BM25_BATCH_BLOCK_CELLS = 4194304
+PROXIMITY_WEIGHT = 1.0
+PROXIMITY_WINDOW = 5
+BM25F_FIELD_WEIGHTS = {"title": 2.0, "description": 1.0}
+BM25F_FIELD_B = {"title": 0.75, "description": 0.75}
+SPELL_MAX_DISTANCE = 2
+SPELL_PREFIX_LENGTH = 7
+SPELL_MIN_WORD_LENGTH = 3
+SUGGEST_BLOCK_SIZE = 64
+CLUSTER_AUTHKEY_ENV = "CLUSTER_AUTHKEY"
+CLUSTER_SHARDS = 4
+EMBEDDING_MODEL = "all-MiniLM-L6-v2"
+CROSS_ENCODER_MODEL = "cross-encoder/ms-marco-TinyBERT-L2-v2"
+CLIP_MODEL = "clip-ViT-B-32"
+QUERY_CACHE_PATH = "cache/query_embeddings.sqlite"
+QUERY_CACHE_SIZE = 4096
+VECTOR_MODES = ["exact", "hnsw", "ivfpq", "pca"]
+HNSW_M = 16
+HNSW_EF_CONSTRUCTION = 100
+HNSW_EF_SEARCH = 64
+HNSW_PATH = "cache/chunk_hnsw.npz"
+IVF_NLIST = 256
+IVF_NPROBE = 16
+IVF_SUBQUANTIZERS = 48
+IVF_RERANK = 8
+IVF_TRAIN_SIZE = 65536
+IVF_KMEANS_ITERATIONS = 20
+IVF_BATCH_SIZE = 65536
+IVFPQ_PATH = "cache/chunk_ivfpq.npz"
+EMBEDDING_CODECS = ["float32", "float16", "int8", "binary"]
+CODEC_RERANK = 10
+CODEC_BATCH_SIZE = 1024
+MOVIE_CODES_PATH = "cache/movie_embeddings.codes.npz"
+CHUNK_CODES_PATH = "cache/chunk_embeddings.codes.npz"
+EMBEDDING_MANIFEST_VERSION = 1
+EMBEDDING_COPY_BATCH_SIZE = 65536
+CHUNK_METADATA_PATH = "cache/chunk_metadata.npz"
+LEGACY_CHUNK_METADATA_PATH = "cache/chunk_metadata.json"
+ENCODE_WORKERS = 1
+ENCODE_BATCH_SIZE = 64
+ENCODE_WINDOW = 64
+SEARCH_BATCH_BLOCK_CELLS = 4194304
+SEARCH_BATCH_TILE_ROWS = 16384
+PCA_DIMENSIONS = 64
+PCA_RERANK = 10
+PCA_TRAIN_SIZE = 65536
+PCA_BATCH_SIZE = 65536
+PCA_PATH = "cache/chunk_pca.npz"
\ No newline at end of file
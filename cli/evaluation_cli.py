@@ -1,5 +1,6 @@
 import argparse, json
 import lib.hybrid_search as hybrid_search
+from lib.document_source import load_documents
 
 
 def main():
@@ -21,10 +22,9 @@ def main():
     with open("data/golden_dataset.json", "r") as f:
         data = json.load(f)
 
-    with open("data/movies.json", "r") as f:
-        documents = json.load(f)
+    documents = load_documents()
 
-    searcher = hybrid_search.HybridSearch(documents["movies"])
+    searcher = hybrid_search.HybridSearch(documents)
 
     for test_case in data["test_cases"]:
 
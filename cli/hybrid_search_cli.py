@@ -1,6 +1,9 @@
 import argparse, json, time
 import lib.hybrid_search
-from sentence_transformers import CrossEncoder
+from lib.document_source import load_documents
+from lib.models import get_model, print_model_stats
+from lib.embedding_cache import print_cache_stats
+from constants import *
 
 
 def main() -> None:
@@ -14,15 +17,19 @@ def main() -> None:
     weighted_search_parser.add_argument("query", type=str, help="Search query")
     weighted_search_parser.add_argument("--alpha", type=float, nargs='?', default=0.5, help="Optional weighting factor for keyword vs semantic search.")
     weighted_search_parser.add_argument("--limit", type=int, nargs='?', default=5, help="Optional maximum number of results.")
+    weighted_search_parser.add_argument("--filter", type=str, help="Optional boolean query of words, phrases, AND, OR and NOT that results must match.")
+    weighted_search_parser.add_argument("--vector-mode", type=str, choices=VECTOR_MODES, default="exact", help="How the semantic half finds its chunks: exact scan, the HNSW graph, the IVF-PQ index or the PCA projection.")
 
     rrf_search_parser = subparsers.add_parser("rrf-search", help="Search movies using a weighted keyword and chunked semantic search.")
     rrf_search_parser.add_argument("query", type=str, help="Search query")
     rrf_search_parser.add_argument("--k", type=int, nargs='?', default=60, help="Optional .")
     rrf_search_parser.add_argument("--limit", type=int, nargs='?', default=5, help="Optional maximum number of results.")
+    rrf_search_parser.add_argument("--filter", type=str, help="Optional boolean query of words, phrases, AND, OR and NOT that results must match.")
+    rrf_search_parser.add_argument("--vector-mode", type=str, choices=VECTOR_MODES, default="exact", help="How the semantic half finds its chunks: exact scan, the HNSW graph, the IVF-PQ index or the PCA projection.")
     rrf_search_parser.add_argument(
         "--enhance",
         type=str,
-        choices=["spell", "rewrite", "expand"],
+        choices=["spell", "local_spell", "rewrite", "expand"],
         help="Query enhancement method",
     )
     rrf_search_parser.add_argument(
@@ -47,12 +54,11 @@ def main() -> None:
 
         case "weighted-search":
             
-            with open("data/movies.json", "r") as file:
-                data = json.load(file)
+            documents = load_documents()
             
-            model = lib.hybrid_search.HybridSearch(data["movies"])
+            model = lib.hybrid_search.HybridSearch(documents, vector_mode=args.vector_mode)
 
-            results = model.weighted_search(args.query, args.alpha, args.limit)
+            results = model.weighted_search(args.query, args.alpha, args.limit, args.filter)
 
             count = 1
             for res in results:
@@ -66,10 +72,9 @@ def main() -> None:
             pass
 
         case "rrf-search":
-            with open("data/movies.json", "r") as file:
-                data = json.load(file)
+            documents = load_documents()
             
-            model = lib.hybrid_search.HybridSearch(data["movies"])
+            model = lib.hybrid_search.HybridSearch(documents, vector_mode=args.vector_mode)
 
             query = args.query
 
@@ -80,19 +85,20 @@ def main() -> None:
 
             match args.enhance:
                 case "spell":
-                    llm_query = f"""Fix any spelling errors in this movie search query.
-
-                        Only correct obvious typos. Don't change correctly spelled words.
-
-                        Query: "{query}"
-
-                        If no errors, return the original query.
-                        Corrected:"""
+                    llm_query = lib.hybrid_search.spell_prompt(query)
                     
                     query = lib.hybrid_search.llm_query(llm_query)
 
                     print(f"Enhanced query ({args.enhance}): '{args.query}' -> '{query}'\n")
 
+                    pass
+                case "local_spell":
+                    # Corrected against the index vocabulary, without a
+                    # round trip to the LLM.
+                    query = model.correct_spelling(query)
+
+                    print(f"Enhanced query ({args.enhance}): '{args.query}' -> '{query}'\n")
+
                     pass
                 case "rewrite":
                     llm_query = f"""Rewrite this movie search query to be more specific and searchable.
@@ -159,7 +165,7 @@ def main() -> None:
                 case _:
                     pass
 
-            results = model.rrf_search(query, args.k, limit)
+            results = model.rrf_search(query, args.k, limit, args.filter)
             
             if args.verbose:
                 print()
@@ -241,7 +247,7 @@ def main() -> None:
                     for i in range(len(results)):
                         pairs.append([query, f"{results[i]['doc'].get('title', '')} - {results[i]['doc'].get('description', '')}"])
 
-                    cross_encoder = CrossEncoder("cross-encoder/ms-marco-TinyBERT-L2-v2")
+                    cross_encoder = get_model(CROSS_ENCODER_MODEL, "cross_encoder")
                     scores = cross_encoder.predict(pairs)
 
                     for i in range(len(scores)):
@@ -313,6 +319,12 @@ def main() -> None:
 
                 for i in range(len(evaluation)):
                     print(f"{formatted_results[i]}: {evaluation[i]}/3")
+
+            if args.verbose:
+                print()
+                print("Models:")
+                print_model_stats()
+                print_cache_stats()
             
             pass
                    
@@ -1,57 +1,106 @@
 #!/usr/bin/env python3
 
-import argparse, json, string, InvertedIndex
-from nltk.stem import PorterStemmer
+import argparse, json, InvertedIndex
+from lib.analyzer import get_analyzer
+from lib.segment_set import read_manifest
+from lib.batch_bm25 import check_documents, check_queries, check_batch
+from lib.query_parser import boolean_tokens, has_operators
 from constants import *
-
-def get_stopwords():
-    with open("data/stopwords.txt", "r") as file:
-        return file.read().splitlines()
     
 def tokenize_text(text):
-    stopwords = get_stopwords()
-    stemmer = PorterStemmer()
+    return get_analyzer().analyze(text)
+
+def find_movies(keyword, index, limit=5, match_all=False):
+
+    # Plain words match any of them, as they always have. A query with
+    # operators, or match_all, is a boolean query, where words next to each
+    # other are ANDed.
+    if not match_all and not has_operators(keyword):
+        keyword = " OR ".join(word for _, word in boolean_tokens(keyword))
 
-    keyword_tokens_temp = text.lower().translate(str.maketrans("", "", string.punctuation)).split()
+    return index.boolean_search(keyword, limit)
 
-    filtered = [w for w in keyword_tokens_temp if w not in stopwords]
+def parse_field_values(pairs):
 
-    keyword_tokens = [stemmer.stem(w) for w in filtered]
+    # ["title=3", "description=1"] -> {"title": 3.0, "description": 1.0}
+    if pairs is None:
+        return None
 
-    return keyword_tokens
+    values = {}
 
-def find_movies(keyword, index):
+    for pair in pairs:
+        field, separator, value = pair.partition("=")
 
-    keyword_tokens = tokenize_text(keyword)
+        if separator == "":
+            raise ValueError(f"Expected field=value, got {pair}")
 
-    results = []
-    seen = set()
+        values[field] = float(value)
 
-    for keyword in keyword_tokens:
-        if keyword not in index.index:
-            continue
+    return values
 
-        for doc_id in index.get_documents(keyword):
-            if doc_id in seen:
+def read_change_feed(path):
+
+    # One change per line: {"op": "add" | "update", "document": {...}} or
+    # {"op": "delete", "id": ...}. Consecutive changes of the same kind are
+    # applied together, until one touches a document already in the batch.
+    batch_op = None
+    batch = []
+    batch_ids = set()
+
+    with open(path, "r") as file:
+        for line in file:
+            if line.strip() == "":
                 continue
 
-            seen.add(doc_id)
-            results.append(doc_id)
+            change = json.loads(line)
+            op = change["op"]
 
-            if len(results) >= 5:
-                return results
-    
-    return results
+            if op not in ["add", "update", "delete"]:
+                raise ValueError(f"Unknown change feed operation: {op}")
+
+            item = change["id"] if op == "delete" else change["document"]
+            doc_id = item if op == "delete" else item["id"]
+
+            if op != batch_op or doc_id in batch_ids:
+                if len(batch) > 0:
+                    yield batch_op, batch
+
+                batch_op = op
+                batch = []
+                batch_ids = set()
+
+            batch.append(item)
+            batch_ids.add(doc_id)
+
+    if len(batch) > 0:
+        yield batch_op, batch
 
     
 def main() -> None:
     parser = argparse.ArgumentParser(description="Keyword Search CLI")
     subparsers = parser.add_subparsers(dest="command", help="Available commands")
 
-    search_parser = subparsers.add_parser("search", help="Search movies using BM25")
-    search_parser.add_argument("query", type=str, help="Search query")
+    search_parser = subparsers.add_parser("search", help="Find movies matching a boolean query")
+    search_parser.add_argument("query", type=str, help='Words, any of which a movie must contain, or a boolean query of words, "phrases", NEAR/k, AND, OR, NOT and parentheses, where words next to each other are ANDed.')
+    search_parser.add_argument("limit", type=int, nargs='?', default=5, help="Optional maximum number of results.")
+    search_parser.add_argument("--all", action="store_true", help="Require every word of a plain query, as if joined by AND.")
+
+    suggest_parser = subparsers.add_parser("suggest", help="Complete a partly typed query from the index vocabulary and movie titles")
+    suggest_parser.add_argument("prefix", type=str, help="What has been typed so far")
+    suggest_parser.add_argument("limit", type=int, nargs='?', default=5, help="Optional maximum number of words and of titles.")
 
     build_parser = subparsers.add_parser("build", help="Build the inverted index for movie searches")
+    build_parser.add_argument("--workers", type=int, default=1, help="Number of processes that analyze the corpus in parallel.")
+    build_parser.add_argument("--positions", action="store_true", help="Also store word positions, for phrase and NEAR/k queries and proximity ranking.")
+
+    subparsers.add_parser("convert", help="Convert a pickled index cache into the memory-mapped segment format")
+
+    apply_parser = subparsers.add_parser("apply", help="Apply a JSONL change feed of added, updated and deleted movies to the index")
+    apply_parser.add_argument("feed", type=str, help="Path to the JSONL change feed")
+
+    subparsers.add_parser("merge", help="Merge all index segments into one and drop deleted documents")
+
+    subparsers.add_parser("segments", help="List the index segments and their deleted documents")
 
     tf_parser = subparsers.add_parser("tf", help="See the term frequency for a given doc_id and a given term")
     tf_parser.add_argument("doc_id", type=int, help="Document ID")
@@ -74,8 +123,18 @@ def main() -> None:
     bm25tf_parser.add_argument("b", type=float, nargs='?', default=BM25_B, help="Tunable BM25 B parameter")
 
     bm25search_parser = subparsers.add_parser("bm25search", help="Search movies using full BM25 scoring")
-    bm25search_parser.add_argument("query", type=str, help="Search query")
+    bm25search_parser.add_argument("query", type=str, help='Search query. "quoted phrases" and a NEAR/k b restrict the results if the index has positions.')
     bm25search_parser.add_argument("limit", type=int, nargs='?', default=5, help="Optional maximum number of results.")
+    bm25search_parser.add_argument("--mode", type=str, choices=BM25_MODES, default="exhaustive", help="Query evaluation strategy. wand and bmw prune documents that cannot reach the top results.")
+    bm25search_parser.add_argument("--filter", type=str, help="Optional boolean query, as for search, that documents must match before they are scored.")
+    bm25search_parser.add_argument("--proximity", action="store_true", help="Boost documents where neighbouring query terms occur close together. Needs an index built with --positions.")
+    bm25search_parser.add_argument("--fields", type=str, nargs="+", metavar="FIELD=WEIGHT", help="Score with BM25F using these field weights, e.g. title=3 description=1. Unlisted fields keep their defaults.")
+    bm25search_parser.add_argument("--field-b", type=str, nargs="+", metavar="FIELD=B", help="Per-field length normalization for BM25F, e.g. title=0.3.")
+
+    verify_batch_parser = subparsers.add_parser("verify_batch", help="Check that batched BM25 gives bm25_search's results exactly, on a small generated corpus")
+    verify_batch_parser.add_argument("--index", action="store_true", help="Check the saved index instead, with queries drawn from its vocabulary.")
+    verify_batch_parser.add_argument("--queries", type=int, default=200, help="Number of random queries.")
+    verify_batch_parser.add_argument("--limit", type=int, default=10, help="Results per query.")
 
     args = parser.parse_args()
 
@@ -91,17 +150,129 @@ def main() -> None:
                 print(e)
                 return
             
-            movies = find_movies(args.query, index)
-            
+            try:
+                movies = find_movies(args.query, index, args.limit, args.all)
+            except Exception as e:
+                print(e)
+                return
+
             for movie in movies:
                 print(f"{movie}. {index.docmap[movie]['title']}")
 
             pass
         
+        case "verify_batch":
+            index = InvertedIndex.InvertedIndex()
+
+            if args.index:
+                try:
+                    index.load()
+                except Exception as e:
+                    print(e)
+                    return
+
+                vocabulary = sorted(index.postings)
+            else:
+                documents, vocabulary = check_documents()
+                index.index_documents([documents])
+
+            # A mismatch raises, so the command fails.
+            checked = check_batch(index, check_queries(vocabulary, args.queries), args.limit)
+
+            print(f"Batch BM25 matches bm25_search on {checked} queries over {len(index.doc_ids)} documents")
+
+            pass
+
+        case "suggest":
+            index = InvertedIndex.InvertedIndex()
+
+            try:
+                index.load()
+                suggestions = index.suggest(args.prefix, args.limit)
+            except Exception as e:
+                print(e)
+                return
+
+            print("Words:")
+            for word, df in suggestions["words"]:
+                print(f"  {word} ({df} documents)")
+
+            print("Titles:")
+            for doc_id, title in suggestions["titles"]:
+                print(f"  {doc_id}. {title}")
+
+            pass
+
         case "build":
             index = InvertedIndex.InvertedIndex()
-            index.build()
+            index.build(args.workers, args.positions)
+            index.save()
+
+            stats = index.build_stats
+            print(f"Analyzed {stats['texts']} texts into {stats['tokens']} tokens in {stats['seconds']:.2f}s")
+            print(f"Stem cache: {stats['stem_cache_hits']} hits, {stats['stem_cache_misses']} misses")
+
+            pass
+
+        case "convert":
+            index = InvertedIndex.InvertedIndex()
+
+            try:
+                index.load_pickles()
+            except Exception as e:
+                print(e)
+                return
+
             index.save()
+            print(f"Converted {len(index.doc_ids)} documents and {len(index.postings)} terms into {INDEX_SEGMENT_PATH}")
+
+            pass
+
+        case "apply":
+            index = InvertedIndex.InvertedIndex()
+
+            counts = {"add": 0, "update": 0, "delete": 0}
+
+            try:
+                for op, batch in read_change_feed(args.feed):
+                    match op:
+                        case "add":
+                            index.add_documents(batch)
+                        case "update":
+                            index.update_documents(batch)
+                        case "delete":
+                            index.delete_documents(batch)
+
+                    counts[op] += len(batch)
+            except Exception as e:
+                print(e)
+
+            print(f"Added {counts['add']}, updated {counts['update']} and deleted {counts['delete']} documents")
+
+            pass
+
+        case "merge":
+            index = InvertedIndex.InvertedIndex()
+
+            try:
+                merged = index.merge_segments(force=True)
+            except Exception as e:
+                print(e)
+                return
+
+            print(f"Ran {merged} merges")
+
+            pass
+
+        case "segments":
+            manifest = read_manifest()
+
+            if manifest is None:
+                print("Index not found. Run build first.")
+                return
+
+            for entry in manifest["segments"]:
+                print(f"{entry['name']}: {entry['doc_count']} documents, {len(entry['deleted'])} deleted")
 
             pass
 
@@ -173,7 +344,7 @@ def main() -> None:
 
             try:
                 index.load()
-                results = index.bm25_search(args.query)
+                results = index.bm25_search(args.query, args.limit, args.mode, args.proximity, args.filter, parse_field_values(args.fields), parse_field_values(args.field_b))
                 
                 i = 1
                 for key in results:
@@ -0,0 +1,129 @@
+import string, time
+from functools import lru_cache
+from nltk.stem import PorterStemmer
+from constants import *
+
+
+class Analyzer:
+    def __init__(self, stopwords, stem_cache_size=STEM_CACHE_SIZE):
+
+        self.stopwords = frozenset(stopwords)
+        self.translation = str.maketrans("", "", string.punctuation)
+        self.stemmer = PorterStemmer()
+        self.stem = lru_cache(maxsize=stem_cache_size)(self.stemmer.stem)
+
+        self.texts = 0
+        self.tokens = 0
+        self.seconds = 0.0
+
+    def __words(self, text):
+        words = text.lower().translate(self.translation).split()
+
+        return [w for w in words if w not in self.stopwords]
+
+    def __tokens(self, text):
+        return [self.stem(w) for w in self.__words(text)]
+
+    def __positioned_words(self, text):
+        words = text.lower().translate(self.translation).split()
+
+        # Positions count every word, stopwords included, so a phrase only
+        # matches text with the same gaps.
+        pairs = [(w, i) for i, w in enumerate(words) if w not in self.stopwords]
+
+        return [w for w, _ in pairs], [i for _, i in pairs]
+
+    def __positioned_tokens(self, text):
+        words, positions = self.__positioned_words(text)
+
+        return [self.stem(w) for w in words], positions
+
+    def analyze(self, text):
+        start = time.perf_counter()
+
+        tokens = self.__tokens(text)
+
+        self.seconds += time.perf_counter() - start
+        self.texts += 1
+        self.tokens += len(tokens)
+
+        return tokens
+
+    def analyze_many(self, texts):
+        start = time.perf_counter()
+
+        token_lists = [self.__tokens(text) for text in texts]
+
+        self.seconds += time.perf_counter() - start
+        self.texts += len(token_lists)
+        self.tokens += sum(len(tokens) for tokens in token_lists)
+
+        return token_lists
+
+    def analyze_positions(self, text):
+        start = time.perf_counter()
+
+        tokens, positions = self.__positioned_tokens(text)
+
+        self.seconds += time.perf_counter() - start
+        self.texts += 1
+        self.tokens += len(tokens)
+
+        return tokens, positions
+
+    def analyze_fields(self, documents, positions=False):
+        start = time.perf_counter()
+
+        analyzed = []
+
+        # A document is a list of field texts, analyzed exactly as the fields
+        # joined into one text. The token counts of all but the last field
+        # tell where each field ends. The words each token was stemmed from
+        # come along for the spelling vocabulary.
+        for fields in documents:
+            # A missing field, such as a movie without a description, is
+            # analyzed as empty.
+            fields = ["" if field is None else field for field in fields]
+            text = " ".join(fields)
+
+            if positions:
+                words, token_positions = self.__positioned_words(text)
+            else:
+                words, token_positions = self.__words(text), None
+
+            tokens = [self.stem(w) for w in words]
+            field_lengths = [len(self.__words(field)) for field in fields[:-1]]
+            analyzed.append((tokens, token_positions, field_lengths, words))
+
+        self.seconds += time.perf_counter() - start
+        self.texts += len(analyzed)
+        self.tokens += sum(len(tokens) for tokens, _, _, _ in analyzed)
+
+        return analyzed
+
+    def get_stats(self):
+        cache = self.stem.cache_info()
+
+        return {
+            "texts": self.texts,
+            "tokens": self.tokens,
+            "seconds": self.seconds,
+            "stem_cache_hits": cache.hits,
+            "stem_cache_misses": cache.misses,
+            "stem_cache_size": cache.currsize,
+        }
+
+analyzer = None
+
+def get_stopwords():
+    with open("data/stopwords.txt", "r") as file:
+        return file.read().splitlines()
+
+def get_analyzer():
+    global analyzer
+
+    # Built on first use so the stopwords are read once per process.
+    if analyzer is None:
+        analyzer = Analyzer(get_stopwords())
+
+    return analyzer
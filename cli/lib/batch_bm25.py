@@ -0,0 +1,132 @@
+import random
+import numpy as np
+from lib.wand import merge_top_k
+from constants import *
+
+# Batch BM25 scoring as a sparse product. The weight matrix holds every
+# term's BM25 contribution per document in CSR form (one row per term), and
+# a block of queries is scored by gathering the rows of its terms and
+# summing them per (query, document) cell.
+#
+# The sum is done with np.bincount, which adds the contributions of a cell
+# in the order given. Terms are gathered in query order, repeats included,
+# so every score is bit-for-bit the one the scalar path computes. A general
+# sparse matrix product does not fix that order.
+
+
+class WeightMatrix:
+    def __init__(self, index):
+
+        terms = sorted(index.postings)
+        rows_parts = []
+        score_parts = []
+
+        self.term_ids = {}
+        self.indptr = np.zeros(len(terms) + 1, dtype=np.int64)
+
+        for i, term in enumerate(terms):
+            rows, scores = index.get_term_scores(term)
+            rows_parts.append(rows)
+            score_parts.append(scores)
+
+            self.term_ids[term] = i
+            self.indptr[i + 1] = self.indptr[i] + len(rows)
+
+        self.indices = np.concatenate(rows_parts) if len(terms) > 0 else np.zeros(0, dtype=np.int64)
+        self.data = np.concatenate(score_parts) if len(terms) > 0 else np.zeros(0)
+        self.doc_count = len(index.doc_ids)
+
+    def term_row(self, term):
+        i = self.term_ids[term]
+        start = self.indptr[i]
+        end = self.indptr[i + 1]
+
+        return self.indices[start:end], self.data[start:end]
+
+def score_batch(matrix, query_terms, limit):
+
+    doc_count = matrix.doc_count
+    results = []
+
+    # Score as many queries at once as fit a dense block of
+    # BM25_BATCH_BLOCK_CELLS scores.
+    block_size = max(1, BM25_BATCH_BLOCK_CELLS // max(1, doc_count))
+
+    for block_start in range(0, len(query_terms), block_size):
+        block = query_terms[block_start:block_start + block_size]
+        cells = []
+        weights = []
+
+        for q, terms in enumerate(block):
+            for term in terms:
+                if term not in matrix.term_ids:
+                    continue
+
+                rows, scores = matrix.term_row(term)
+                cells.append(rows + q * doc_count)
+                weights.append(scores)
+
+        if len(cells) > 0:
+            totals = np.bincount(np.concatenate(cells), weights=np.concatenate(weights), minlength=len(block) * doc_count)
+        else:
+            totals = np.zeros(len(block) * doc_count)
+
+        totals = totals.reshape(len(block), doc_count)
+
+        for q in range(len(block)):
+            # Every contribution is positive, so the matched documents are
+            # exactly the non-zero cells.
+            rows = np.flatnonzero(totals[q])
+
+            if limit <= 0:
+                results.append(([], len(rows)))
+                continue
+
+            top_rows, top_scores = merge_top_k(np.zeros(0, dtype=np.int64), np.zeros(0), rows, totals[q][rows], limit)
+
+            results.append((list(zip(top_rows.tolist(), top_scores.tolist())), len(rows)))
+
+    return results
+
+def check_documents(count=500, seed=0):
+
+    # A small corpus for check_batch: pseudo-words with skewed frequencies,
+    # so postings lists vary in length, some stopwords, and repeated
+    # documents, whose scores tie.
+    rng = random.Random(seed)
+    syllables = ["ka", "lo", "mi", "ren", "tu", "sha", "vo", "dar", "ne", "pi"]
+    vocabulary = ["".join(rng.choices(syllables, k=rng.randint(2, 3))) for _ in range(300)] + ["the", "and", "of"]
+    weights = [1 / (rank + 1) for rank in range(len(vocabulary))]
+    documents = []
+
+    for i in range(count):
+        if i % 50 == 49:
+            title, description = documents[i - 1]["title"], documents[i - 1]["description"]
+        else:
+            title = " ".join(rng.choices(vocabulary, weights, k=rng.randint(1, 4)))
+            description = " ".join(rng.choices(vocabulary, weights, k=rng.randint(0, 40)))
+
+        documents.append({"id": i + 1, "title": title, "description": description})
+
+    return documents, vocabulary
+
+def check_queries(vocabulary, count=200, seed=0):
+
+    # Repeated terms, unknown words, a stopword-only query and a phrase, as
+    # well as plain keywords.
+    rng = random.Random(seed)
+    queries = [" ".join(rng.choices(vocabulary, k=rng.randint(1, 5))) for _ in range(count)]
+
+    return queries + [f"{vocabulary[0]} {vocabulary[0]}", "zzzunknown", "the and of", f'"{vocabulary[1]} {vocabulary[2]}"']
+
+def check_batch(index, queries, limit):
+
+    # Raises on the first query whose batch results differ from
+    # bm25_search's in any document, rank or bit of a score.
+    for query, result in zip(queries, index.bm25_search_batch(queries, limit)):
+        expected = index.bm25_search(query, limit)
+
+        if list(result.items()) != list(expected.items()):
+            raise AssertionError(f"Batch BM25 differs from bm25_search for {query!r}: {list(result.items())} != {list(expected.items())}")
+
+    return len(queries)
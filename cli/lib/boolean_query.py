@@ -0,0 +1,159 @@
+import numpy as np
+from lib.analyzer import get_analyzer
+from lib.positions import POSITION_SHIFT, clause_spans, contains
+from lib.query_parser import Term, Phrase, Near, And, Or, Not, parse_boolean
+
+# Boolean evaluation over sorted postings rows.
+#
+# A node evaluates to (rows, negated): sorted unique rows, and whether the
+# node matches exactly those rows or every row but them. Keeping NOT
+# symbolic means "a NOT b" only ever probes b's rows against a's, and the
+# complement of a set is only built if the whole expression is negated.
+#
+# A node with nothing indexed in it, like a word that is a stopword, is None
+# and constrains nothing, the way stopwords are dropped from keyword queries.
+
+
+def intersect(first, second):
+
+    short, long = (first, second) if len(first) <= len(second) else (second, first)
+
+    if len(short) == 0:
+        return short
+
+    # Skip the stretch of the long list outside the short list's range.
+    start = np.searchsorted(long, short[0], side="left")
+    end = np.searchsorted(long, short[-1], side="right")
+
+    return short[contains(long[start:end], short)]
+
+def matching_indices(rows, values):
+
+    # Indices of the rows that are also in values, probing whichever list
+    # is shorter into the other.
+    if len(values) < len(rows):
+        found = np.minimum(np.searchsorted(rows, values), len(rows) - 1)
+        return found[rows[found] == values]
+
+    return np.flatnonzero(contains(values, rows))
+
+def difference(rows, excluded):
+    return rows[~contains(excluded, rows)]
+
+def union(row_lists):
+
+    if len(row_lists) == 0:
+        return np.zeros(0, dtype=np.int64)
+
+    if len(row_lists) == 1:
+        return row_lists[0]
+
+    return np.unique(np.concatenate(row_lists))
+
+def intersect_all(row_lists):
+
+    # Cheapest first: start from the rarest list, so every later probe is
+    # into a result no longer than it, and stop once nothing is left.
+    row_lists = sorted(row_lists, key=len)
+    rows = row_lists[0]
+
+    for other in row_lists[1:]:
+        if len(rows) == 0:
+            break
+
+        rows = intersect(rows, other)
+
+    return rows
+
+def term_rows(index, text):
+
+    tokens = get_analyzer().analyze(text)
+
+    if len(tokens) == 0:
+        return None
+
+    rows = [index.postings[term][0] if term in index.postings else np.zeros(0, dtype=np.int64) for term in tokens]
+
+    return intersect_all(rows)
+
+def positional_rows(index, node):
+
+    # Without positions a phrase or NEAR/k can only require its words.
+    if index.positions is None:
+        return evaluate(index, And([Term(word) for word in node.text.split()]))
+
+    spans = clause_spans(index, node)
+
+    if spans is None:
+        return None
+
+    return np.unique(spans[0] >> POSITION_SHIFT), False
+
+def evaluate(index, node):
+
+    match node:
+        case Term():
+            rows = term_rows(index, node.text)
+            return None if rows is None else (rows, False)
+
+        case Phrase() | Near():
+            return positional_rows(index, node)
+
+        case Not():
+            result = evaluate(index, node.child)
+            return None if result is None else (result[0], not result[1])
+
+        case And():
+            results = [result for result in (evaluate(index, child) for child in node.children) if result is not None]
+
+            if len(results) == 0:
+                return None
+
+            included = [rows for rows, negated in results if not negated]
+            excluded = [rows for rows, negated in results if negated]
+
+            # a AND NOT b AND NOT c = a minus (b or c), and with no a at all,
+            # NOT (b or c).
+            if len(included) == 0:
+                return union(excluded), True
+
+            rows = intersect_all(included)
+
+            for other in sorted(excluded, key=len, reverse=True):
+                if len(rows) == 0:
+                    break
+
+                rows = difference(rows, other)
+
+            return rows, False
+
+        case Or():
+            results = [result for result in (evaluate(index, child) for child in node.children) if result is not None]
+
+            if len(results) == 0:
+                return None
+
+            included = [rows for rows, negated in results if not negated]
+            excluded = [rows for rows, negated in results if negated]
+
+            # a OR NOT b OR NOT c = NOT ((b and c) minus a).
+            if len(excluded) == 0:
+                return union(included), False
+
+            return difference(intersect_all(excluded), union(included)), True
+
+def filter_rows(index, expression):
+
+    result = evaluate(index, parse_boolean(expression))
+
+    # An expression of stopwords only matches nothing, whether it is a
+    # search or a filter.
+    if result is None:
+        return np.zeros(0, dtype=np.int64)
+
+    rows, negated = result
+
+    if negated:
+        return difference(np.arange(len(index.doc_ids), dtype=np.int64), rows)
+
+    return rows
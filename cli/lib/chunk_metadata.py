@@ -0,0 +1,91 @@
+import json, os
+import numpy as np
+from collections.abc import Sequence
+from constants import *
+
+# Chunk metadata as columns.
+#
+# Chunks are written movie by movie, so the chunks of movie m are rows
+# offsets[m]:offsets[m + 1] of the chunk embeddings. Besides the offsets only
+# the movie and position of each chunk are kept, as two int32 arrays saved
+# beside the embeddings; loading them is one read of an .npz, where the old
+# indented JSON list was parsed into a dict per chunk. Indexing still gives
+# the old dicts, for results.
+
+
+class ChunkMetadata(Sequence):
+    def __init__(self, movie_idx, chunk_idx, offsets):
+
+        self.movie_idx = movie_idx
+        self.chunk_idx = chunk_idx
+        self.offsets = offsets
+
+    @classmethod
+    def from_counts(cls, counts):
+
+        # counts[m] is the number of chunks of movie m.
+        counts = np.asarray(counts, dtype=np.int64)
+        offsets = np.concatenate(([0], np.cumsum(counts)))
+        starts = np.repeat(offsets[:-1], counts)
+
+        movie_idx = np.repeat(np.arange(len(counts), dtype=np.int32), counts)
+        chunk_idx = (np.arange(offsets[-1]) - starts).astype(np.int32)
+
+        return cls(movie_idx, chunk_idx, offsets)
+
+    @classmethod
+    def from_json(cls, path):
+
+        # A cache written before the columns existed.
+        with open(path, "r") as file:
+            chunks = json.load(file)["chunks"]
+
+        movie_idx = np.array([chunk["movie_idx"] for chunk in chunks], dtype=np.int32)
+        counts = np.bincount(movie_idx, minlength=int(movie_idx.max()) + 1 if len(movie_idx) > 0 else 0)
+
+        if np.any(movie_idx[1:] < movie_idx[:-1]):
+            raise ValueError(f"Chunks in {path} are not in movie order.")
+
+        return cls.from_counts(counts)
+
+    def save(self, path):
+
+        with open(path, "wb") as file:
+            np.savez(file, movie_idx=self.movie_idx, chunk_idx=self.chunk_idx, offsets=self.offsets)
+
+    @classmethod
+    def load(cls, path):
+
+        with np.load(path) as arrays:
+            return cls(arrays["movie_idx"], arrays["chunk_idx"], arrays["offsets"])
+
+    def total_chunks(self, movie):
+        return int(self.offsets[movie + 1] - self.offsets[movie])
+
+    def __getitem__(self, i):
+
+        if i < 0:
+            i += len(self)
+
+        if i < 0 or i >= len(self):
+            raise IndexError(i)
+
+        movie = int(self.movie_idx[i])
+
+        return {"movie_idx": movie, "chunk_idx": int(self.chunk_idx[i]), "total_chunks": self.total_chunks(movie)}
+
+    def __len__(self):
+        return len(self.movie_idx)
+
+def load_chunk_metadata():
+
+    if os.path.isfile(CHUNK_METADATA_PATH):
+        return ChunkMetadata.load(CHUNK_METADATA_PATH)
+
+    # Converted once, then read as columns.
+    if os.path.isfile(LEGACY_CHUNK_METADATA_PATH):
+        metadata = ChunkMetadata.from_json(LEGACY_CHUNK_METADATA_PATH)
+        metadata.save(CHUNK_METADATA_PATH)
+        return metadata
+
+    return None
@@ -0,0 +1,304 @@
+import os
+import multiprocessing as mp
+import numpy as np
+from multiprocessing.connection import Listener, Client
+from multiprocessing import AuthenticationError
+from InvertedIndex import InvertedIndex
+from lib.document_source import iter_documents, batched
+from lib.boolean_query import filter_rows
+from lib.vectors import group_chunks, chunk_movie_scores
+from lib.chunk_metadata import load_chunk_metadata
+from lib.models import get_model
+from lib.embedding_cache import embed_query
+from constants import *
+
+# Scatter-gather search over a corpus split into shards.
+#
+# Document i of the corpus belongs to shard i % shards, and is row i // shards
+# there. Each shard is a worker process with its own index over its documents,
+# reached over a socket, so a worker can run on this host or another one that
+# has the corpus. The coordinator sends a query to every shard at once and
+# merges their top-k.
+#
+# Results are the same as one index over the whole corpus:
+#   - shards score with the document count, total length and dfs of the whole
+#     corpus, which the coordinator gathers once when it connects, so every
+#     document gets the score it would get on a single node;
+#   - each shard returns its own top k, zero-scored fill included, ranked by
+#     score and then row, and the corpus row of a document is known from its
+#     shard row, so merging by score and then corpus row keeps ties in order.
+#
+# Messages are pickles, and unpickling runs code, so shards and coordinator
+# share a secret they authenticate with, on every address, loopback too:
+# any local process could otherwise connect. It comes from a file or the
+# CLUSTER_AUTHKEY environment variable, and nothing runs without one. Local
+# clusters make a fresh secret for every run.
+
+
+def shard_documents(path, shard, shards):
+
+    for i, document in enumerate(iter_documents(path)):
+        if i % shards == shard:
+            yield document
+
+def corpus_row(row, shard, shards):
+    return row * shards + shard
+
+def read_authkey(path=None):
+
+    if path is not None:
+        with open(path, "rb") as file:
+            authkey = file.read().strip()
+
+        if len(authkey) == 0:
+            raise ValueError(f"{path} holds no secret.")
+
+        return authkey
+
+    authkey = os.environ.get(CLUSTER_AUTHKEY_ENV, "")
+
+    if authkey == "":
+        raise ValueError(f"No cluster secret. Set {CLUSTER_AUTHKEY_ENV} or pass --authkey-file.")
+
+    return authkey.encode("utf-8")
+
+
+class ShardServer:
+    def __init__(self, path, shard, shards, positions=False):
+
+        self.shard = shard
+        self.shards = shards
+
+        self.index = InvertedIndex()
+        self.index.index_documents(batched(shard_documents(path, shard, shards)), positions=positions)
+
+        # Normalized chunks of this shard's movies and the movie of each,
+        # loaded on the first vector query.
+        self.chunk_matrix = None
+        self.chunk_movies = None
+
+    def load_chunks(self):
+
+        chunk_metadata = load_chunk_metadata()
+
+        if chunk_metadata is None:
+            raise Exception("No chunk embeddings. Run `semantic_search_cli.py embed_chunks` first.")
+
+        movies = chunk_metadata.movie_idx
+        chunks = np.flatnonzero(movies % self.shards == self.shard)
+
+        chunk_embeddings = np.load("cache/chunk_embeddings.npy", mmap_mode="r")[chunks]
+        self.chunk_matrix, self.chunk_movies = group_chunks(chunk_embeddings, movies[chunks])
+
+    def document(self, movie_idx):
+        return self.index.docmap[int(self.index.doc_ids[movie_idx // self.shards])]
+
+    def handle(self, command, *args):
+
+        match command:
+            case "statistics":
+                return len(self.index.doc_ids), int(self.index.lengths.sum()), {term: len(rows) for term, (rows, _) in self.index.postings.items()}
+
+            case "use_statistics":
+                self.index.use_global_statistics(*args)
+
+            case "bm25":
+                results = self.index.bm25_search(*args)
+                rows = [corpus_row(self.index.doc_rows[doc_id], self.shard, self.shards) for doc_id in results]
+
+                return list(zip(rows, results.keys(), results.values())), self.index.search_stats["scored"]
+
+            case "filter":
+                return corpus_row(filter_rows(self.index, *args), self.shard, self.shards)
+
+            case "chunks":
+                embedded_query, limit, movie_idxs = args
+
+                if self.chunk_matrix is None:
+                    self.load_chunks()
+
+                movies, scores = chunk_movie_scores(embedded_query, self.chunk_matrix, self.chunk_movies, limit, movie_idxs)
+
+                return [(movie_idx, score, self.document(movie_idx)) for movie_idx, score in zip(movies.tolist(), scores)]
+
+            case _:
+                raise ValueError(f"Unknown shard command: {command}")
+
+    def serve(self, listener):
+
+        # One coordinator at a time. A coordinator that goes away, or that
+        # does not know the secret, leaves the shard waiting for the next
+        # one; "close" stops it.
+        while True:
+            try:
+                connection = listener.accept()
+            except (AuthenticationError, EOFError, OSError):
+                continue
+
+            with connection:
+                while True:
+                    try:
+                        command, *args = connection.recv()
+                    except EOFError:
+                        break
+
+                    if command == "close":
+                        connection.send(("ok", None))
+                        return
+
+                    try:
+                        connection.send(("ok", self.handle(command, *args)))
+                    except Exception as e:
+                        connection.send(("error", f"Shard {self.shard}: {e}"))
+
+def serve_shard(address, path, shard, shards, positions=False, ready=None, authkey=None):
+
+    if authkey is None:
+        raise ValueError(f"Refusing to listen on {address[0]} without a cluster secret.")
+
+    server = ShardServer(path, shard, shards, positions)
+
+    with Listener(address, authkey=authkey) as listener:
+        # Only announced once the index is built, so a coordinator never
+        # waits on a shard that is still loading.
+        if ready is not None:
+            ready.send(listener.address)
+            ready.close()
+        else:
+            print(f"Shard {shard} of {shards} listening on {listener.address[0]}:{listener.address[1]}", flush=True)
+
+        server.serve(listener)
+
+
+class ClusterSearch:
+    def __init__(self, addresses, authkey=None, processes=None):
+
+        if authkey is None:
+            raise ValueError("Refusing to connect to shards without a cluster secret.")
+
+        self.connections = [Client(tuple(address), authkey=authkey) for address in addresses]
+        self.processes = processes or []
+        self.chunk_metadata = None
+        self.search_stats = {}
+
+        # Every shard scores with the statistics of the whole corpus.
+        statistics = self.scatter([("statistics",)] * len(self.connections))
+
+        doc_count = sum(count for count, _, _ in statistics)
+        total_length = sum(length for _, length, _ in statistics)
+        dfs = {}
+
+        for _, _, shard_dfs in statistics:
+            for term, df in shard_dfs.items():
+                dfs[term] = dfs.get(term, 0) + df
+
+        self.doc_count = doc_count
+        self.scatter([("use_statistics", doc_count, total_length, {term: dfs[term] for term in shard_dfs}) for _, _, shard_dfs in statistics])
+
+    def scatter(self, messages):
+
+        # Everything is sent before anything is received, so the shards
+        # work on a query at the same time.
+        for connection, message in zip(self.connections, messages):
+            connection.send(message)
+
+        replies = [connection.recv() for connection in self.connections]
+
+        for status, value in replies:
+            if status == "error":
+                raise Exception(value)
+
+        return [value for _, value in replies]
+
+    def broadcast(self, *message):
+        return self.scatter([message] * len(self.connections))
+
+    def bm25_search(self, query, limit=5, mode="exhaustive", proximity=False, filter_query=None):
+
+        if mode not in BM25_MODES:
+            raise ValueError(f"Unknown BM25 mode: {mode}")
+
+        replies = self.broadcast("bm25", query, limit, mode, proximity, filter_query)
+        entries = [entry for results, _ in replies for entry in results]
+
+        # Best score first, then corpus row, as on a single node.
+        entries.sort(key=lambda entry: (-entry[2], entry[0]))
+
+        self.search_stats = {"mode": mode, "scored": sum(scored for _, scored in replies), "shards": len(self.connections)}
+
+        return {doc_id: score for _, doc_id, score in entries[:limit]}
+
+    def filter_rows(self, expression):
+
+        return np.sort(np.concatenate(self.broadcast("filter", expression)))
+
+    def search_chunks(self, query, limit=10, movie_idxs=None):
+
+        # The query is embedded once, here, and only its vector is sent.
+        embedded_query = embed_query(EMBEDDING_MODEL, get_model(EMBEDDING_MODEL), query)
+        entries = [entry for results in self.broadcast("chunks", embedded_query, limit, movie_idxs) for entry in results]
+        entries.sort(key=lambda entry: (-entry[1], entry[0]))
+
+        if self.chunk_metadata is None:
+            self.chunk_metadata = load_chunk_metadata()
+
+        results = []
+
+        for movie_idx, score, document in entries[:limit]:
+            dic = {}
+            dic["id"] = movie_idx
+            dic["title"] = document["title"]
+            dic["document"] = document["description"][:100]
+            dic["score"] = round(score, SCORE_PRECISION)
+            dic["metadata"] = self.chunk_metadata[dic["id"]]
+            results.append(dic)
+
+        return results
+
+    def close(self):
+
+        for connection in self.connections:
+            if len(self.processes) > 0:
+                connection.send(("close",))
+                connection.recv()
+
+            connection.close()
+
+        for process in self.processes:
+            process.join()
+
+def start_local_cluster(shards=CLUSTER_SHARDS, path=MOVIES_PATH, positions=False):
+
+    # Stand-in for workers on other hosts: one process per shard on
+    # localhost, each on a port of its own choosing.
+    processes = []
+    pipes = []
+    authkey = os.urandom(32)
+
+    for shard in range(shards):
+        receiver, sender = mp.Pipe(duplex=False)
+        process = mp.Process(target=serve_shard, args=(("localhost", 0), path, shard, shards, positions, sender, authkey), daemon=True)
+        process.start()
+        sender.close()
+
+        processes.append(process)
+        pipes.append(receiver)
+
+    addresses = []
+
+    for receiver in pipes:
+        try:
+            addresses.append(receiver.recv())
+        except EOFError:
+            raise Exception("A shard failed to start.")
+
+    return ClusterSearch(addresses, authkey, processes)
+
+def parse_address(text):
+
+    host, separator, port = text.rpartition(":")
+
+    if separator == "":
+        raise ValueError(f"Expected host:port, got {text}")
+
+    return host, int(port)
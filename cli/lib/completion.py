@@ -0,0 +1,112 @@
+import numpy as np
+from lib.analyzer import get_analyzer
+from constants import *
+
+# Prefix completion over sorted keys.
+#
+# Keys sharing a prefix are one contiguous range of a sorted list, found by
+# two binary searches. The best completions of that range come from block
+# maxima: the top k entries of a range all lie in blocks of
+# SUGGEST_BLOCK_SIZE entries whose maxima are at least the k-th highest
+# block maximum, so only those blocks
+# and the partial ones at the range ends are looked at, however many keys
+# share the prefix.
+#
+# Titles are keyed by every suffix that starts at a word, so "dark kn"
+# completes "The Dark Knight" as well as "the dark".
+
+
+def normalize(text):
+    return " ".join(text.lower().translate(get_analyzer().translation).split())
+
+def title_keys(titles, first_row):
+
+    keys = []
+
+    for row, title in enumerate(titles, first_row):
+        words = normalize(title).split()
+
+        for i in range(len(words)):
+            keys.append((" ".join(words[i:]), row))
+
+    return keys
+
+
+class PrefixIndex:
+    def __init__(self, key, count, weights):
+
+        # key(i) is the i-th key in sorted order, and entries with a
+        # negative weight are never suggested.
+        self.key = key
+        self.count = count
+        self.weights = np.asarray(weights, dtype=np.int64)
+        self.block_maxima = None
+
+    def bound(self, prefix, inclusive, low=0):
+
+        high = self.count
+
+        # First key whose prefix is above (or, not inclusive, at least)
+        # the given one.
+        while low < high:
+            middle = (low + high) // 2
+            head = self.key(middle)[:len(prefix)]
+
+            if head < prefix or (inclusive and head == prefix):
+                low = middle + 1
+            else:
+                high = middle
+
+        return low
+
+    def range(self, prefix):
+
+        start = self.bound(prefix, False)
+
+        return start, self.bound(prefix, True, start)
+
+    def top(self, prefix, limit):
+
+        start, end = self.range(prefix)
+
+        if limit <= 0 or start >= end:
+            return np.zeros(0, dtype=np.int64)
+
+        if self.block_maxima is None:
+            starts = np.arange(0, self.count, SUGGEST_BLOCK_SIZE)
+            self.block_maxima = np.maximum.reduceat(self.weights, starts) if self.count > 0 else np.zeros(0)
+
+        # Whole blocks inside the range compete on their maxima, the partial
+        # blocks at either end are always looked at.
+        first = -(-start // SUGGEST_BLOCK_SIZE)
+        last = end // SUGGEST_BLOCK_SIZE
+        entries = []
+
+        if first < last:
+            maxima = self.block_maxima[first:last]
+
+            # Every block tied with the k-th best maximum is kept, so ties
+            # still go to the first key.
+            if len(maxima) > limit:
+                threshold = -np.partition(-maxima, limit - 1)[limit - 1]
+                blocks = first + np.flatnonzero(maxima >= threshold)
+            else:
+                blocks = np.arange(first, last)
+
+            for block in blocks.tolist():
+                entries.append(np.arange(block * SUGGEST_BLOCK_SIZE, (block + 1) * SUGGEST_BLOCK_SIZE))
+
+            entries.append(np.arange(start, first * SUGGEST_BLOCK_SIZE))
+            entries.append(np.arange(last * SUGGEST_BLOCK_SIZE, end))
+        else:
+            entries.append(np.arange(start, end))
+
+        entries = np.concatenate(entries)
+        weights = self.weights[entries]
+        entries = entries[weights >= 0]
+        weights = weights[weights >= 0]
+
+        # Highest weight first, then key order.
+        order = np.lexsort((entries, -weights))
+
+        return entries[order][:limit]
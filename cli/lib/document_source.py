@@ -0,0 +1,272 @@
+import json, tempfile
+import numpy as np
+from array import array
+from collections.abc import Mapping, Sequence
+from constants import *
+
+# Streaming access to the corpus. data/movies.json is read a chunk at a time
+# and documents are decoded one by one, JSONL files a line at a time, so
+# nothing ever holds the raw file or the whole parsed corpus in memory.
+
+READ_CHUNK_SIZE = 1 << 20
+
+WHITESPACE = " \t\n\r"
+
+
+class JSONStreamReader:
+    def __init__(self, file):
+        self.file = file
+        self.decoder = json.JSONDecoder()
+        self.buffer = ""
+        self.position = 0
+        self.eof = False
+
+    def __fill(self):
+
+        if self.eof:
+            return False
+
+        chunk = self.file.read(READ_CHUNK_SIZE)
+
+        if chunk == "":
+            self.eof = True
+            return False
+
+        # Drop what has been consumed so the buffer stays about one chunk.
+        self.buffer = self.buffer[self.position:] + chunk
+        self.position = 0
+
+        return True
+
+    def peek(self):
+
+        while True:
+            while self.position < len(self.buffer) and self.buffer[self.position] in WHITESPACE:
+                self.position += 1
+
+            if self.position < len(self.buffer):
+                return self.buffer[self.position]
+
+            if not self.__fill():
+                return ""
+
+    def expect(self, characters):
+
+        character = self.peek()
+
+        if character == "" or character not in characters:
+            raise ValueError(f"Expected one of '{characters}' in JSON stream, found '{character}'.")
+
+        self.position += 1
+
+        return character
+
+    def decode(self):
+
+        self.peek()
+
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.position)
+
+                # A number running into the end of the buffer may continue
+                # in the next chunk.
+                if end < len(self.buffer) or self.eof:
+                    self.position = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+
+            self.__fill()
+
+    def iter_array(self):
+
+        self.expect("[")
+
+        if self.peek() == "]":
+            self.position += 1
+            return
+
+        while True:
+            yield self.decode()
+
+            if self.expect(",]") == "]":
+                return
+
+    def iter_key(self, key):
+
+        # Values under other top-level keys are decoded and skipped.
+        self.expect("{")
+
+        if self.peek() == "}":
+            return
+
+        while True:
+            name = self.decode()
+            self.expect(":")
+
+            if name == key:
+                yield from self.iter_array()
+            else:
+                self.decode()
+
+            if self.expect(",}") == "}":
+                return
+
+
+def iter_documents(path=MOVIES_PATH):
+
+    with open(path, "r") as file:
+        if path.endswith(".jsonl"):
+            for line in file:
+                if line.strip() != "":
+                    yield json.loads(line)
+            return
+
+        reader = JSONStreamReader(file)
+
+        if reader.peek() == "[":
+            yield from reader.iter_array()
+        else:
+            yield from reader.iter_key("movies")
+
+def batched(documents, batch_size=DOCUMENT_BATCH_SIZE):
+
+    batch = []
+
+    for document in documents:
+        batch.append(document)
+
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+
+    if len(batch) > 0:
+        yield batch
+
+def iter_batches(path=MOVIES_PATH, batch_size=DOCUMENT_BATCH_SIZE):
+    return batched(iter_documents(path), batch_size)
+
+def load_documents(path=MOVIES_PATH):
+
+    store = DocumentStore()
+
+    for batch in iter_batches(path):
+        store.extend(batch)
+
+    return store
+
+
+class DocumentStore(Sequence):
+    def __init__(self):
+
+        # Documents are kept JSON encoded in an anonymous temporary file and
+        # decoded again on access, so only their offsets stay in memory.
+        self.file = tempfile.TemporaryFile()
+        self.offsets = array("Q", [0])
+        self.ids = array("q")
+
+    def append(self, document):
+
+        encoded = json.dumps(document).encode("utf-8")
+
+        self.file.seek(self.offsets[-1])
+        self.file.write(encoded)
+        self.offsets.append(self.offsets[-1] + len(encoded))
+        self.ids.append(document["id"])
+
+    def extend(self, documents):
+        for document in documents:
+            self.append(document)
+
+    def encoded(self, i):
+
+        self.file.seek(self.offsets[i])
+
+        return self.file.read(self.offsets[i + 1] - self.offsets[i])
+
+    def encoded_sizes(self):
+        return [self.offsets[i + 1] - self.offsets[i] for i in range(len(self))]
+
+    def iter_encoded(self):
+        for i in range(len(self)):
+            yield self.encoded(i)
+
+    def __getitem__(self, i):
+
+        if i < 0:
+            i += len(self)
+
+        if i < 0 or i >= len(self):
+            raise IndexError(i)
+
+        return json.loads(self.encoded(i))
+
+    def __iter__(self):
+        for encoded in self.iter_encoded():
+            yield json.loads(encoded)
+
+    def __len__(self):
+        return len(self.ids)
+
+
+class RowLookup(Mapping):
+    def __init__(self, doc_ids):
+
+        # Doc id -> row through a sorted order array, far smaller than a dict
+        # of Python ints.
+        self.doc_ids = np.asarray(doc_ids, dtype=np.int64)
+        self.order = np.argsort(self.doc_ids, kind="stable")
+
+    def __getitem__(self, doc_id):
+
+        position = np.searchsorted(self.doc_ids, doc_id, sorter=self.order)
+
+        if position < len(self.doc_ids):
+            row = int(self.order[position])
+            if self.doc_ids[row] == doc_id:
+                return row
+
+        raise KeyError(doc_id)
+
+    def __iter__(self):
+        for doc_id in self.doc_ids:
+            yield int(doc_id)
+
+    def __len__(self):
+        return len(self.doc_ids)
+
+
+class StoredDocumentView(Mapping):
+    def __init__(self, store, rows):
+        self.store = store
+        self.rows = rows
+
+    def __getitem__(self, doc_id):
+        return self.store[self.rows[doc_id]]
+
+    def __contains__(self, doc_id):
+        return doc_id in self.rows
+
+    def __iter__(self):
+        return iter(self.store.ids)
+
+    def __len__(self):
+        return len(self.store)
+
+    def values(self):
+        return iter(self.store)
+
+    def encoded_sizes(self):
+        return self.store.encoded_sizes()
+
+    def iter_encoded(self):
+        return self.store.iter_encoded()
+
+def document_map(documents):
+
+    if isinstance(documents, DocumentStore):
+        return StoredDocumentView(documents, RowLookup(documents.ids))
+
+    return {document["id"]: document for document in documents}
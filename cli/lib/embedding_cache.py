@@ -0,0 +1,172 @@
+import os, sqlite3, threading
+import numpy as np
+from collections import OrderedDict
+from constants import *
+
+# Query embeddings, cached in two tiers.
+#
+# Queries repeat, and encoding one runs the whole transformer. An embedding
+# is looked up by (model name, query text with its whitespace collapsed)
+# first in a bounded in-memory LRU, then in a SQLite table under cache/, and
+# only encoded if neither has it. The table outlives the process and is
+# shared by every process that opens it; SQLite's write-ahead log lets them
+# read while one of them writes.
+#
+# The collapsed text is only the key. The model is given the query as it
+# was typed, and always on its own: a batch pads its texts to a common
+# length, which moves their vectors slightly, and a cached vector should be
+# the one a single lookup would have encoded.
+
+
+def cache_key(model_name, text):
+    return model_name, " ".join(text.split())
+
+def encode_text(model, text):
+
+    vector = np.array(model.encode([text])[0])
+    vector.flags.writeable = False
+
+    return vector
+
+
+class EmbeddingCache:
+    def __init__(self, path=QUERY_CACHE_PATH, capacity=QUERY_CACHE_SIZE):
+
+        self.path = path
+        self.capacity = capacity
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        self.connection = None
+        self.pid = None
+
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        # Repeats of a missed text within one get_many, encoded once but
+        # found in neither tier, so neither hits nor misses.
+        self.repeats = 0
+
+    def connect(self):
+
+        # A connection does not survive a fork, so a child process opens
+        # its own.
+        if self.connection is not None and self.pid == os.getpid():
+            return self.connection
+
+        directory = os.path.dirname(self.path)
+
+        if directory != "" and not os.path.isdir(directory):
+            os.makedirs(directory, exist_ok=True)
+
+        self.connection = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS embeddings (model TEXT, text TEXT, dtype TEXT, vector BLOB, PRIMARY KEY (model, text))")
+        self.pid = os.getpid()
+
+        return self.connection
+
+    def remember(self, key, vector):
+
+        self.memory[key] = vector
+        self.memory.move_to_end(key)
+
+        while len(self.memory) > self.capacity:
+            self.memory.popitem(last=False)
+
+    def get(self, model_name, model, text):
+
+        key = cache_key(model_name, text)
+
+        with self.lock:
+            if key in self.memory:
+                self.memory_hits += 1
+                self.memory.move_to_end(key)
+                return self.memory[key]
+
+            row = self.connect().execute("SELECT dtype, vector FROM embeddings WHERE model = ? AND text = ?", key).fetchone()
+
+            if row is not None:
+                self.disk_hits += 1
+                vector = np.frombuffer(row[1], dtype=row[0])
+                self.remember(key, vector)
+                return vector
+
+        # Encoded outside the lock, so other queries are not held up. Two
+        # threads missing on the same text both encode it, and both get
+        # the same vector.
+        vector = encode_text(model, text)
+
+        with self.lock:
+            self.misses += 1
+
+            with self.connect() as connection:
+                connection.execute("INSERT OR IGNORE INTO embeddings VALUES (?, ?, ?, ?)", (*key, vector.dtype.str, vector.tobytes()))
+
+            self.remember(key, vector)
+
+        return vector
+
+    def get_many(self, model_name, model, texts):
+
+        keys = [cache_key(model_name, text) for text in texts]
+        vectors = [None] * len(keys)
+        missing = {}
+
+        with self.lock:
+            for i, key in enumerate(keys):
+                if key in self.memory:
+                    self.memory_hits += 1
+                    self.memory.move_to_end(key)
+                    vectors[i] = self.memory[key]
+                    continue
+
+                row = self.connect().execute("SELECT dtype, vector FROM embeddings WHERE model = ? AND text = ?", key).fetchone()
+
+                if row is not None:
+                    self.disk_hits += 1
+                    vectors[i] = np.frombuffer(row[1], dtype=row[0])
+                    self.remember(key, vectors[i])
+                else:
+                    missing.setdefault(key, []).append(i)
+
+        if len(missing) == 0:
+            return vectors
+
+        # Every text neither tier has is encoded as get would, repeats once.
+        encoded = [encode_text(model, texts[indices[0]]) for indices in missing.values()]
+
+        with self.lock:
+            with self.connect() as connection:
+                for key, vector in zip(missing, encoded):
+                    self.misses += 1
+                    self.repeats += len(missing[key]) - 1
+
+                    connection.execute("INSERT OR IGNORE INTO embeddings VALUES (?, ?, ?, ?)", (*key, vector.dtype.str, vector.tobytes()))
+                    self.remember(key, vector)
+
+                    for i in missing[key]:
+                        vectors[i] = vector
+
+        return vectors
+
+    def stats(self):
+
+        with self.lock:
+            return {"memory_hits": self.memory_hits, "disk_hits": self.disk_hits, "misses": self.misses, "repeats": self.repeats, "memory_entries": len(self.memory)}
+
+query_cache = EmbeddingCache()
+
+def embed_query(model_name, model, text):
+    return query_cache.get(model_name, model, text)
+
+def embed_queries(model_name, model, texts):
+    return query_cache.get_many(model_name, model, texts)
+
+def print_cache_stats():
+
+    stats = query_cache.stats()
+    lookups = stats["memory_hits"] + stats["disk_hits"] + stats["misses"]
+    hit_rate = (stats["memory_hits"] + stats["disk_hits"]) / lookups if lookups > 0 else 0.0
+
+    print(f"Query embeddings: {stats['memory_hits']} memory hits, {stats['disk_hits']} disk hits, {stats['misses']} misses ({hit_rate:.0%} hit rate), {stats['repeats']} repeats within a batch")
@@ -0,0 +1,100 @@
+import hashlib, json, os
+import numpy as np
+from lib.encoding import embedding_dimensions, open_output, encode_rows
+from constants import *
+
+# Embeddings kept as one float32 .npy per corpus, next to a JSON manifest of
+# the model that encoded them, their dimensions and a content hash per row.
+#
+# A refresh hashes the text of every document and encodes only those whose
+# hash the manifest does not have. Every other vector is copied over from
+# the previous file, by hash, so reordered documents are reused too. The new
+# file is written beside the old one and swapped in, so readers mapping the
+# old file keep a consistent view.
+
+
+def content_hash(text):
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=8).hexdigest()
+
+def embedding_manifest_path(vectors_path):
+    return f"{os.path.splitext(vectors_path)[0]}.manifest.json"
+
+def read_embedding_manifest(vectors_path):
+
+    path = embedding_manifest_path(vectors_path)
+
+    if not (os.path.isfile(path) and os.path.isfile(vectors_path)):
+        return None
+
+    with open(path, "r") as file:
+        manifest = json.load(file)
+
+    # Only trusted if it still describes the file next to it.
+    shape = np.load(vectors_path, mmap_mode="r").shape
+
+    if manifest.get("version") != EMBEDDING_MANIFEST_VERSION or shape != (len(manifest["hashes"]), manifest["dimensions"]):
+        return None
+
+    return manifest
+
+def write_embedding_manifest(vectors_path, manifest):
+
+    path = embedding_manifest_path(vectors_path)
+    temp_path = f"{path}.tmp"
+
+    with open(temp_path, "w") as file:
+        json.dump(manifest, file)
+
+    os.replace(temp_path, path)
+
+def refresh_embeddings(model_name, model, documents, text, vectors_path, reuse=True, workers=ENCODE_WORKERS):
+
+    hashes = [content_hash(text(document)) for document in documents]
+    manifest = read_embedding_manifest(vectors_path) if reuse else None
+
+    if manifest is not None and manifest["model"] != model_name:
+        manifest = None
+
+    if manifest is not None and manifest["hashes"] == hashes:
+        return np.load(vectors_path, mmap_mode="r"), {"reused": len(hashes), "encoded": 0}
+
+    previous = {}
+    old = None
+
+    if manifest is not None:
+        old = np.load(vectors_path, mmap_mode="r")
+        previous = {content: row for row, content in enumerate(manifest["hashes"])}
+
+    sources = np.array([previous.get(content, -1) for content in hashes], dtype=np.int64)
+    missing = np.flatnonzero(sources < 0)
+    dimensions = manifest["dimensions"] if manifest is not None else None
+
+    if dimensions is None:
+        dimensions = embedding_dimensions(model)
+
+    # Encoded straight into the new file, which an interrupted refresh
+    # leaves behind to resume into.
+    temp_path = f"{vectors_path}.tmp"
+    vectors = open_output(temp_path, (len(hashes), dimensions))
+
+    encode_rows(model_name, (text(documents[row]) for row in missing.tolist()), len(missing), vectors, missing, workers, checkpoint_path=f"{temp_path}.progress")
+
+    reused = np.flatnonzero(sources >= 0)
+
+    for start in range(0, len(reused), EMBEDDING_COPY_BATCH_SIZE):
+        rows = reused[start:start + EMBEDDING_COPY_BATCH_SIZE]
+        vectors[rows] = old[sources[rows]]
+
+    vectors.flush()
+    del vectors, old
+
+    # The old manifest goes first: a crash before the new one is written
+    # leaves no manifest, and the next refresh encodes everything again
+    # instead of trusting stale hashes.
+    if os.path.isfile(embedding_manifest_path(vectors_path)):
+        os.remove(embedding_manifest_path(vectors_path))
+
+    os.replace(temp_path, vectors_path)
+    write_embedding_manifest(vectors_path, {"version": EMBEDDING_MANIFEST_VERSION, "model": model_name, "dimensions": dimensions, "hashes": hashes})
+
+    return np.load(vectors_path, mmap_mode="r"), {"reused": len(reused), "encoded": len(missing)}
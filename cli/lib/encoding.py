@@ -0,0 +1,217 @@
+import hashlib, json, os, sys
+import multiprocessing as mp
+import numpy as np
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from lib.document_source import batched
+from lib.models import get_model
+from constants import *
+
+# Encoding many texts straight into a float32 array on disk.
+#
+# Texts are read a window of ENCODE_WINDOW batches at a time and sorted by
+# length within it, so each batch holds texts of about the same length and
+# the transformer pads little. Batches go to a pool of worker processes, each
+# with its own copy of the model, and are written to their rows of the output
+# as they come back; only the window being read is held in memory.
+#
+# Every batch written is recorded in a checkpoint beside the output, with a
+# hash of its texts. A run started again over the same texts skips the
+# batches already recorded, so an interrupted build resumes where it stopped.
+# The checkpoint also records the output file as it was after the last
+# batch, so one left beside a deleted or recreated output is not trusted.
+
+
+def embedding_dimensions(model):
+
+    dimensions = model.get_sentence_embedding_dimension() if hasattr(model, "get_sentence_embedding_dimension") else None
+
+    if dimensions is None:
+        dimensions = len(model.encode(["dimensions"], show_progress_bar=False)[0])
+
+    return dimensions
+
+def open_output(path, shape):
+
+    # A partial output of the same shape is kept for the checkpoint to
+    # resume into.
+    if os.path.isfile(path):
+        output = np.load(path, mmap_mode="r+")
+
+        if output.shape == shape and output.dtype == np.float32:
+            return output
+
+        del output
+
+    return np.lib.format.open_memmap(path, mode="w+", dtype=np.float32, shape=shape)
+
+def output_identity(output):
+
+    # Rows written through the mapping update the modification time, so
+    # an output changed or replaced since the last record does not match.
+    stat = os.stat(output.filename)
+
+    return {"path": os.path.abspath(output.filename), "size": stat.st_size, "inode": stat.st_ino, "mtime_ns": stat.st_mtime_ns}
+
+def batch_digest(texts):
+
+    digest = hashlib.blake2b(digest_size=8)
+
+    for text in texts:
+        digest.update(text.encode("utf-8"))
+        digest.update(b"\0")
+
+    # The top bit is set so that no digest reads as "not done".
+    return int.from_bytes(digest.digest(), "little") | (1 << 63)
+
+worker_model = None
+
+def init_worker(model_name):
+
+    global worker_model
+    worker_model = get_model(model_name)
+
+    # The pool already uses every core, so each worker keeps to one thread.
+    try:
+        import torch
+        torch.set_num_threads(1)
+    except ImportError:
+        pass
+
+def encode_batch(batch_id, texts):
+    return batch_id, np.asarray(worker_model.encode(texts, batch_size=len(texts), show_progress_bar=False), dtype=np.float32)
+
+
+class EncodingCheckpoint:
+    def __init__(self, path, settings, batches, output):
+
+        # A checkpoint left by a run with other settings, or for another
+        # output file, is started over.
+        self.header_path = f"{path}.json"
+        self.digests_path = f"{path}.npy"
+        self.settings = settings
+        self.output = output
+        self.digests = None
+
+        if os.path.isfile(self.header_path) and os.path.isfile(self.digests_path):
+            try:
+                with open(self.header_path, "r") as file:
+                    header = json.load(file)
+            except ValueError:
+                header = None
+
+            digests = np.load(self.digests_path, mmap_mode="r+")
+
+            if header == self.header() and digests.shape == (batches,):
+                self.digests = digests
+
+        if self.digests is None:
+            self.digests = np.lib.format.open_memmap(self.digests_path, mode="w+", dtype=np.uint64, shape=(batches,))
+            self.write_header()
+
+    def header(self):
+        return {**self.settings, "output": output_identity(self.output)}
+
+    def write_header(self):
+
+        # Replaced whole, so a stop mid-write leaves the old header.
+        with open(f"{self.header_path}.tmp", "w") as file:
+            json.dump(self.header(), file)
+
+        os.replace(f"{self.header_path}.tmp", self.header_path)
+
+    def finished(self, batch_id, digest):
+        return int(self.digests[batch_id]) == digest
+
+    def record(self, batch_id, digest):
+
+        self.digests[batch_id] = digest
+        self.digests.flush()
+        self.write_header()
+
+    def remove(self):
+
+        self.digests = None
+
+        for path in [self.header_path, self.digests_path]:
+            if os.path.isfile(path):
+                os.remove(path)
+
+def encode_rows(model_name, texts, count, output, rows=None, workers=ENCODE_WORKERS, batch_size=ENCODE_BATCH_SIZE, window=ENCODE_WINDOW, checkpoint_path=None):
+
+    # texts yields count strings; text k is written to row rows[k] of output,
+    # or to row k without rows.
+    rows = np.arange(count) if rows is None else np.asarray(rows, dtype=np.int64)
+    batches = -(-count // batch_size)
+    settings = {"model": model_name, "count": count, "shape": list(output.shape), "batch_size": batch_size, "window": window}
+    checkpoint = EncodingCheckpoint(checkpoint_path or f"{output.filename}.progress", settings, batches, output)
+
+    stats = {"encoded": 0, "resumed": 0}
+    pending = {}
+
+    def tasks():
+
+        start = 0
+
+        for chunk in batched(texts, batch_size * window):
+            order = sorted(range(len(chunk)), key=lambda i: len(chunk[i]))
+
+            # Windows are whole numbers of batches, so batch ids are the same
+            # on every run over the same texts.
+            for offset in range(0, len(order), batch_size):
+                batch_id = (start + offset) // batch_size
+                members = order[offset:offset + batch_size]
+                batch_texts = [chunk[i] for i in members]
+                digest = batch_digest(batch_texts)
+
+                if checkpoint.finished(batch_id, digest):
+                    stats["resumed"] += len(members)
+                    continue
+
+                pending[batch_id] = (rows[start + np.array(members, dtype=np.int64)], digest)
+                yield batch_id, batch_texts
+
+            start += len(chunk)
+
+    def write(batch_id, embeddings):
+
+        batch_rows, digest = pending.pop(batch_id)
+
+        # Rows reach the disk before the checkpoint says they are there.
+        output[batch_rows] = embeddings
+        output.flush()
+        checkpoint.record(batch_id, digest)
+
+        stats["encoded"] += len(batch_rows)
+        print(f"\rEncoded {stats['encoded'] + stats['resumed']}/{count} texts", end="", file=sys.stderr, flush=True)
+
+    if workers > 1:
+        # Spawned, not forked: a forked copy of a model that has already
+        # run can hang in its thread pool. An executor rather than a Pool,
+        # so a worker that dies fails the build, which then resumes, instead
+        # of leaving it waiting for ever.
+        with ProcessPoolExecutor(workers, mp_context=mp.get_context("spawn"), initializer=init_worker, initargs=(model_name,)) as pool:
+            in_flight = deque()
+
+            for batch_id, batch_texts in tasks():
+                in_flight.append(pool.submit(encode_batch, batch_id, batch_texts))
+
+                # Bound the batches in flight, or reading would run ahead of
+                # the workers and queue every text.
+                while len(in_flight) > workers * 2:
+                    write(*in_flight.popleft().result())
+
+            while len(in_flight) > 0:
+                write(*in_flight.popleft().result())
+    else:
+        model = get_model(model_name)
+
+        for batch_id, batch_texts in tasks():
+            write(batch_id, np.asarray(model.encode(batch_texts, batch_size=len(batch_texts), show_progress_bar=False), dtype=np.float32))
+
+    if count > 0:
+        print(file=sys.stderr)
+
+    checkpoint.remove()
+
+    return stats
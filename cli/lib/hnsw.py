@@ -0,0 +1,296 @@
+import heapq, math, zlib
+import numpy as np
+from lib.vectors import normalize_vector, best_per_movie, chunk_movie_scores
+from constants import *
+
+# Hierarchical navigable small world graph over unit-length vectors.
+#
+# Every vector is a node on level 0, and on each level above with
+# probability 1/M per level. A search starts from the single node on the top
+# level, walks greedily down to level 0 and there explores the best ef nodes
+# it has seen, so it only ever computes similarities for the neighbours of
+# nodes close to the query instead of for every vector.
+#
+# Similarity is the dot product, which for unit-length rows is the cosine.
+# Links of level l are rows of a (nodes on l, capacity) int32 array, with
+# the number in use kept alongside; level 0 holds 2M links per node and the
+# levels above M, as in the original paper.
+
+
+def fingerprint(vectors):
+    return np.array([len(vectors), vectors.shape[1] if vectors.ndim == 2 else 0, zlib.crc32(np.ascontiguousarray(vectors).data)], dtype=np.int64)
+
+
+class HNSWIndex:
+    def __init__(self, vectors, m=HNSW_M, ef_construction=HNSW_EF_CONSTRUCTION, seed=0):
+
+        self.vectors = vectors
+        self.m = m
+        self.ef_construction = ef_construction
+        self.seed = seed
+
+        self.levels = np.zeros(len(vectors), dtype=np.int8)
+        self.rows = []
+        self.links = []
+        self.counts = []
+        self.entry = -1
+        self.max_level = -1
+
+        # Nodes seen by the current search carry its stamp, so nothing has
+        # to be cleared between searches.
+        self.visited = np.zeros(len(vectors), dtype=np.int32)
+        self.stamp = 0
+
+    def allocate(self, levels):
+
+        self.levels = levels
+        self.rows = []
+        self.links = []
+        self.counts = []
+
+        for level in range(int(levels.max()) + 1 if len(levels) > 0 else 0):
+            nodes = np.flatnonzero(levels >= level)
+            rows = np.full(len(levels), -1, dtype=np.int64)
+            rows[nodes] = np.arange(len(nodes))
+
+            self.rows.append(rows)
+            self.links.append(np.full((len(nodes), self.capacity(level)), -1, dtype=np.int32))
+            self.counts.append(np.zeros(len(nodes), dtype=np.int32))
+
+    def capacity(self, level):
+        return self.m * 2 if level == 0 else self.m
+
+    def build(self):
+
+        # Levels are drawn up front, so every level's arrays can be sized
+        # before the first insert.
+        rng = np.random.default_rng(self.seed)
+        scale = 1 / math.log(self.m)
+        levels = np.floor(-np.log(1 - rng.random(len(self.vectors))) * scale)
+
+        self.allocate(np.minimum(levels, np.iinfo(np.int8).max).astype(np.int8))
+
+        for node in range(len(self.vectors)):
+            self.insert(node)
+
+        return self
+
+    def neighbors(self, node, level):
+
+        row = self.rows[level][node]
+
+        return self.links[level][row, :self.counts[level][row]]
+
+    def search_layer(self, query, entries, ef, level):
+
+        self.stamp += 1
+
+        if self.stamp == np.iinfo(np.int32).max:
+            self.visited[:] = 0
+            self.stamp = 1
+
+        visited = self.visited
+        stamp = self.stamp
+        vectors = self.vectors
+
+        entries = np.asarray(entries, dtype=np.int64)
+        visited[entries] = stamp
+        similarities = (vectors[entries] @ query).tolist()
+
+        # Candidates to expand, best first, and the best ef found so far,
+        # worst first.
+        candidates = [(-similarity, node) for similarity, node in zip(similarities, entries.tolist())]
+        heapq.heapify(candidates)
+        results = [(similarity, node) for similarity, node in zip(similarities, entries.tolist())]
+        heapq.heapify(results)
+
+        while len(results) > ef:
+            heapq.heappop(results)
+
+        while len(candidates) > 0:
+            similarity, node = heapq.heappop(candidates)
+
+            # Nothing left to expand can improve on the results.
+            if -similarity < results[0][0] and len(results) >= ef:
+                break
+
+            links = self.neighbors(node, level)
+            links = links[visited[links] != stamp]
+
+            if len(links) == 0:
+                continue
+
+            visited[links] = stamp
+            similarities = vectors[links] @ query
+
+            if len(results) >= ef:
+                keep = similarities > results[0][0]
+                links = links[keep]
+                similarities = similarities[keep]
+
+            for similarity, link in zip(similarities.tolist(), links.tolist()):
+                if len(results) < ef:
+                    heapq.heappush(results, (similarity, link))
+                elif similarity > results[0][0]:
+                    heapq.heapreplace(results, (similarity, link))
+                else:
+                    continue
+
+                heapq.heappush(candidates, (-similarity, link))
+
+        return sorted(results, key=lambda result: (-result[0], result[1]))
+
+    def select_neighbors(self, found, m):
+
+        # found is (similarity, node) best first. A node is kept only if it
+        # is closer to the base than to every node kept before it, which
+        # spreads the links out in all directions instead of into one
+        # cluster.
+        if len(found) <= m:
+            return [node for _, node in found]
+
+        nodes = np.array([node for _, node in found], dtype=np.int64)
+        similarities = np.array([similarity for similarity, _ in found], dtype=np.float32)
+        pairwise = self.vectors[nodes] @ self.vectors[nodes].T
+        selected = []
+
+        for i in range(len(nodes)):
+            if len(selected) == 0 or pairwise[i, selected].max() < similarities[i]:
+                selected.append(i)
+
+                if len(selected) == m:
+                    break
+
+        return nodes[selected].tolist()
+
+    def set_links(self, node, level, links):
+
+        row = self.rows[level][node]
+        self.links[level][row, :len(links)] = links
+        self.links[level][row, len(links):] = -1
+        self.counts[level][row] = len(links)
+
+    def add_link(self, node, link, level):
+
+        row = self.rows[level][node]
+        count = self.counts[level][row]
+
+        if count < self.capacity(level):
+            self.links[level][row, count] = link
+            self.counts[level][row] = count + 1
+            return
+
+        # Full: keep the best spread of the old links and the new one.
+        links = np.append(self.links[level][row, :count], link)
+        similarities = self.vectors[links] @ self.vectors[node]
+        order = np.lexsort((links, -similarities))
+        found = list(zip(similarities[order].tolist(), links[order].tolist()))
+
+        self.set_links(node, level, self.select_neighbors(found, self.capacity(level)))
+
+    def insert(self, node):
+
+        level = int(self.levels[node])
+        query = self.vectors[node]
+
+        if self.entry < 0:
+            self.entry = node
+            self.max_level = level
+            return
+
+        entries = [self.entry]
+
+        for upper in range(self.max_level, level, -1):
+            entries = [self.search_layer(query, entries, 1, upper)[0][1]]
+
+        for current in range(min(level, self.max_level), -1, -1):
+            found = self.search_layer(query, entries, self.ef_construction, current)
+            links = self.select_neighbors(found, self.m)
+
+            self.set_links(node, current, links)
+
+            for link in links:
+                self.add_link(link, node, current)
+
+            entries = [found_node for _, found_node in found]
+
+        if level > self.max_level:
+            self.entry = node
+            self.max_level = level
+
+    def search(self, query, k, ef=HNSW_EF_SEARCH):
+
+        if self.entry < 0 or k <= 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+
+        entries = [self.entry]
+
+        for level in range(self.max_level, 0, -1):
+            entries = [self.search_layer(query, entries, 1, level)[0][1]]
+
+        found = self.search_layer(query, entries, max(ef, k), 0)[:k]
+
+        return np.array([node for _, node in found], dtype=np.int64), np.array([similarity for similarity, _ in found], dtype=np.float32)
+
+    def save(self, path):
+
+        arrays = {
+            "parameters": np.array([self.m, self.ef_construction, self.seed, self.entry, self.max_level], dtype=np.int64),
+            "fingerprint": fingerprint(self.vectors),
+            "levels": self.levels,
+        }
+
+        # Rows of the upper levels follow from the levels, so only the
+        # links and their counts are stored.
+        for level in range(len(self.links)):
+            arrays[f"links_{level}"] = self.links[level]
+            arrays[f"counts_{level}"] = self.counts[level]
+
+        with open(path, "wb") as file:
+            np.savez(file, **arrays)
+
+    @classmethod
+    def load(cls, path, vectors):
+
+        # None if the file was built from other vectors than these.
+        with np.load(path) as arrays:
+            if not np.array_equal(arrays["fingerprint"], fingerprint(vectors)):
+                return None
+
+            m, ef_construction, seed, entry, max_level = arrays["parameters"].tolist()
+            index = cls(vectors, m, ef_construction, seed)
+            index.allocate(arrays["levels"])
+
+            for level in range(len(index.links)):
+                index.links[level] = arrays[f"links_{level}"]
+                index.counts[level] = arrays[f"counts_{level}"]
+
+            index.entry = entry
+            index.max_level = max_level
+
+        return index
+
+def hnsw_movie_scores(index, embedded_query, chunk_movies, limit, ef=HNSW_EF_SEARCH):
+
+    query = normalize_vector(embedded_query)
+    k = limit * 2
+
+    # Movies have several chunks, so ask for more chunks than movies, and
+    # for more again if too many of them share a movie.
+    while True:
+        # Past a tenth of all chunks a graph search costs more than the
+        # scan it is meant to avoid.
+        if k * 10 >= len(chunk_movies):
+            return chunk_movie_scores(embedded_query, index.vectors, chunk_movies, limit)
+
+        chunks, scores = index.search(query, k, max(ef, k))
+        movies = chunk_movies[chunks]
+
+        if len(np.unique(movies)) >= limit:
+            break
+
+        k *= 2
+
+    order = np.argsort(movies, kind="stable")
+
+    return best_per_movie(movies[order], scores[order], limit)
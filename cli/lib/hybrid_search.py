@@ -1,29 +1,51 @@
 import os
 
 from InvertedIndex import InvertedIndex
+from .boolean_query import filter_rows
 from .semantic_search import ChunkedSemanticSearch
 from google import genai
 from dotenv import load_dotenv
 
 
 class HybridSearch:
-    def __init__(self, documents):
+    def __init__(self, documents, bm25_mode="exhaustive", vector_mode="exact"):
         self.documents = documents
-        self.semantic_search = ChunkedSemanticSearch()
+        self.bm25_mode = bm25_mode
+        self.semantic_search = ChunkedSemanticSearch(vector_mode=vector_mode)
         self.semantic_search.load_or_create_chunk_embeddings(documents)
 
         self.idx = InvertedIndex()
-        if not os.path.exists("data/movies.json"):
+        if not self.idx.exists():
             self.idx.build()
             self.idx.save()
 
-    def _bm25_search(self, query, limit):
-        self.idx.load()
-        return self.idx.bm25_search(query, limit)
+    def _bm25_search(self, query, limit, mode=None, filter_query=None):
+        # Picks up segments added or merged since the last search.
+        self.idx.refresh()
+        return self.idx.bm25_search(query, limit, mode or self.bm25_mode, filter_query=filter_query)
 
-    def weighted_search(self, query, alpha, limit=5):
-        bm25_results = self._bm25_search(query, limit*500)
-        semantic_results = self.semantic_search.search_chunks(query, limit*500)
+    def _semantic_search(self, query, limit, filter_query=None):
+
+        if filter_query is None:
+            return self.semantic_search.search_chunks(query, limit)
+
+        rows = filter_rows(self.idx, filter_query)
+
+        # The same boolean filter restricts the chunks that are compared, by
+        # position of their movie in self.documents.
+        allowed = set(self.idx.doc_ids[rows].tolist())
+        doc_ids = self.documents.ids if hasattr(self.documents, "ids") else [doc["id"] for doc in self.documents]
+        movie_idxs = {i for i, doc_id in enumerate(doc_ids) if doc_id in allowed}
+
+        return self.semantic_search.search_chunks(query, limit, movie_idxs)
+
+    def correct_spelling(self, query):
+        self.idx.refresh()
+        return self.idx.correct_spelling(query)
+
+    def weighted_search(self, query, alpha, limit=5, filter_query=None):
+        bm25_results = self._bm25_search(query, limit*500, filter_query=filter_query)
+        semantic_results = self._semantic_search(query, limit*500, filter_query)
 
         keyword_ids = list(bm25_results.keys())
         keyword_scores = list(bm25_results.values())
@@ -72,9 +94,9 @@ class HybridSearch:
         return sorted_results[:result_len]    
         
 
-    def rrf_search(self, query, k=60, limit=10):
-        bm25_results = self._bm25_search(query, limit*500)
-        semantic_results = self.semantic_search.search_chunks(query, limit*500)
+    def rrf_search(self, query, k=60, limit=10, filter_query=None):
+        bm25_results = self._bm25_search(query, limit*500, filter_query=filter_query)
+        semantic_results = self._semantic_search(query, limit*500, filter_query)
 
         score_dict = {}
 
@@ -140,6 +162,16 @@ def hybrid_score(bm25_score, semantic_score, alpha=0.5):
 def rrf_score(rank, k=60):
     return 1 / (k + rank)
 
+def spell_prompt(query):
+    return f"""Fix any spelling errors in this movie search query.
+
+                        Only correct obvious typos. Don't change correctly spelled words.
+
+                        Query: "{query}"
+
+                        If no errors, return the original query.
+                        Corrected:"""
+
 def llm_query(query):
     load_dotenv()
     api_key = os.environ.get("GEMINI_API_KEY")
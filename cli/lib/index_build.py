@@ -0,0 +1,166 @@
+import heapq
+import numpy as np
+from collections import Counter
+from lib.analyzer import get_analyzer
+from lib.completion import title_keys
+
+# Batched index build. Each batch of documents is analyzed into a run of
+# postings sorted by term, in a worker process or inline, and the runs are
+# combined with a k-way merge on term. Rows are global, so concatenating a
+# term's postings in run order gives the same arrays however the corpus was
+# split.
+
+STAT_KEYS = ["texts", "tokens", "seconds", "stem_cache_hits", "stem_cache_misses"]
+
+
+def document_fields(movies):
+    return [(movie["title"], movie["description"]) for movie in movies]
+
+def build_shard(documents, first_row, positions=False):
+
+    analyzer = get_analyzer()
+    before = analyzer.get_stats()
+
+    postings = {}
+    lengths = []
+    title_lengths = []
+    word_dfs = Counter()
+
+    for row, (tokens, token_positions, field_lengths, words) in enumerate(analyzer.analyze_fields(documents, positions), first_row):
+        lengths.append(len(tokens))
+        title_lengths.append(field_lengths[0])
+        word_dfs.update(set(words))
+
+        # The title comes first, so its terms are the leading tokens.
+        title_occurrences = Counter(tokens[:field_lengths[0]])
+
+        if token_positions is None:
+            occurrences = Counter(tokens)
+        else:
+            occurrences = {}
+            for term, position in zip(tokens, token_positions):
+                occurrences.setdefault(term, []).append(position)
+
+        for term, occurrence in occurrences.items():
+            if term not in postings:
+                postings[term] = ([], [], [], [])
+
+            postings[term][0].append(row)
+            postings[term][3].append(title_occurrences[term])
+
+            if token_positions is None:
+                postings[term][1].append(occurrence)
+            else:
+                postings[term][1].append(len(occurrence))
+                postings[term][2].extend(occurrence)
+
+    # One flat array per run rather than two per term, which keeps a run's
+    # memory close to 16 bytes per posting. Positions follow the postings
+    # they belong to, tf of them each.
+    terms = sorted(postings)
+    offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(postings[term][0]) for term in terms])
+    count = int(offsets[-1])
+    rows = np.fromiter((row for term in terms for row in postings[term][0]), dtype=np.int64, count=count)
+    tfs = np.fromiter((tf for term in terms for tf in postings[term][1]), dtype=np.int64, count=count)
+    title_tfs = np.fromiter((tf for term in terms for tf in postings[term][3]), dtype=np.int64, count=count)
+    run_positions = None
+
+    if positions:
+        run_positions = np.fromiter((position for term in terms for position in postings[term][2]), dtype=np.uint32, count=int(tfs.sum()))
+
+    # Pool processes are reused across runs, so report only this run's work.
+    after = analyzer.get_stats()
+    stats = {key: after[key] - before[key] for key in STAT_KEYS}
+
+    return {
+        "terms": terms,
+        "offsets": offsets,
+        "rows": rows,
+        "tfs": tfs,
+        "title_tfs": title_tfs,
+        "lengths": np.array(lengths, dtype=np.int64),
+        "title_lengths": np.array(title_lengths, dtype=np.int64),
+        "stats": stats,
+        "positions": run_positions,
+        "word_dfs": word_dfs,
+        "title_keys": title_keys([fields[0] for fields in documents], first_row),
+    }
+
+def merge_shards(shards):
+
+    postings = {}
+    title_tfs = {}
+    positions = {} if len(shards) > 0 and all(shard["positions"] is not None for shard in shards) else None
+    stats = {key: 0 for key in STAT_KEYS}
+
+    # Where each posting's positions start in its run.
+    position_offsets = [np.concatenate([[0], np.cumsum(shard["tfs"])]) if positions is not None else None for shard in shards]
+
+    # heapq.merge keeps equal terms in run order, and runs hold ascending
+    # row ranges, so each term's rows come out sorted.
+    streams = [term_stream(shard["terms"], i) for i, shard in enumerate(shards)]
+    current = None
+    parts = []
+
+    for term, i, j in heapq.merge(*streams):
+        if term != current:
+            if current is not None:
+                add_postings(postings, title_tfs, positions, current, parts)
+
+            current = term
+            parts = []
+
+        shard = shards[i]
+        start = shard["offsets"][j]
+        end = shard["offsets"][j + 1]
+        run_positions = None
+
+        if positions is not None:
+            run_positions = shard["positions"][position_offsets[i][start]:position_offsets[i][end]]
+
+        parts.append((shard["rows"][start:end], shard["tfs"][start:end], shard["title_tfs"][start:end], run_positions))
+
+    if current is not None:
+        add_postings(postings, title_tfs, positions, current, parts)
+
+    # Document frequencies of the unstemmed words, for spelling correction.
+    word_dfs = Counter()
+
+    for shard in shards:
+        word_dfs.update(shard["word_dfs"])
+
+        for key in STAT_KEYS:
+            stats[key] += shard["stats"][key]
+
+    return {
+        "postings": postings,
+        "title_tfs": title_tfs,
+        "positions": positions,
+        "lengths": concatenate_runs(shards, "lengths"),
+        "title_lengths": concatenate_runs(shards, "title_lengths"),
+        "stats": stats,
+        "word_dfs": dict(sorted(word_dfs.items())),
+        "title_keys": sorted(key for shard in shards for key in shard["title_keys"]),
+    }
+
+def term_stream(terms, shard):
+    for j, term in enumerate(terms):
+        yield term, shard, j
+
+def add_postings(postings, title_tfs, positions, term, parts):
+
+    # Copy even a single part, so the merged postings do not keep the whole
+    # run alive through a view.
+    postings[term] = (np.concatenate([part[0] for part in parts]), np.concatenate([part[1] for part in parts]))
+    title_tfs[term] = np.concatenate([part[2] for part in parts])
+
+    if positions is not None:
+        positions[term] = np.concatenate([part[3] for part in parts])
+
+def concatenate_runs(shards, key):
+
+    if len(shards) == 0:
+        return np.zeros(0, dtype=np.int64)
+
+    return np.concatenate([shard[key] for shard in shards])
\ No newline at end of file
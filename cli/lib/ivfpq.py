@@ -0,0 +1,197 @@
+import numpy as np
+from lib.vectors import normalize_rows, normalize_vector, top_indices, rows_movie_scores
+from constants import *
+
+# Inverted file index with product quantization over unit-length vectors.
+#
+# k-means centroids split the vectors into nlist lists. Within a list a
+# vector is stored as its residual from the centroid, cut into
+# `subquantizers` slices, each replaced by the byte naming the closest of
+# 256 slice centroids. A vector costs `subquantizers` bytes instead of four
+# per dimension.
+#
+# A query is scored against the nprobe lists whose centroids are closest:
+#   q . x  ~  q . centroid + sum over slices of q_s . slice_centroid_s[code_s]
+# where the second term comes from one (subquantizers, 256) lookup table per
+# query. The best candidates are then scored exactly against the original
+# rows, read through a memmap, so only those rows are ever paged in.
+
+
+def nearest_centroids(vectors, centroids):
+
+    # argmin |x - c|^2 = argmax x . c - |c|^2 / 2, in batches so the
+    # distance matrix stays small.
+    half_norms = (centroids.astype(np.float32) ** 2).sum(axis=1) / 2
+    nearest = np.empty(len(vectors), dtype=np.int64)
+
+    for start in range(0, len(vectors), IVF_BATCH_SIZE):
+        batch = vectors[start:start + IVF_BATCH_SIZE]
+        nearest[start:start + len(batch)] = np.argmax(batch @ centroids.T - half_norms, axis=1)
+
+    return nearest
+
+def kmeans(vectors, k, iterations=IVF_KMEANS_ITERATIONS, seed=0):
+
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(len(vectors), k, replace=False)].copy()
+
+    for _ in range(iterations):
+        assignments = nearest_centroids(vectors, centroids)
+        counts = np.bincount(assignments, minlength=k)
+
+        # Sums per cluster by sorting once, not by scattered adds.
+        order = np.argsort(assignments, kind="stable")
+        filled = np.flatnonzero(counts)
+        starts = np.concatenate(([0], np.cumsum(counts[filled])[:-1]))
+        centroids[filled] = np.add.reduceat(vectors[order], starts) / counts[filled, None]
+
+        # An empty cluster restarts from a random vector.
+        empty = np.flatnonzero(counts == 0)
+
+        if len(empty) > 0:
+            centroids[empty] = vectors[rng.choice(len(vectors), len(empty), replace=False)]
+
+    return centroids
+
+def exact_scores(vectors, norms, query, rows=None):
+
+    # Cosines of the given rows of the original vectors, or of all of them,
+    # a batch at a time.
+    count = len(vectors) if rows is None else len(rows)
+    scores = np.zeros(count, dtype=np.float32)
+
+    for start in range(0, count, IVF_BATCH_SIZE):
+        batch = slice(start, min(start + IVF_BATCH_SIZE, count)) if rows is None else rows[start:start + IVF_BATCH_SIZE]
+        dots = np.asarray(vectors[batch], dtype=np.float32) @ query
+        np.divide(dots, norms[batch], out=scores[start:start + len(dots)], where=norms[batch] > 0)
+
+    return scores
+
+
+class IVFPQIndex:
+    def __init__(self, centroids, codebooks, offsets, ids, codes, norms, fingerprint=None):
+
+        # ids and codes are in list order: list i is offsets[i]:offsets[i + 1].
+        self.centroids = centroids
+        self.codebooks = codebooks
+        self.offsets = offsets
+        self.ids = ids
+        self.codes = codes
+        self.norms = norms
+        self.fingerprint = fingerprint
+
+    @classmethod
+    def build(cls, vectors, nlist=IVF_NLIST, subquantizers=IVF_SUBQUANTIZERS, train_size=IVF_TRAIN_SIZE, seed=0):
+
+        count, dimensions = vectors.shape
+
+        if dimensions % subquantizers != 0:
+            raise ValueError(f"{dimensions} dimensions cannot be split into {subquantizers} subquantizers.")
+
+        width = dimensions // subquantizers
+
+        # Centroids and codebooks are trained on a sample, so training
+        # memory does not grow with the corpus.
+        rng = np.random.default_rng(seed)
+        sample = np.sort(rng.choice(count, min(count, train_size), replace=False))
+        training = normalize_rows(vectors[sample])
+
+        centroids = kmeans(training, min(nlist, len(training)), seed=seed)
+        residuals = training - centroids[nearest_centroids(training, centroids)]
+        codebooks = np.stack([kmeans(np.ascontiguousarray(residuals[:, s * width:(s + 1) * width]), min(256, len(training)), seed=seed) for s in range(subquantizers)])
+
+        lists = np.empty(count, dtype=np.int64)
+        codes = np.empty((count, subquantizers), dtype=np.uint8)
+        norms = np.empty(count, dtype=np.float32)
+
+        # Every vector is encoded, a batch at a time.
+        for start in range(0, count, IVF_BATCH_SIZE):
+            raw = np.asarray(vectors[start:start + IVF_BATCH_SIZE], dtype=np.float32)
+            batch = normalize_rows(raw)
+            end = start + len(batch)
+
+            norms[start:end] = np.linalg.norm(raw, axis=1)
+            lists[start:end] = nearest_centroids(batch, centroids)
+            residuals = batch - centroids[lists[start:end]]
+
+            for s in range(subquantizers):
+                codes[start:end, s] = nearest_centroids(np.ascontiguousarray(residuals[:, s * width:(s + 1) * width]), codebooks[s])
+
+        order = np.argsort(lists, kind="stable")
+        offsets = np.searchsorted(lists[order], np.arange(len(centroids) + 1))
+
+        return cls(centroids, codebooks, offsets, order.astype(np.int32), codes[order], norms)
+
+    def search(self, query, k, nprobe=IVF_NPROBE, vectors=None, rerank=IVF_RERANK):
+
+        if k <= 0 or len(self.ids) == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+
+        query = normalize_vector(query)
+        subquantizers, _, width = self.codebooks.shape
+
+        coarse = self.centroids @ query
+        probes = top_indices(coarse, nprobe)
+
+        # One lookup table per query: the dot product of each query slice
+        # with each slice centroid.
+        tables = np.einsum("sjw,sw->sj", self.codebooks, query.reshape(subquantizers, width))
+
+        positions = np.concatenate([np.arange(self.offsets[probe], self.offsets[probe + 1]) for probe in probes.tolist()])
+        lists = np.repeat(probes, self.offsets[probes + 1] - self.offsets[probes])
+        approximate = coarse[lists] + tables[np.arange(subquantizers), self.codes[positions]].sum(axis=1)
+
+        if vectors is None:
+            best = top_indices(approximate, k)
+            return self.ids[positions[best]].astype(np.int64), approximate[best]
+
+        # The best candidates by code are scored again from the original
+        # rows, read in row order.
+        candidates = np.sort(self.ids[positions[top_indices(approximate, k * rerank)]].astype(np.int64))
+        scores = exact_scores(vectors, self.norms, query, candidates)
+        best = top_indices(scores, k)
+
+        return candidates[best], scores[best]
+
+    def nbytes(self):
+        return sum(array.nbytes for array in [self.centroids, self.codebooks, self.offsets, self.ids, self.codes, self.norms])
+
+    def save(self, path):
+
+        with open(path, "wb") as file:
+            np.savez(file, centroids=self.centroids, codebooks=self.codebooks, offsets=self.offsets, ids=self.ids, codes=self.codes, norms=self.norms, fingerprint=self.fingerprint)
+
+    @classmethod
+    def load(cls, path, fingerprint=None):
+
+        # None if the file was built from other vectors.
+        with np.load(path) as arrays:
+            if fingerprint is not None and not np.array_equal(arrays["fingerprint"], fingerprint):
+                return None
+
+            return cls(arrays["centroids"], arrays["codebooks"], arrays["offsets"], arrays["ids"], arrays["codes"], arrays["norms"], arrays["fingerprint"])
+
+def ivfpq_movie_scores(index, vectors, embedded_query, row_movies, limit, nprobe=IVF_NPROBE, movie_idxs=None):
+
+    query = normalize_vector(embedded_query)
+
+    # A filter is applied exactly, reading only the chunks of the movies in
+    # it.
+    if movie_idxs is not None:
+        rows = np.flatnonzero(np.isin(row_movies, np.fromiter(movie_idxs, dtype=np.int64, count=len(movie_idxs))))
+        return rows_movie_scores(rows, exact_scores(vectors, index.norms, query, rows), row_movies, limit)
+
+    k = limit * 2
+
+    # As for HNSW: more chunks than movies, more again if too many share a
+    # movie, and a plain scan once that would cover a tenth of them.
+    while True:
+        if k * 10 >= len(row_movies):
+            return rows_movie_scores(np.arange(len(row_movies)), exact_scores(vectors, index.norms, query), row_movies, limit)
+
+        rows, scores = index.search(query, k, nprobe, vectors)
+
+        if len(np.unique(row_movies[rows])) >= limit or len(rows) < k:
+            return rows_movie_scores(rows, scores, row_movies, limit)
+
+        k *= 2
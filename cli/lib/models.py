@@ -0,0 +1,103 @@
+import os, threading, time
+
+# Models loaded once per process and shared.
+#
+# Loading a transformer reads hundreds of megabytes from disk, so every
+# SentenceTransformer and CrossEncoder is taken from here by name instead of
+# being constructed where it is used. The first caller for a name loads it
+# while holding that name's lock; callers for the same name wait for it, and
+# callers for other names are not held up.
+
+
+def resident_bytes():
+
+    # Resident set size of this process, where /proc has it.
+    try:
+        with open("/proc/self/statm", "r") as file:
+            return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+def parameter_bytes(model):
+
+    module = model if hasattr(model, "parameters") else getattr(model, "model", None)
+
+    if module is None or not hasattr(module, "parameters"):
+        return None
+
+    return sum(parameter.numel() * parameter.element_size() for parameter in module.parameters())
+
+def load_model(kind, name):
+
+    # sentence_transformers is imported on first use, so importing this
+    # module does not pull in torch.
+    match kind:
+        case "sentence_transformer":
+            from sentence_transformers import SentenceTransformer
+            return SentenceTransformer(name)
+        case "cross_encoder":
+            from sentence_transformers import CrossEncoder
+            return CrossEncoder(name)
+        case _:
+            raise ValueError(f"Unknown model kind: {kind}")
+
+
+class ModelRegistry:
+    def __init__(self):
+
+        self.lock = threading.Lock()
+        self.models = {}
+        self.key_locks = {}
+        self.stats = {}
+
+    def get(self, name, kind="sentence_transformer"):
+
+        key = (kind, name)
+
+        # Already loaded: no locking at all.
+        model = self.models.get(key)
+
+        if model is not None:
+            return model
+
+        with self.lock:
+            key_lock = self.key_locks.setdefault(key, threading.Lock())
+
+        with key_lock:
+            if key in self.models:
+                return self.models[key]
+
+            before = resident_bytes()
+            start = time.perf_counter()
+
+            model = load_model(kind, name)
+
+            seconds = time.perf_counter() - start
+            after = resident_bytes()
+
+            self.stats[key] = {
+                "kind": kind,
+                "name": name,
+                "seconds": seconds,
+                "parameter_bytes": parameter_bytes(model),
+                "resident_bytes": after - before if before is not None and after is not None else None,
+            }
+            self.models[key] = model
+
+        return model
+
+    def loaded(self):
+        return [dict(stats) for stats in self.stats.values()]
+
+registry = ModelRegistry()
+
+def get_model(name, kind="sentence_transformer"):
+    return registry.get(name, kind)
+
+def print_model_stats():
+
+    for stats in registry.loaded():
+        parameters = f"{stats['parameter_bytes'] / 2 ** 20:.1f} MB parameters" if stats["parameter_bytes"] is not None else "parameters unknown"
+        resident = f"{stats['resident_bytes'] / 2 ** 20:+.1f} MB resident" if stats["resident_bytes"] is not None else "resident size unknown"
+
+        print(f"{stats['name']} ({stats['kind']}): loaded in {stats['seconds']:.2f}s, {parameters}, {resident}")
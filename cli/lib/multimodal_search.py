@@ -1,26 +1,49 @@
+import sys
 from PIL import Image
-from sentence_transformers import SentenceTransformer
-from lib.semantic_search import cosine_similarity
-import json
+from lib.vectors import cosine_similarity
+from lib.document_source import batched, load_documents
+from lib.models import get_model
+from lib.embedding_cache import embed_query
+from constants import *
+import numpy as np
 
 class MultimodalSearch:
-    def __init__(self, documents, model_name="clip-ViT-B-32"):
-        self.model = SentenceTransformer(model_name)
+    def __init__(self, documents, model_name=CLIP_MODEL):
+        self.model_name = model_name
+        self.model = get_model(model_name)
         self.documents = documents
         self.texts = []
+        embeddings = []
 
-        for doc in documents:
-            self.texts.append(f"{doc['title']}: {doc['description']}")
-        
-        self.embeddings = self.model.encode(self.texts, show_progress_bar=True)
+        # Encoded a batch at a time as the documents stream in, with one
+        # running count for the whole run rather than a bar per batch.
+        for batch in batched(documents):
+            texts = [f"{doc['title']}: {doc['description']}" for doc in batch]
+            self.texts.extend(texts)
+            embeddings.append(self.model.encode(texts, show_progress_bar=False))
+            print(f"\rEncoded {len(self.texts)} documents", end="", file=sys.stderr, flush=True)
+
+        if len(self.texts) > 0:
+            print(file=sys.stderr)
+
+        self.embeddings = np.concatenate(embeddings) if len(embeddings) > 0 else self.model.encode([])
 
     def embed_image(self, path):
         image = Image.open(path)
         embedding = self.model.encode([image])
         return embedding[0]
+    def embed_text(self, text):
+        return embed_query(self.model_name, self.model, text)
+
     def search_with_image(self, path, limit=5):
         image = Image.open(path)
         image_embedding = self.model.encode([image])
+        return self.search_with_embedding(image_embedding, limit)
+
+    def search_with_text(self, query, limit=5):
+        return self.search_with_embedding(self.embed_text(query), limit)
+
+    def search_with_embedding(self, embedding, limit=5):
         results = []
 
         for i in range(len(self.embeddings)):
@@ -28,7 +51,7 @@ class MultimodalSearch:
             dic["id"] = self.documents[i]['id']
             dic["title"] = self.documents[i]['title']
             dic["description"] = self.documents[i]['description']
-            dic["score"] = float(cosine_similarity(image_embedding, self.embeddings[i]))
+            dic["score"] = float(cosine_similarity(embedding, self.embeddings[i]))
             results.append(dic)
         
         sorted_results = sorted(
@@ -50,10 +73,16 @@ def verify_image_embedding(path):
 
 def image_search_command(path, limit=5):
 
-    data = None
-    with open("data/movies.json", "r") as f:
-        data = json.load(f)
+    documents = load_documents()
     
-    search = MultimodalSearch(data["movies"])
+    search = MultimodalSearch(documents)
+
+    return search.search_with_image(path, limit)
+
+def text_search_command(query, limit=5):
+
+    documents = load_documents()
+
+    search = MultimodalSearch(documents)
 
-    return search.search_with_image(path, limit)
\ No newline at end of file
+    return search.search_with_text(query, limit)
\ No newline at end of file
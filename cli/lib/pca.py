@@ -0,0 +1,88 @@
+import numpy as np
+from lib.vectors import normalize_rows, normalize_vector
+from lib.quantization import quantized_top, quantized_movie_scores
+from constants import *
+
+# Unit-length embedding rows projected onto their principal components.
+#
+# The projection is fit by an SVD of a sample of the rows, centred on their
+# mean, and keeps the `dimensions` directions the rows vary most along. Each
+# row is stored as its centred projection, so with C the components:
+#   q . x  =  q . mean + q . (x - mean)  ~  q . mean + (C q) . (C (x - mean))
+# A query is projected once and scanned against the small rows. Like codes,
+# the scan only picks a shortlist: its best rows are scored again exactly
+# from the float32 embeddings, mapped from disk.
+
+
+class PCAProjection:
+    def __init__(self, mean, components, codes, fingerprint=None):
+
+        self.mean = mean
+        self.components = components
+        self.codes = codes
+        self.dimensions = len(components)
+        self.fingerprint = fingerprint
+
+    @classmethod
+    def fit(cls, vectors, dimensions=PCA_DIMENSIONS, train_size=PCA_TRAIN_SIZE, seed=0):
+
+        count, width = vectors.shape
+
+        if count == 0:
+            raise ValueError("No embeddings to fit a projection to.")
+
+        if dimensions <= 0 or dimensions > width:
+            raise ValueError(f"{width} dimensions cannot be projected onto {dimensions}.")
+
+        # Fit on a sample, so fitting memory does not grow with the corpus.
+        rng = np.random.default_rng(seed)
+        sample = np.sort(rng.choice(count, min(count, train_size), replace=False))
+        training = normalize_rows(vectors[sample])
+        mean = training.mean(axis=0)
+
+        # Rows of vt are the principal directions, most variance first.
+        _, _, vt = np.linalg.svd(training - mean, full_matrices=False)
+        components = np.ascontiguousarray(vt[:dimensions], dtype=np.float32)
+        mean = mean.astype(np.float32)
+
+        codes = np.empty((count, len(components)), dtype=np.float32)
+
+        for start in range(0, count, PCA_BATCH_SIZE):
+            batch = normalize_rows(vectors[start:start + PCA_BATCH_SIZE])
+            codes[start:start + len(batch)] = (batch - mean) @ components.T
+
+        return cls(mean, components, codes)
+
+    def scores(self, query):
+
+        # Cosines, less whatever the dropped directions contribute.
+        query = normalize_vector(query)
+
+        return self.codes @ (self.components @ query) + float(self.mean @ query)
+
+    def nbytes(self):
+        return sum(array.nbytes for array in [self.mean, self.components, self.codes])
+
+    def save(self, path):
+
+        with open(path, "wb") as file:
+            np.savez(file, mean=self.mean, components=self.components, codes=self.codes, fingerprint=self.fingerprint)
+
+    @classmethod
+    def load(cls, path, fingerprint=None):
+
+        # None if the projection was fit to other vectors.
+        with np.load(path) as arrays:
+            if fingerprint is not None and not np.array_equal(arrays["fingerprint"], fingerprint):
+                return None
+
+            return cls(arrays["mean"], arrays["components"], arrays["codes"], arrays["fingerprint"])
+
+def pca_top(projection, vectors, query, limit, rerank=PCA_RERANK):
+    return quantized_top(projection, vectors, query, limit, rerank)
+
+def pca_movie_scores(projection, vectors, embedded_query, row_movies, limit, rerank=PCA_RERANK, movie_idxs=None):
+
+    # The projection stands in for codes: the best movies by it, then every
+    # chunk of those movies at full precision.
+    return quantized_movie_scores(projection, vectors, embedded_query, row_movies, limit, rerank, movie_idxs)
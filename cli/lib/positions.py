@@ -0,0 +1,185 @@
+import numpy as np
+from lib.analyzer import get_analyzer
+from lib.query_parser import Near
+from constants import *
+
+# Phrase, NEAR/k and proximity evaluation over the positional index.
+#
+# An occurrence is packed into one int64 key, row << POSITION_SHIFT |
+# position. A term's keys come out of its postings already sorted, so
+# matching positions across terms is a binary search of one sorted array for
+# the keys of another. A match is a span of keys (start, end) in one row.
+
+POSITION_SHIFT = 32
+
+POSITION_MASK = (1 << POSITION_SHIFT) - 1
+
+
+def term_occurrences(index, term):
+
+    rows, tfs = index.postings[term]
+    positions = index.positions[term]
+
+    return (np.repeat(rows, tfs) << POSITION_SHIFT) | positions.astype(np.int64)
+
+def contains(keys, values):
+
+    # Binary search of sorted values into sorted keys. Each search starts
+    # where the previous one ended, so a short list is probed into a long
+    # one in O(short * log(long)) without touching most of it.
+    if len(keys) == 0:
+        return np.zeros(len(values), dtype=bool)
+
+    found = np.minimum(np.searchsorted(keys, values), len(keys) - 1)
+
+    return keys[found] == values
+
+def empty_spans():
+    return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+def phrase_spans(index, text):
+
+    tokens, positions = get_analyzer().analyze_positions(text)
+
+    # Only stopwords, which are not indexed: no constraint at all.
+    if len(tokens) == 0:
+        return None
+
+    if any(term not in index.postings for term in tokens):
+        return empty_spans()
+
+    offsets = [position - positions[0] for position in positions]
+
+    # Anchor on the rarest term, then probe the others at their offsets.
+    order = sorted(range(len(tokens)), key=lambda i: len(index.postings[tokens[i]][0]))
+    anchor = order[0]
+
+    keys = term_occurrences(index, tokens[anchor])
+    keys = keys[(keys & POSITION_MASK) >= offsets[anchor]]
+    starts = keys - offsets[anchor]
+
+    for i in order[1:]:
+        if len(starts) == 0:
+            break
+
+        starts = starts[contains(term_occurrences(index, tokens[i]), starts + offsets[i])]
+
+    return starts, starts + offsets[-1]
+
+def near_spans(left, right, distance):
+
+    left_starts, left_ends = left
+    right_starts, right_ends = right
+
+    if len(left_starts) == 0 or len(right_starts) == 0:
+        return empty_spans()
+
+    # Right spans that can be in reach of each left span, by start.
+    length = int((right_ends - right_starts).max())
+    low = np.searchsorted(right_starts, left_starts - distance - length, side="left")
+    high = np.searchsorted(right_starts, left_ends + distance, side="right")
+    counts = high - low
+
+    if counts.sum() == 0:
+        return empty_spans()
+
+    a = np.repeat(np.arange(len(left_starts)), counts)
+    b = low[a] + np.arange(int(counts.sum())) - np.repeat(np.cumsum(counts) - counts, counts)
+
+    # Operands may not overlap, so a term is never near its own occurrence.
+    gaps = np.maximum(right_starts[b] - left_ends[a], left_starts[a] - right_ends[b])
+    keep = ((left_starts[a] >> POSITION_SHIFT) == (right_starts[b] >> POSITION_SHIFT)) & (gaps >= 1) & (gaps <= distance)
+
+    starts = np.minimum(left_starts[a], right_starts[b])[keep]
+    ends = np.maximum(left_ends[a], right_ends[b])[keep]
+
+    order = np.lexsort((ends, starts))
+    starts = starts[order]
+    ends = ends[order]
+    unique = np.ones(len(starts), dtype=bool)
+    unique[1:] = (starts[1:] != starts[:-1]) | (ends[1:] != ends[:-1])
+
+    return starts[unique], ends[unique]
+
+def clause_spans(index, clause):
+
+    if not isinstance(clause, Near):
+        return phrase_spans(index, clause.text)
+
+    left = clause_spans(index, clause.left)
+    right = clause_spans(index, clause.right)
+
+    if left is None:
+        return right
+
+    if right is None:
+        return left
+
+    return near_spans(left, right, clause.distance)
+
+def match_rows(index, clauses):
+
+    rows = None
+
+    # Rows that match every clause, or None if no clause constrains them.
+    for clause in clauses:
+        spans = clause_spans(index, clause)
+
+        if spans is None:
+            continue
+
+        clause_rows = np.unique(spans[0] >> POSITION_SHIFT)
+        rows = clause_rows if rows is None else np.intersect1d(rows, clause_rows, assume_unique=True)
+
+    return rows
+
+def proximity_boosts(index, terms):
+
+    rows_parts = []
+    boost_parts = []
+
+    # Each pair of neighbouring query terms adds the smaller of their idfs
+    # over the squared distance of their closest occurrences, if that is
+    # within PROXIMITY_WINDOW positions.
+    for first, second in zip(terms, terms[1:]):
+        if first == second or first not in index.postings or second not in index.postings:
+            continue
+
+        probe = term_occurrences(index, first)
+        target = term_occurrences(index, second)
+
+        if len(target) > len(probe):
+            probe, target = target, probe
+
+        found = np.searchsorted(target, probe)
+        after = target[np.minimum(found, len(target) - 1)]
+        before = target[np.maximum(found - 1, 0)]
+
+        probe_rows = probe >> POSITION_SHIFT
+        distances = np.full(len(probe), PROXIMITY_WINDOW + 1, dtype=np.int64)
+
+        same = (found < len(target)) & ((after >> POSITION_SHIFT) == probe_rows)
+        distances[same] = np.minimum(distances[same], (after - probe)[same])
+
+        same = (found > 0) & ((before >> POSITION_SHIFT) == probe_rows)
+        distances[same] = np.minimum(distances[same], (probe - before)[same])
+
+        near = distances <= PROXIMITY_WINDOW
+
+        if not near.any():
+            continue
+
+        rows = probe_rows[near]
+        distances = distances[near]
+        starts = np.flatnonzero(np.diff(rows, prepend=-1))
+        closest = np.minimum.reduceat(distances, starts)
+
+        rows_parts.append(rows[starts])
+        boost_parts.append(min(index.idfs[first], index.idfs[second]) / closest.astype(np.float64) ** 2)
+
+    if len(rows_parts) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0)
+
+    rows, inverse = np.unique(np.concatenate(rows_parts), return_inverse=True)
+
+    return rows, PROXIMITY_WEIGHT * np.bincount(inverse, weights=np.concatenate(boost_parts))
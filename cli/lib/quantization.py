@@ -0,0 +1,206 @@
+import os
+import numpy as np
+from lib.vectors import normalize_rows, normalize_vector, top_indices, rows_movie_scores, file_fingerprint
+from constants import *
+
+# Compact codes for unit-length embedding rows.
+#
+#   float16  two bytes per dimension.
+#   int8     one byte per dimension, each dimension scaled by its largest
+#            absolute value over all rows.
+#   binary   one bit per dimension, its sign, compared by Hamming distance.
+#
+# A query scans the codes, then scores a shortlist of the best rows again
+# from the float32 embeddings, mapped from disk, so only the shortlist is
+# ever read at full precision. float32 keeps no codes at all, not even a
+# file: the embeddings are scanned as before.
+
+if hasattr(np, "bitwise_count"):
+    popcount = np.bitwise_count
+else:
+    POPCOUNT_TABLE = np.array([bin(byte).count("1") for byte in range(256)], dtype=np.uint8)
+
+    def popcount(codes):
+        return POPCOUNT_TABLE[codes.view(np.uint8)].reshape(len(codes), -1)
+
+
+class QuantizedMatrix:
+    def __init__(self, codec, codes=None, scale=None, dimensions=0, fingerprint=None):
+
+        if codec not in EMBEDDING_CODECS:
+            raise ValueError(f"Unknown embedding codec: {codec}")
+
+        self.codec = codec
+        self.codes = codes
+        self.scale = scale
+        self.dimensions = dimensions
+        self.fingerprint = fingerprint
+
+    @classmethod
+    def encode(cls, vectors, codec):
+
+        count = len(vectors)
+        dimensions = vectors.shape[1] if vectors.ndim == 2 else 0
+
+        if codec == "float32" or count == 0 or dimensions == 0:
+            return cls(codec, dimensions=dimensions)
+
+        scale = None
+
+        # int8 needs the range of every dimension before the first row is
+        # encoded.
+        if codec == "int8":
+            scale = np.zeros(dimensions, dtype=np.float32)
+
+            for start in range(0, count, CODEC_BATCH_SIZE):
+                np.maximum(scale, np.abs(normalize_rows(vectors[start:start + CODEC_BATCH_SIZE])).max(axis=0), out=scale)
+
+            scale = np.where(scale > 0, scale / 127, 1).astype(np.float32)
+
+        match codec:
+            case "float16":
+                codes = np.empty((count, dimensions), dtype=np.float16)
+            case "int8":
+                codes = np.empty((count, dimensions), dtype=np.int8)
+            case "binary":
+                codes = np.empty((count, (dimensions + 7) // 8), dtype=np.uint8)
+
+        for start in range(0, count, CODEC_BATCH_SIZE):
+            batch = normalize_rows(vectors[start:start + CODEC_BATCH_SIZE])
+            end = start + len(batch)
+
+            match codec:
+                case "float16":
+                    codes[start:end] = batch
+                case "int8":
+                    codes[start:end] = np.rint(batch / scale)
+                case "binary":
+                    codes[start:end] = np.packbits(batch > 0, axis=1)
+
+        return cls(codec, codes, scale, dimensions)
+
+    def scores(self, query):
+
+        # Higher is better; only binary scores are not cosines.
+        if self.codes is None:
+            return np.zeros(0, dtype=np.float32)
+
+        query = normalize_vector(query)
+        scores = np.empty(len(self.codes), dtype=np.float32)
+
+        if self.codec == "binary":
+            bits = np.packbits(query > 0)
+            codes = self.codes
+
+            # Eight bytes at a time where the rows allow it.
+            if codes.shape[1] % 8 == 0 and codes.flags.c_contiguous:
+                codes = codes.view(np.uint64)
+                bits = bits.view(np.uint64)
+
+            for start in range(0, len(codes), CODEC_BATCH_SIZE):
+                batch = codes[start:start + CODEC_BATCH_SIZE]
+                scores[start:start + len(batch)] = self.dimensions - 2 * popcount(batch ^ bits).sum(axis=1, dtype=np.int32)
+
+            return scores
+
+        # Codes are widened into one small buffer a batch at a time, as BLAS
+        # has no int8 or float16 products.
+        if self.codec == "int8":
+            query = query * self.scale
+
+        buffer = np.empty((min(CODEC_BATCH_SIZE, len(self.codes)), self.codes.shape[1]), dtype=np.float32)
+
+        for start in range(0, len(self.codes), CODEC_BATCH_SIZE):
+            batch = self.codes[start:start + CODEC_BATCH_SIZE]
+            widened = buffer[:len(batch)]
+            np.copyto(widened, batch, casting="unsafe")
+            np.dot(widened, query, out=scores[start:start + len(batch)])
+
+        return scores
+
+    def nbytes(self):
+        return sum(array.nbytes for array in [self.codes, self.scale] if array is not None)
+
+    def save(self, path):
+
+        arrays = {"codec": np.array(self.codec), "dimensions": np.array(self.dimensions), "fingerprint": self.fingerprint}
+
+        if self.codes is not None:
+            arrays["codes"] = self.codes
+
+        if self.scale is not None:
+            arrays["scale"] = self.scale
+
+        with open(path, "wb") as file:
+            np.savez(file, **arrays)
+
+    @classmethod
+    def load(cls, path, fingerprint=None):
+
+        # None if the codes were made from other embeddings.
+        with np.load(path) as arrays:
+            if fingerprint is not None and not np.array_equal(arrays["fingerprint"], fingerprint):
+                return None
+
+            codes = arrays["codes"] if "codes" in arrays else None
+            scale = arrays["scale"] if "scale" in arrays else None
+
+            return cls(str(arrays["codec"]), codes, scale, int(arrays["dimensions"]), arrays["fingerprint"])
+
+def load_or_encode(vectors_path, codes_path, codec=None, fingerprint=None):
+
+    # The codec is picked when the embeddings are built and recorded next
+    # to them. Without one, the recorded codec is used, also for rebuilt
+    # embeddings; asking for another re-encodes from the float32 ones.
+    recorded = QuantizedMatrix.load(codes_path) if os.path.isfile(codes_path) else None
+
+    if codec is None:
+        codec = recorded.codec if recorded is not None else "float32"
+
+    # float32 is recorded by having no codes file.
+    if codec == "float32":
+        if recorded is not None:
+            os.remove(codes_path)
+
+        return QuantizedMatrix(codec)
+
+    if fingerprint is None:
+        fingerprint = file_fingerprint(vectors_path)
+
+    if recorded is not None and recorded.codec == codec and np.array_equal(recorded.fingerprint, fingerprint):
+        return recorded
+
+    quantized = QuantizedMatrix.encode(np.load(vectors_path, mmap_mode="r"), codec)
+    quantized.fingerprint = fingerprint
+    quantized.save(codes_path)
+
+    return quantized
+
+def rescore(vectors, rows, query):
+
+    # Cosines of the given rows at full precision, read in row order.
+    rows = np.sort(rows)
+
+    return rows, normalize_rows(vectors[rows]) @ normalize_vector(query)
+
+def quantized_top(quantized, vectors, query, limit, rerank=CODEC_RERANK):
+
+    rows, scores = rescore(vectors, top_indices(quantized.scores(query), limit * rerank), query)
+    best = top_indices(scores, limit)
+
+    return rows[best], scores[best]
+
+def quantized_movie_scores(quantized, vectors, embedded_query, row_movies, limit, rerank=CODEC_RERANK, movie_idxs=None):
+
+    scores = quantized.scores(embedded_query)
+    rows = np.arange(len(row_movies))
+
+    if movie_idxs is not None:
+        rows = np.flatnonzero(np.isin(row_movies, np.fromiter(movie_idxs, dtype=np.int64, count=len(movie_idxs))))
+
+    # The best movies by code, then every chunk of those movies at full
+    # precision.
+    movies, _ = rows_movie_scores(rows, scores[rows], row_movies, limit * rerank)
+    rows, scores = rescore(vectors, rows[np.isin(row_movies[rows], movies)], embedded_query)
+
+    return rows_movie_scores(rows, scores, row_movies, limit)
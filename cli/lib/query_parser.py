@@ -0,0 +1,232 @@
+import re
+
+# Query syntax on top of plain keywords:
+#
+#   "the dark knight"       words in this order, with the same gaps
+#   batman NEAR/3 joker     operands at most 3 positions apart, either order
+#
+# Operands of NEAR/k are words or quoted phrases, and NEAR/k chains to the
+# left. Everything else is a bare word. Every word of the query is also a
+# BM25 term, so a phrase is ranked like the keywords it contains.
+#
+# Boolean expressions, used to find or filter documents rather than rank
+# them, add AND, OR, NOT and parentheses over the same operands:
+#
+#   (batman OR superman) NOT "lego movie"
+#
+# NOT binds tightest, then NEAR/k, AND, and OR. Operands next to each other
+# are ANDed.
+
+QUERY_TOKEN = re.compile(r'"([^"]*)"|(\S+)')
+
+BOOLEAN_TOKEN = re.compile(r'"([^"]*)"|([()])|([^\s()"]+)')
+
+NEAR_OPERATOR = re.compile(r"NEAR/(\d+)")
+
+BOOLEAN_OPERATORS = {"AND": "and", "OR": "or", "NOT": "not", "(": "open", ")": "close"}
+
+
+class Term:
+    def __init__(self, text):
+        self.text = text
+
+class Phrase:
+    def __init__(self, text):
+        self.text = text
+
+class Near:
+    def __init__(self, left, right, distance):
+        self.left = left
+        self.right = right
+        self.distance = distance
+        self.text = f"{left.text} {right.text}"
+
+class And:
+    def __init__(self, children):
+        self.children = children
+
+class Or:
+    def __init__(self, children):
+        self.children = children
+
+class Not:
+    def __init__(self, child):
+        self.child = child
+
+
+def query_tokens(query):
+
+    for match in QUERY_TOKEN.finditer(query):
+        phrase, word = match.groups()
+
+        if phrase is not None:
+            yield "phrase", phrase
+        elif NEAR_OPERATOR.fullmatch(word):
+            yield "near", int(NEAR_OPERATOR.fullmatch(word).group(1))
+        else:
+            yield "word", word
+
+def parse_query(query):
+
+    tokens = list(query_tokens(query))
+    clauses = []
+    i = 0
+
+    while i < len(tokens):
+        if tokens[i][0] == "near":
+            raise ValueError(f"NEAR/{tokens[i][1]} needs a word or phrase on both sides.")
+
+        clause = operand(tokens[i])
+        i += 1
+
+        while i < len(tokens) and tokens[i][0] == "near":
+            if i + 1 >= len(tokens) or tokens[i + 1][0] == "near":
+                raise ValueError(f"NEAR/{tokens[i][1]} needs a word or phrase on both sides.")
+
+            clause = Near(clause, operand(tokens[i + 1]), tokens[i][1])
+            i += 2
+
+        clauses.append(clause)
+
+    return clauses
+
+def operand(token):
+
+    kind, text = token
+
+    if kind == "phrase":
+        return Phrase(text)
+
+    return Term(text)
+
+def is_positional(clause):
+    return isinstance(clause, (Phrase, Near))
+
+def query_text(clauses):
+    return " ".join(clause.text for clause in clauses)
+
+
+def boolean_tokens(expression):
+
+    for match in BOOLEAN_TOKEN.finditer(expression):
+        phrase, parenthesis, word = match.groups()
+
+        if phrase is not None:
+            yield "phrase", phrase
+        elif parenthesis is not None:
+            yield BOOLEAN_OPERATORS[parenthesis], parenthesis
+        elif word in BOOLEAN_OPERATORS:
+            yield BOOLEAN_OPERATORS[word], word
+        elif NEAR_OPERATOR.fullmatch(word):
+            yield "near", int(NEAR_OPERATOR.fullmatch(word).group(1))
+        else:
+            yield "word", word
+
+def has_operators(expression):
+
+    # Anything but plain words: AND, OR, NOT, parentheses, phrases or NEAR/k.
+    return any(kind != "word" for kind, _ in boolean_tokens(expression))
+
+def parse_boolean(expression):
+
+    parser = BooleanParser(list(boolean_tokens(expression)))
+
+    if parser.peek() is None:
+        raise ValueError("Empty boolean query.")
+
+    node = parser.parse_or()
+
+    if parser.peek() is not None:
+        raise ValueError(f"Unexpected '{parser.tokens[parser.position][1]}' in boolean query.")
+
+    return node
+
+
+class BooleanParser:
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.position = 0
+
+    def peek(self):
+
+        if self.position < len(self.tokens):
+            return self.tokens[self.position][0]
+
+        return None
+
+    def next(self):
+
+        token = self.tokens[self.position]
+        self.position += 1
+
+        return token
+
+    def parse_or(self):
+
+        children = [self.parse_and()]
+
+        while self.peek() == "or":
+            self.next()
+            children.append(self.parse_and())
+
+        return children[0] if len(children) == 1 else Or(children)
+
+    def parse_and(self):
+
+        children = [self.parse_not()]
+
+        while self.peek() not in [None, "or", "close"]:
+            if self.peek() == "and":
+                self.next()
+
+            children.append(self.parse_not())
+
+        return children[0] if len(children) == 1 else And(children)
+
+    def parse_not(self):
+
+        if self.peek() == "not":
+            self.next()
+            return Not(self.parse_not())
+
+        return self.parse_near()
+
+    def parse_near(self):
+
+        node = self.parse_primary()
+
+        while self.peek() == "near":
+            _, distance = self.next()
+            right = self.parse_primary()
+
+            if not isinstance(node, (Term, Phrase, Near)) or not isinstance(right, (Term, Phrase)):
+                raise ValueError(f"NEAR/{distance} needs a word or phrase on both sides.")
+
+            node = Near(node, right, distance)
+
+        return node
+
+    def parse_primary(self):
+
+        kind = self.peek()
+
+        if kind is None:
+            raise ValueError("Boolean query ends where an operand was expected.")
+
+        _, text = self.next()
+
+        match kind:
+            case "open":
+                node = self.parse_or()
+
+                if self.peek() != "close":
+                    raise ValueError("Missing ')' in boolean query.")
+
+                self.next()
+                return node
+            case "word":
+                return Term(text)
+            case "phrase":
+                return Phrase(text)
+            case _:
+                raise ValueError(f"Unexpected '{text}' in boolean query.")
@@ -0,0 +1,546 @@
+import json, mmap, os, struct
+import numpy as np
+from collections.abc import Mapping
+
+# Single-file, memory-mapped index segment.
+#
+# The file starts with a fixed header followed by a table of named sections.
+# Every section is a flat little-endian array (or byte blob) aligned to 8
+# bytes, so opening a segment only parses the header and maps the file; the
+# pages behind a section are read when a query first touches them.
+
+SEGMENT_MAGIC = b"RSEG"
+SEGMENT_VERSION = 1
+
+# magic, version, doc count, term count, total document length, section count
+HEADER = struct.Struct("<4sIQQQQ")
+# name, offset, length in bytes
+SECTION_ENTRY = struct.Struct("<16sQQ")
+
+POSITION_CHUNK_SIZE = 1 << 20
+
+SECTION_DTYPES = {
+    "doc_ids": np.int64,          # row -> doc id
+    "doc_id_order": np.int64,     # rows sorted by doc id, for id -> row lookups
+    "doc_lengths": np.uint32,     # row -> token count
+    "doc_offsets": np.uint64,     # row -> offset into doc_store (doc count + 1)
+    "doc_store": np.uint8,        # JSON encoded documents
+    "term_offsets": np.uint64,    # term -> offset into term_blob (term count + 1)
+    "term_blob": np.uint8,        # sorted UTF-8 terms
+    "term_df": np.uint32,
+    "term_idf": np.float64,
+    "term_max_score": np.float64,
+    "posting_offsets": np.uint64, # term -> offset into postings (term count + 1)
+    "postings": np.uint8,         # varint row gaps followed by varint tfs
+    "block_offsets": np.uint64,   # term -> offset into the block arrays (term count + 1)
+    "block_ids": np.int64,
+    "block_maxima": np.float64,
+    "position_offsets": np.uint64, # term -> offset into positions (term count + 1), optional
+    "positions": np.uint8,        # per posting, varint gaps between the tf positions of the term
+    "title_lengths": np.uint32,   # row -> title token count, optional
+    "title_offsets": np.uint64,   # term -> offset into title_postings (term count + 1), optional
+    "title_postings": np.uint8,   # varint (posting index gap, title tf) pairs of postings with a title tf
+    "word_offsets": np.uint64,    # word -> offset into word_blob (word count + 1), optional
+    "word_blob": np.uint8,        # sorted UTF-8 unstemmed words, for spelling correction
+    "word_df": np.uint32,
+    "suggest_offsets": np.uint64, # title key -> offset into suggest_blob (key count + 1), optional
+    "suggest_blob": np.uint8,     # sorted normalized titles and their suffixes from each word on
+    "suggest_rows": np.int64,     # title key -> row
+}
+
+
+def encode_sizes(values):
+
+    sizes = np.ones(len(values), dtype=np.int64)
+    rest = np.asarray(values, dtype=np.uint64) >> np.uint64(7)
+
+    while rest.any():
+        sizes += rest > 0
+        rest >>= np.uint64(7)
+
+    return sizes
+
+def encode_varints(values):
+
+    values = np.asarray(values, dtype=np.uint64)
+
+    if len(values) == 0:
+        return np.zeros(0, dtype=np.uint8)
+
+    sizes = encode_sizes(values)
+    starts = np.cumsum(sizes) - sizes
+    encoded = np.empty(int(sizes.sum()), dtype=np.uint8)
+    rest = values.copy()
+
+    for i in range(int(sizes.max())):
+        active = sizes > i
+        more = (sizes[active] > i + 1).astype(np.uint8) << 7
+        encoded[starts[active] + i] = (rest[active] & np.uint64(0x7F)).astype(np.uint8) | more
+        rest[active] >>= np.uint64(7)
+
+    return encoded
+
+def decode_varints(data):
+
+    data = np.asarray(data, dtype=np.uint8)
+
+    if len(data) == 0:
+        return np.zeros(0, dtype=np.int64)
+
+    ends = np.flatnonzero(data < 0x80)
+
+    if len(ends) == len(data):
+        return data.astype(np.int64)
+
+    starts = np.concatenate([[0], ends[:-1] + 1])
+    groups = np.repeat(np.arange(len(ends)), ends - starts + 1)
+    shifts = ((np.arange(len(data)) - starts[groups]) * 7).astype(np.uint64)
+    values = np.add.reduceat((data & 0x7F).astype(np.uint64) << shifts, starts)
+
+    return values.astype(np.int64)
+
+def align(offset):
+    return (offset + 7) & ~7
+
+
+def write_segment(path, index):
+
+    doc_ids = np.asarray(index.doc_ids, dtype=np.int64)
+    lengths = np.asarray(index.lengths, dtype=np.uint32)
+
+    # Documents spilled to disk during a build are copied over already
+    # encoded, without holding them all in memory.
+    if hasattr(index.docmap, "iter_encoded"):
+        sizes = index.docmap.encoded_sizes()
+        documents = (int(np.sum(sizes, dtype=np.uint64)), index.docmap.iter_encoded())
+    else:
+        encoded = [json.dumps(doc).encode("utf-8") for doc in index.docmap.values()]
+        sizes = [len(doc) for doc in encoded]
+        documents = b"".join(encoded)
+
+    doc_offsets = np.zeros(len(sizes) + 1, dtype=np.uint64)
+    doc_offsets[1:] = np.cumsum(sizes)
+
+    terms = sorted(index.postings)
+    encoded_terms = [term.encode("utf-8") for term in terms]
+    term_offsets = np.zeros(len(terms) + 1, dtype=np.uint64)
+    term_offsets[1:] = np.cumsum([len(term) for term in encoded_terms])
+
+    dfs = np.zeros(len(terms), dtype=np.uint32)
+    idfs = np.zeros(len(terms))
+    max_scores = np.zeros(len(terms))
+    block_offsets = np.zeros(len(terms) + 1, dtype=np.uint64)
+    values = []
+    block_ids = []
+    block_maxima = []
+
+    for i, term in enumerate(terms):
+        rows, tfs = index.postings[term]
+        blocks, maxima = index.block_maxima[term]
+
+        dfs[i] = len(rows)
+        idfs[i] = index.idfs[term]
+        max_scores[i] = index.max_scores[term]
+        block_offsets[i + 1] = block_offsets[i] + len(blocks)
+
+        values.append(np.diff(rows, prepend=0))
+        values.append(tfs)
+        block_ids.append(blocks)
+        block_maxima.append(maxima)
+
+    # Encode every postings list in one pass, then find where each term's
+    # bytes end: after its 2 * df values.
+    values = np.concatenate(values) if len(values) > 0 else np.zeros(0, dtype=np.int64)
+    postings = encode_varints(values)
+    value_ends = np.cumsum(encode_sizes(values))
+    posting_offsets = np.zeros(len(terms) + 1, dtype=np.uint64)
+
+    if len(terms) > 0:
+        posting_offsets[1:] = value_ends[np.cumsum(dfs.astype(np.int64) * 2) - 1]
+
+    sections = {
+        "doc_ids": doc_ids,
+        "doc_id_order": np.argsort(doc_ids, kind="stable").astype(np.int64),
+        "doc_lengths": lengths,
+        "doc_offsets": doc_offsets,
+        "doc_store": documents,
+        "term_offsets": term_offsets,
+        "term_blob": b"".join(encoded_terms),
+        "term_df": dfs,
+        "term_idf": idfs,
+        "term_max_score": max_scores,
+        "posting_offsets": posting_offsets,
+        "postings": postings,
+        "block_offsets": block_offsets,
+        "block_ids": np.concatenate(block_ids).astype(np.int64) if len(block_ids) > 0 else np.zeros(0, dtype=np.int64),
+        "block_maxima": np.concatenate(block_maxima) if len(block_maxima) > 0 else np.zeros(0),
+    }
+
+    if index.positions is not None:
+        sections["position_offsets"], sections["positions"] = encode_positions(index, terms)
+
+    if index.title_tfs is not None:
+        sections["title_lengths"] = np.asarray(index.title_lengths, dtype=np.uint32)
+        sections["title_offsets"], sections["title_postings"] = encode_title_tfs(index, terms)
+
+    if index.word_dfs is not None:
+        encoded_words = [word.encode("utf-8") for word in sorted(index.word_dfs)]
+        word_offsets = np.zeros(len(encoded_words) + 1, dtype=np.uint64)
+        word_offsets[1:] = np.cumsum([len(word) for word in encoded_words])
+
+        sections["word_offsets"] = word_offsets
+        sections["word_blob"] = b"".join(encoded_words)
+        sections["word_df"] = np.array([index.word_dfs[word] for word in sorted(index.word_dfs)], dtype=np.uint32)
+
+    if index.title_keys is not None:
+        encoded_keys = [key.encode("utf-8") for key, _ in index.title_keys]
+        suggest_offsets = np.zeros(len(encoded_keys) + 1, dtype=np.uint64)
+        suggest_offsets[1:] = np.cumsum([len(key) for key in encoded_keys])
+
+        sections["suggest_offsets"] = suggest_offsets
+        sections["suggest_blob"] = b"".join(encoded_keys)
+        sections["suggest_rows"] = np.array([row for _, row in index.title_keys], dtype=np.int64)
+
+    write_sections(path, sections, len(doc_ids), len(terms), int(lengths.sum(dtype=np.uint64)))
+
+def encode_positions(index, terms):
+
+    position_offsets = np.zeros(len(terms) + 1, dtype=np.uint64)
+    encoded = []
+    gaps = []
+    pending = 0
+    first = 0
+
+    # Positions outnumber postings, so they are encoded in chunks of about
+    # POSITION_CHUNK_SIZE values rather than in one pass.
+    for i, term in enumerate(terms):
+        _, tfs = index.postings[term]
+        positions = np.asarray(index.positions[term], dtype=np.int64)
+
+        # Each posting starts again from position 0.
+        term_gaps = np.diff(positions, prepend=0)
+        starts = np.cumsum(tfs) - tfs
+        term_gaps[starts] = positions[starts]
+
+        gaps.append(term_gaps)
+        pending += len(term_gaps)
+
+        if pending >= POSITION_CHUNK_SIZE or i == len(terms) - 1:
+            values = np.concatenate(gaps)
+            value_ends = np.cumsum(encode_sizes(values))
+            term_ends = np.cumsum([len(term_gaps) for term_gaps in gaps]) - 1
+
+            position_offsets[first + 1:i + 2] = position_offsets[first] + value_ends[term_ends]
+            encoded.append(encode_varints(values))
+
+            gaps = []
+            pending = 0
+            first = i + 1
+
+    return position_offsets, np.concatenate(encoded) if len(encoded) > 0 else np.zeros(0, dtype=np.uint8)
+
+def encode_title_tfs(index, terms):
+
+    values = []
+    counts = np.zeros(len(terms), dtype=np.int64)
+
+    # Most postings have no title occurrence, so only the others are
+    # stored, as pairs of a gap between their indices in the postings list
+    # and their title tf.
+    for i, term in enumerate(terms):
+        title_tfs = np.asarray(index.title_tfs[term], dtype=np.int64)
+        found = np.flatnonzero(title_tfs)
+        pairs = np.empty(2 * len(found), dtype=np.int64)
+        pairs[0::2] = np.diff(found, prepend=0)
+        pairs[1::2] = title_tfs[found]
+
+        values.append(pairs)
+        counts[i] = len(found)
+
+    values = np.concatenate(values) if len(values) > 0 else np.zeros(0, dtype=np.int64)
+    value_ends = np.concatenate([[0], np.cumsum(encode_sizes(values))])
+    title_offsets = value_ends[np.concatenate([[0], np.cumsum(2 * counts)])].astype(np.uint64)
+
+    return title_offsets, encode_varints(values)
+
+def write_sections(path, sections, doc_count, term_count, total_length):
+
+    # A section is an array, bytes, or a (length, chunks) pair streamed
+    # into the file.
+    data = {}
+
+    for name, section in sections.items():
+        if isinstance(section, np.ndarray):
+            section = np.ascontiguousarray(section, dtype=SECTION_DTYPES.get(name, section.dtype)).tobytes()
+        data[name] = section
+
+    offset = align(HEADER.size + SECTION_ENTRY.size * len(data))
+    entries = []
+
+    for name, section in data.items():
+        length = section[0] if isinstance(section, tuple) else len(section)
+        entries.append((name, offset, length))
+        offset = align(offset + length)
+
+    # Write next to the target and swap it in, so a reader never maps a
+    # half-written segment.
+    temp_path = f"{path}.tmp"
+
+    with open(temp_path, "wb") as file:
+        file.write(HEADER.pack(SEGMENT_MAGIC, SEGMENT_VERSION, doc_count, term_count, total_length, len(entries)))
+
+        for name, section_offset, length in entries:
+            file.write(SECTION_ENTRY.pack(name.encode("ascii"), section_offset, length))
+
+        for name, section_offset, length in entries:
+            file.write(b"\0" * (section_offset - file.tell()))
+
+            if isinstance(data[name], tuple):
+                for chunk in data[name][1]:
+                    file.write(chunk)
+            else:
+                file.write(data[name])
+
+    os.replace(temp_path, path)
+
+
+class Segment:
+    def __init__(self, path):
+
+        self.path = path
+
+        with open(path, "rb") as file:
+            self.buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if len(self.buffer) < HEADER.size:
+            raise Exception(f"Index segment {path} is truncated.")
+
+        magic, version, doc_count, term_count, total_length, section_count = HEADER.unpack_from(self.buffer, 0)
+
+        if magic != SEGMENT_MAGIC:
+            raise Exception(f"{path} is not an index segment.")
+
+        if version != SEGMENT_VERSION:
+            raise Exception(f"Unsupported index segment version {version} in {path}, rebuild the index.")
+
+        self.doc_count = doc_count
+        self.term_count = term_count
+        self.total_length = total_length
+        self.sections = {}
+
+        for i in range(section_count):
+            name, offset, length = SECTION_ENTRY.unpack_from(self.buffer, HEADER.size + i * SECTION_ENTRY.size)
+            self.sections[name.rstrip(b"\0").decode("ascii")] = (offset, length)
+
+        self.doc_ids = self.array("doc_ids")
+        self.doc_id_order = self.array("doc_id_order")
+        self.doc_lengths = self.array("doc_lengths")
+        self.doc_offsets = self.array("doc_offsets")
+        self.term_offsets = self.array("term_offsets")
+        self.term_df = self.array("term_df")
+        self.term_idf = self.array("term_idf")
+        self.term_max_score = self.array("term_max_score")
+        self.posting_offsets = self.array("posting_offsets")
+        self.block_offsets = self.array("block_offsets")
+        self.block_ids = self.array("block_ids")
+        self.block_maxima = self.array("block_maxima")
+
+        # Positions are only written for indexes built with them.
+        self.has_positions = self.has_section("positions")
+
+        if self.has_positions:
+            self.position_offsets = self.array("position_offsets")
+
+        # And title statistics for BM25F only for indexes built since.
+        self.has_fields = self.has_section("title_postings")
+
+        if self.has_fields:
+            self.title_lengths = self.array("title_lengths")
+            self.title_offsets = self.array("title_offsets")
+
+        # And the unstemmed words of the documents.
+        self.has_words = self.has_section("word_blob")
+
+        if self.has_words:
+            self.word_offsets = self.array("word_offsets")
+            self.word_df = self.array("word_df")
+
+        # And the title keys for completion.
+        self.has_suggestions = self.has_section("suggest_blob")
+
+        if self.has_suggestions:
+            self.suggest_offsets = self.array("suggest_offsets")
+            self.suggest_rows = self.array("suggest_rows")
+
+    def has_section(self, name):
+        return name in self.sections
+
+    def array(self, name):
+        offset, length = self.sections[name]
+        dtype = np.dtype(SECTION_DTYPES.get(name, np.uint8))
+
+        if length == 0:
+            return np.zeros(0, dtype=dtype)
+
+        return np.frombuffer(self.buffer, dtype=dtype, count=length // dtype.itemsize, offset=offset)
+
+    def bytes(self, name, start, end):
+        offset, _ = self.sections[name]
+        return self.buffer[offset + start:offset + end]
+
+    def term(self, i):
+        return self.bytes("term_blob", int(self.term_offsets[i]), int(self.term_offsets[i + 1])).decode("utf-8")
+
+    def terms(self):
+        for i in range(self.term_count):
+            yield self.term(i)
+
+    def word(self, i):
+        return self.bytes("word_blob", int(self.word_offsets[i]), int(self.word_offsets[i + 1])).decode("utf-8")
+
+    def words(self):
+        for i in range(len(self.word_offsets) - 1):
+            yield self.word(i)
+
+    def suggestion(self, i):
+        return self.bytes("suggest_blob", int(self.suggest_offsets[i]), int(self.suggest_offsets[i + 1])).decode("utf-8")
+
+    def find_term(self, term):
+
+        key = term.encode("utf-8")
+        low = 0
+        high = self.term_count
+
+        while low < high:
+            middle = (low + high) // 2
+            current = self.bytes("term_blob", int(self.term_offsets[middle]), int(self.term_offsets[middle + 1]))
+
+            if current < key:
+                low = middle + 1
+            elif current > key:
+                high = middle
+            else:
+                return middle
+
+        return -1
+
+    def postings(self, i):
+        values = decode_varints(np.frombuffer(
+            self.bytes("postings", int(self.posting_offsets[i]), int(self.posting_offsets[i + 1])),
+            dtype=np.uint8))
+
+        df = int(self.term_df[i])
+
+        return np.cumsum(values[:df]), values[df:]
+
+    def positions(self, i):
+        gaps = decode_varints(np.frombuffer(
+            self.bytes("positions", int(self.position_offsets[i]), int(self.position_offsets[i + 1])),
+            dtype=np.uint8))
+
+        _, tfs = self.postings(i)
+        starts = np.cumsum(tfs) - tfs
+        totals = np.cumsum(gaps)
+
+        # Undo the gaps within each posting only.
+        return (totals - np.repeat(totals[starts] - gaps[starts], tfs)).astype(np.uint32)
+
+    def title_tfs(self, i):
+        values = decode_varints(np.frombuffer(
+            self.bytes("title_postings", int(self.title_offsets[i]), int(self.title_offsets[i + 1])),
+            dtype=np.uint8))
+
+        title_tfs = np.zeros(int(self.term_df[i]), dtype=np.int64)
+        title_tfs[np.cumsum(values[0::2])] = values[1::2]
+
+        return title_tfs
+
+    def blocks(self, i):
+        start = int(self.block_offsets[i])
+        end = int(self.block_offsets[i + 1])
+
+        return self.block_ids[start:end], self.block_maxima[start:end]
+
+    def document(self, row):
+        return json.loads(self.bytes("doc_store", int(self.doc_offsets[row]), int(self.doc_offsets[row + 1])))
+
+    def find_row(self, doc_id):
+        position = np.searchsorted(self.doc_ids, doc_id, sorter=self.doc_id_order)
+
+        if position < self.doc_count:
+            row = int(self.doc_id_order[position])
+            if self.doc_ids[row] == doc_id:
+                return row
+
+        return -1
+
+
+# Read-only dict-like views, so InvertedIndex can use a segment in place of
+# the dicts it builds in memory.
+
+class TermView(Mapping):
+    def __init__(self, segment, lookup):
+        self.segment = segment
+        self.lookup = lookup
+
+    def __getitem__(self, term):
+        i = self.segment.find_term(term)
+
+        if i < 0:
+            raise KeyError(term)
+
+        return self.lookup(i)
+
+    def __contains__(self, term):
+        return self.segment.find_term(term) >= 0
+
+    def __iter__(self):
+        return self.segment.terms()
+
+    def __len__(self):
+        return self.segment.term_count
+
+class DocumentView(Mapping):
+    def __init__(self, segment):
+        self.segment = segment
+
+    def __getitem__(self, doc_id):
+        row = self.segment.find_row(doc_id)
+
+        if row < 0:
+            raise KeyError(doc_id)
+
+        return self.segment.document(row)
+
+    def __contains__(self, doc_id):
+        return self.segment.find_row(doc_id) >= 0
+
+    def __iter__(self):
+        for doc_id in self.segment.doc_ids:
+            yield int(doc_id)
+
+    def __len__(self):
+        return self.segment.doc_count
+
+    def values(self):
+        for row in range(self.segment.doc_count):
+            yield self.segment.document(row)
+
+class RowView(Mapping):
+    def __init__(self, segment):
+        self.segment = segment
+
+    def __getitem__(self, doc_id):
+        row = self.segment.find_row(doc_id)
+
+        if row < 0:
+            raise KeyError(doc_id)
+
+        return row
+
+    def __iter__(self):
+        for doc_id in self.segment.doc_ids:
+            yield int(doc_id)
+
+    def __len__(self):
+        return self.segment.doc_count
@@ -0,0 +1,308 @@
+import fcntl, heapq, json, os
+import numpy as np
+from collections.abc import Mapping
+from contextlib import contextmanager
+from functools import lru_cache
+from lib.segment import Segment
+from lib.analyzer import get_analyzer
+from lib.index_build import document_fields
+from constants import *
+
+# An index made of several segments. The manifest lists the segments in row
+# order, and for each one the ids of documents deleted from it since it was
+# written (tombstones). Live documents of all segments share one row space,
+# so InvertedIndex scores them exactly as it scores a single segment.
+#
+# Statistics stored inside a segment only describe that segment. With more
+# than one segment, or any tombstone, N, df and avgdl are recomputed here
+# over the live documents.
+
+MANIFEST_VERSION = 1
+
+
+def segment_path(name):
+    return os.path.join(os.path.dirname(INDEX_MANIFEST_PATH), name)
+
+@contextmanager
+def manifest_lock():
+
+    # Serializes manifest changes between the merge thread, other writers
+    # and readers opening segments that a merge is about to remove.
+    with open(f"{INDEX_MANIFEST_PATH}.lock", "w") as file:
+        fcntl.flock(file, fcntl.LOCK_EX)
+
+        try:
+            yield
+        finally:
+            fcntl.flock(file, fcntl.LOCK_UN)
+
+@contextmanager
+def merge_lock():
+
+    # Held for a whole merge. Yields False instead of waiting when another
+    # merge is running.
+    with open(f"{INDEX_MANIFEST_PATH}.merge.lock", "w") as file:
+        try:
+            fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+
+        try:
+            yield True
+        finally:
+            fcntl.flock(file, fcntl.LOCK_UN)
+
+def read_manifest():
+
+    if os.path.isfile(INDEX_MANIFEST_PATH):
+        with open(INDEX_MANIFEST_PATH, "r") as file:
+            return json.load(file)
+
+    # A cache written before the manifest existed holds one base segment.
+    if os.path.isfile(INDEX_SEGMENT_PATH):
+        return new_manifest(os.path.basename(INDEX_SEGMENT_PATH), Segment(INDEX_SEGMENT_PATH).doc_count)
+
+    return None
+
+def new_manifest(name, doc_count, generation=0, next_segment=1):
+    return {
+        "version": MANIFEST_VERSION,
+        "generation": generation,
+        "next_segment": next_segment,
+        "segments": [{"name": name, "doc_count": doc_count, "deleted": []}],
+    }
+
+def write_manifest(manifest):
+
+    manifest["generation"] += 1
+    temp_path = f"{INDEX_MANIFEST_PATH}.tmp"
+
+    with open(temp_path, "w") as file:
+        json.dump(manifest, file)
+
+    os.replace(temp_path, INDEX_MANIFEST_PATH)
+
+def reserve_segment_name(manifest):
+
+    name = f"segment_{manifest['next_segment']:06d}.seg"
+    manifest["next_segment"] += 1
+
+    return name
+
+def select_merge(manifest, force=False):
+
+    entries = manifest["segments"]
+    live = [entry["doc_count"] - len(entry["deleted"]) for entry in entries]
+    total = sum(entry["doc_count"] for entry in entries)
+    deleted = sum(len(entry["deleted"]) for entry in entries)
+
+    if force or (total > 0 and deleted / total > SEGMENT_DELETE_RATIO):
+        return (0, len(entries)) if len(entries) > 1 or deleted > 0 else None
+
+    if len(entries) <= SEGMENT_MERGE_LIMIT:
+        return None
+
+    # Merge the adjacent run of segments with the fewest live documents, so
+    # large segments are rarely rewritten. Runs must be adjacent to keep the
+    # row order, which decides how ties rank.
+    width = min(SEGMENT_MERGE_FACTOR, len(entries))
+    sizes = [sum(live[start:start + width]) for start in range(len(entries) - width + 1)]
+    start = sizes.index(min(sizes))
+
+    return start, start + width
+
+
+class SegmentSet:
+    def __init__(self, entries):
+
+        self.entries = entries
+        self.segments = []
+        self.remaps = []
+
+        doc_ids = []
+        lengths = []
+        sources = []
+        source_rows = []
+        offset = 0
+
+        for k, entry in enumerate(entries):
+            segment = Segment(segment_path(entry["name"]))
+            live_rows = np.arange(segment.doc_count)
+
+            if len(entry["deleted"]) > 0:
+                live_rows = np.flatnonzero(~np.isin(segment.doc_ids, np.array(entry["deleted"], dtype=np.int64)))
+
+            remap = np.full(segment.doc_count, -1, dtype=np.int64)
+            remap[live_rows] = np.arange(offset, offset + len(live_rows))
+            offset += len(live_rows)
+
+            self.segments.append(segment)
+            self.remaps.append(remap)
+
+            doc_ids.append(segment.doc_ids[live_rows])
+            lengths.append(segment.doc_lengths[live_rows].astype(np.int64))
+            sources.append(np.full(len(live_rows), k, dtype=np.int64))
+            source_rows.append(live_rows)
+
+        self.doc_ids = np.concatenate(doc_ids) if len(entries) > 0 else np.zeros(0, dtype=np.int64)
+        self.lengths = np.concatenate(lengths) if len(entries) > 0 else np.zeros(0, dtype=np.int64)
+        self.sources = np.concatenate(sources) if len(entries) > 0 else np.zeros(0, dtype=np.int64)
+        self.source_rows = np.concatenate(source_rows) if len(entries) > 0 else np.zeros(0, dtype=np.int64)
+
+        self.doc_count = len(self.doc_ids)
+        self.total_length = int(self.lengths.sum())
+
+        self.postings = lru_cache(maxsize=TERM_CACHE_SIZE)(self.live_postings)
+
+        # Positions are usable only if every segment was written with them.
+        self.has_positions = len(self.segments) > 0 and all(segment.has_positions for segment in self.segments)
+        self.positions = lru_cache(maxsize=TERM_CACHE_SIZE)(self.live_positions)
+
+        # Likewise title statistics for BM25F.
+        self.has_fields = len(self.segments) > 0 and all(segment.has_fields for segment in self.segments)
+        self.title_tfs = lru_cache(maxsize=TERM_CACHE_SIZE)(self.live_title_tfs)
+
+        self.has_words = len(self.segments) > 0 and all(segment.has_words for segment in self.segments)
+        self.has_suggestions = len(self.segments) > 0 and all(segment.has_suggestions for segment in self.segments)
+
+        if self.has_fields:
+            self.title_lengths = np.concatenate([segment.title_lengths[self.source_rows[self.sources == k]].astype(np.int64) for k, segment in enumerate(self.segments)])
+
+    def live_postings(self, term):
+
+        rows_parts = []
+        tfs_parts = []
+
+        # Segments are in row order, so the remapped rows stay sorted.
+        for segment, remap in zip(self.segments, self.remaps):
+            i = segment.find_term(term)
+
+            if i < 0:
+                continue
+
+            rows, tfs = segment.postings(i)
+            rows = remap[rows]
+            keep = rows >= 0
+
+            rows_parts.append(rows[keep])
+            tfs_parts.append(tfs[keep])
+
+        if len(rows_parts) == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+        return np.concatenate(rows_parts), np.concatenate(tfs_parts)
+
+    def word_dfs(self):
+
+        word_dfs = {}
+
+        # Summed over segments, less the words of their deleted documents,
+        # which are few enough to analyze again.
+        for segment, remap in zip(self.segments, self.remaps):
+            for word, df in zip(segment.words(), segment.word_df.tolist()):
+                word_dfs[word] = word_dfs.get(word, 0) + df
+
+            deleted = [segment.document(int(row)) for row in np.flatnonzero(remap < 0)]
+
+            for _, _, _, words in get_analyzer().analyze_fields(document_fields(deleted)):
+                for word in set(words):
+                    word_dfs[word] -= 1
+
+        return {word: df for word, df in sorted(word_dfs.items()) if df > 0}
+
+    def live_title_tfs(self, term):
+
+        parts = []
+
+        for segment, remap in zip(self.segments, self.remaps):
+            i = segment.find_term(term)
+
+            if i < 0:
+                continue
+
+            rows, _ = segment.postings(i)
+            parts.append(segment.title_tfs(i)[remap[rows] >= 0])
+
+        if len(parts) == 0:
+            return np.zeros(0, dtype=np.int64)
+
+        return np.concatenate(parts)
+
+    def live_positions(self, term):
+
+        parts = []
+
+        for segment, remap in zip(self.segments, self.remaps):
+            i = segment.find_term(term)
+
+            if i < 0:
+                continue
+
+            rows, tfs = segment.postings(i)
+            keep = remap[rows] >= 0
+
+            parts.append(segment.positions(i)[np.repeat(keep, tfs)])
+
+        if len(parts) == 0:
+            return np.zeros(0, dtype=np.uint32)
+
+        return np.concatenate(parts)
+
+    def terms(self):
+
+        streams = [segment.terms() for segment in self.segments]
+        previous = None
+
+        for term in heapq.merge(*streams):
+            if term != previous:
+                yield term
+                previous = term
+
+    def document(self, row):
+        return self.segments[self.sources[row]].document(int(self.source_rows[row]))
+
+    def find_row(self, doc_id):
+
+        for segment, remap in zip(self.segments, self.remaps):
+            row = segment.find_row(doc_id)
+
+            if row >= 0 and remap[row] >= 0:
+                return int(remap[row])
+
+        return -1
+
+    def find_segment(self, doc_id):
+
+        for k, (segment, remap) in enumerate(zip(self.segments, self.remaps)):
+            row = segment.find_row(doc_id)
+
+            if row >= 0 and remap[row] >= 0:
+                return k
+
+        return -1
+
+
+class LiveTermView(Mapping):
+    def __init__(self, segments, lookup):
+        self.segments = segments
+        self.lookup = lookup
+
+    def __getitem__(self, term):
+
+        if term not in self:
+            raise KeyError(term)
+
+        return self.lookup(term)
+
+    def __contains__(self, term):
+        # A term whose documents were all deleted is no longer in the index.
+        return len(self.segments.postings(term)[0]) > 0
+
+    def __iter__(self):
+        for term in self.segments.terms():
+            if term in self:
+                yield term
+
+    def __len__(self):
+        return sum(1 for _ in self)
@@ -1,79 +1,132 @@
-from sentence_transformers import SentenceTransformer
 from constants import *
+from lib.document_source import document_map, load_documents
+from lib.models import get_model, print_model_stats
+from lib.embedding_cache import embed_query, embed_queries
+from lib.embedding_manifest import refresh_embeddings
+from lib.chunk_metadata import ChunkMetadata, load_chunk_metadata
+from lib.encoding import embedding_dimensions, open_output, encode_rows
+from lib.hnsw import HNSWIndex, hnsw_movie_scores
+from lib.ivfpq import IVFPQIndex, ivfpq_movie_scores
+from lib.pca import PCAProjection, pca_movie_scores
+from lib.quantization import load_or_encode, quantized_top, quantized_movie_scores
+from lib.vectors import normalize_rows, cosine_top, cosine_top_batch, group_chunks, chunk_movie_scores, chunk_movie_scores_batch, file_fingerprint
 import numpy as np
-import os, json, re
+import os, re
 
 class SemanticSearch:
-    def __init__(self):
+    def __init__(self, model_name=EMBEDDING_MODEL, codec=None):
 
-        self.model = SentenceTransformer('all-MiniLM-L6-v2')
+        # Shared with every other instance using the same model.
+        self.model_name = model_name
+        self.model = get_model(model_name)
         self.embeddings = None
+
+        if codec is not None and codec not in EMBEDDING_CODECS:
+            raise ValueError(f"Unknown embedding codec: {codec}")
+
+        # The codec to store embeddings with, or None for the one recorded
+        # with them, and their codes.
+        self.codec = codec
+        self.codes = None
+
+        # The embeddings scaled to unit length, for scoring, when they are
+        # not scanned as codes.
+        self.matrix = None
         self.documents = None
         self.document_map = {}
 
+        # Documents reused and encoded by the last build.
+        self.refresh_stats = None
+
     def generate_embedding(self, text):
         if len(text.strip()) == 0:
             raise ValueError("Text contains only whitespace.")
-        
-        embedding = self.model.encode([text])
 
-        return embedding[0]
-    
-    def build_embeddings(self, documents):
+        # Repeated texts come from the query embedding cache.
+        return embed_query(self.model_name, self.model, text)
 
-        self.documents = documents
+    def generate_embeddings(self, texts):
 
-        doc_strings = []
+        for text in texts:
+            if len(text.strip()) == 0:
+                raise ValueError("Text contains only whitespace.")
 
-        for doc in documents:
-            self.document_map[doc["id"]] = doc
-            doc_strings.append(f"{doc['title']}: {doc['description']}")
+        # Texts the cache does not have are encoded one at a time, not in
+        # one call: padding a batch to its longest text moves every vector
+        # slightly, and batch results must match single searches bit for
+        # bit. Only the scoring is batched.
+        return embed_queries(self.model_name, self.model, texts)
+    
+    def build_embeddings(self, documents, reuse=False, workers=ENCODE_WORKERS):
 
-        self.embeddings = self.model.encode(doc_strings, show_progress_bar=True)
+        self.documents = documents
+        self.document_map = document_map(documents)
 
-        with open("cache/movie_embeddings.npy", "wb") as file:
-            np.save(file, self.embeddings)
+        # Encoded a batch at a time, straight into a mapped file. With reuse,
+        # only documents whose text the manifest has no vector for are.
+        self.embeddings, self.refresh_stats = refresh_embeddings(self.model_name, self.model, documents, document_text, "cache/movie_embeddings.npy", reuse, workers)
+
+        self.load_codes()
         
         return self.embeddings
     
-    def load_or_create_embeddings(self, documents):
-        self.documents = documents
+    def load_or_create_embeddings(self, documents, workers=ENCODE_WORKERS):
 
-        for doc in documents:
-            self.document_map[doc["id"]] = doc
-        
-        if os.path.isfile("cache/movie_embeddings.npy"):
-            with open("cache/movie_embeddings.npy", "rb") as file:
-                self.embeddings = np.load(file)
-
-                if len(self.embeddings) == len(documents):
-                    return self.embeddings
-                
-        return self.build_embeddings(documents)
+        # Checked document by document against the manifest, so edited
+        # documents are re-encoded even when the count has not changed.
+        return self.build_embeddings(documents, reuse=True, workers=workers)
+
+    def load_codes(self):
+
+        # Either compact codes, with the float32 rows mapped for rescoring,
+        # or the float32 rows normalized in memory.
+        self.codes = load_or_encode("cache/movie_embeddings.npy", MOVIE_CODES_PATH, self.codec)
+
+        if self.codes.codec == "float32":
+            self.matrix = normalize_rows(self.embeddings)
+        else:
+            self.embeddings = np.load("cache/movie_embeddings.npy", mmap_mode="r")
+            self.matrix = None
     
     def search(self, query, limit):
         if self.embeddings is None:
             raise ValueError("No embeddings loaded. Call `load_or_create_embeddings` first.")
         
-        query_embedding = embed_query_text(query)
+        query_embedding = self.generate_embedding(query)
 
-        similarity_scores = []
+        if self.matrix is None:
+            indices, scores = quantized_top(self.codes, self.embeddings, query_embedding, limit)
+        else:
+            indices, scores = cosine_top(self.matrix, query_embedding, limit)
 
-        for i in range(len(self.embeddings)):
-            similarity_scores.append((cosine_similarity(query_embedding, self.embeddings[i]), self.documents[i]))
-        
-        similarity_scores.sort(key = lambda x: x[0], reverse=True)
+        return self.document_results(indices, scores)
+
+    def search_batch(self, queries, limit):
+        if self.embeddings is None:
+            raise ValueError("No embeddings loaded. Call `load_or_create_embeddings` first.")
+
+        # Queries are encoded one by one, as search would encode them, so
+        # the results are the same; the scan is what is batched.
+        query_embeddings = self.generate_embeddings(queries)
+
+        # Codes are scanned one query at a time; only float32 rows are
+        # scored as a matrix product.
+        if self.matrix is None:
+            top = [quantized_top(self.codes, self.embeddings, query_embedding, limit) for query_embedding in query_embeddings]
+        else:
+            top = cosine_top_batch(self.matrix, query_embeddings, limit)
+
+        return [self.document_results(indices, scores) for indices, scores in top]
+
+    def document_results(self, indices, scores):
 
         results = []
 
-        for i in range(limit):
-            if i > len(similarity_scores):
-                break
-            
+        for i, score in zip(indices.tolist(), scores):
             dic = {}
-            dic["score"] = similarity_scores[i][0]
-            dic["title"] = similarity_scores[i][1]["title"]
-            dic["description"] = similarity_scores[i][1]["description"]
+            dic["score"] = score
+            dic["title"] = self.documents[i]["title"]
+            dic["description"] = self.documents[i]["description"]
 
             results.append(dic)
         
@@ -82,12 +135,16 @@ class SemanticSearch:
 
 
 
+def document_text(doc):
+    return f"{doc['title']}: {doc['description']}"
+
 def verify_model():
 
     model = SemanticSearch()
 
     print(f"Model loaded: {model.model}")
     print(f"Max sequence length: {model.model.max_seq_length}")
+    print_model_stats()
 
 def embed_text(text):
 
@@ -99,19 +156,18 @@ def embed_text(text):
     print(f"First 3 dimensions: {embedding[:3]}")
     print(f"Dimensions: {embedding.shape[0]}")
 
-def verify_embeddings():
+def verify_embeddings(codec=None, workers=ENCODE_WORKERS):
 
-    model = SemanticSearch()
+    model = SemanticSearch(codec=codec)
 
-    data = None
-
-    with open("data/movies.json", "r") as file:
-        data = json.load(file)
+    documents = load_documents()
     
-    embeddings = model.load_or_create_embeddings(data["movies"])
+    embeddings = model.load_or_create_embeddings(documents, workers)
 
-    print(f"Number of docs:   {len(data)}")
+    print(f"Number of docs:   {len(documents)}")
     print(f"Embeddings shape: {embeddings.shape[0]} vectors in {embeddings.shape[1]} dimensions")
+    print(f"Refreshed:        {model.refresh_stats['reused']} reused, {model.refresh_stats['encoded']} encoded")
+    print(f"Codec:            {model.codes.codec}, {model.codes.nbytes() / 2 ** 20:.2f} MB of codes")
 
 def embed_query_text(query):
     model = SemanticSearch()
@@ -124,121 +180,248 @@ def embed_query_text(query):
 
     return embedding
 
-def cosine_similarity(vec1, vec2):
-    dot_product = np.dot(vec1, vec2)
-    norm1 = np.linalg.norm(vec1)
-    norm2 = np.linalg.norm(vec2)
-
-    if norm1 == 0 or norm2 == 0:
-        return 0.0
-
-    return dot_product / (norm1 * norm2)
-
 class ChunkedSemanticSearch(SemanticSearch):
-    def __init__(self, model_name = "all-MiniLM-L6-v2") -> None:
-        super().__init__()
+    def __init__(self, model_name = EMBEDDING_MODEL, vector_mode = "exact", codec = None, pca_dimensions = PCA_DIMENSIONS, pca_rerank = PCA_RERANK) -> None:
+        super().__init__(model_name, codec)
         self.chunk_embeddings = None
         self.chunk_metadata = None
+        self.chunk_codes = None
+
+        # Normalized chunk rows grouped by movie, and the movie of each,
+        # made on first use: ivfpq searches never need them.
+        self.chunk_matrix = None
+        self.chunk_movies = None
+
+        if vector_mode not in VECTOR_MODES:
+            raise ValueError(f"Unknown vector mode: {vector_mode}")
+
+        # How search_chunks finds the best chunks by default, and the HNSW
+        # graph over chunk_matrix and IVF-PQ index and PCA projection over
+        # chunk_embeddings, loaded on first use.
+        self.vector_mode = vector_mode
+        self.hnsw = None
+        self.ivfpq = None
+        self.pca = None
+
+        # Dimensions the chunks are projected onto, and movies shortlisted
+        # by the projection per result, for pca searches.
+        self.pca_dimensions = pca_dimensions
+        self.pca_rerank = pca_rerank
+
+        # The movie of each chunk in file order, for the codes and the
+        # IVF-PQ index, and the fingerprint of the file they were all built
+        # from, taken once when it is mapped.
+        self.row_movies = None
+        self.chunk_fingerprint = None
     
-    def build_chunk_embeddings(self, documents):
+    def build_chunk_embeddings(self, documents, workers=ENCODE_WORKERS):
 
         self.documents = documents
+        self.document_map = document_map(documents)
 
-        all_chunks = []
-        chunk_data = []
-
-        for doc in documents:
+        # Chunked twice: once to count the chunks of each movie, which sizes
+        # the output and gives the metadata columns, and again as the chunks
+        # are encoded.
+        self.chunk_metadata = ChunkMetadata.from_counts([len(document_chunks(doc)) for doc in documents])
 
-            self.document_map[doc["id"]] = doc
-            
-            if "description" not in doc:
-                continue
-            elif doc["description"] == None or doc["description"] == "":
-                continue
+        # Encoded straight into a file, which an interrupted build leaves
+        # behind to resume into.
+        temp_path = "cache/chunk_embeddings.npy.tmp"
+        output = open_output(temp_path, (len(self.chunk_metadata), embedding_dimensions(self.model)))
+        chunks = (chunk for doc in documents for chunk in document_chunks(doc))
 
-            chunks = semantic_chunk(doc["description"], 4, 1)
-            all_chunks.extend(chunks)
+        encode_rows(self.model_name, chunks, len(self.chunk_metadata), output, workers=workers, checkpoint_path=f"{temp_path}.progress")
+        del output
 
-            for i in range(len(chunks)):
-                dic = {}
-                dic["movie_idx"] = documents.index(doc)
-                dic["chunk_idx"] = i
-                dic["total_chunks"] = len(chunks)
-                chunk_data.append(dic)
+        os.replace(temp_path, "cache/chunk_embeddings.npy")
+        self.chunk_metadata.save(CHUNK_METADATA_PATH)
 
-
-        self.chunk_embeddings = self.model.encode(all_chunks, show_progress_bar=True)
-        self.chunk_metadata = chunk_data
-
-        with open("cache/chunk_embeddings.npy", "wb") as file:
-            np.save(file, self.chunk_embeddings)
-
-        with open("cache/chunk_metadata.json", "w") as file:
-            json.dump({"chunks": chunk_data, "total_chunks": len(all_chunks)}, file, indent=2)
+        self.load_chunk_codes()
         
         return self.chunk_embeddings
     
-    def load_or_create_chunk_embeddings(self, documents: list[dict]) -> np.ndarray:
+    def load_or_create_chunk_embeddings(self, documents: list[dict], workers=ENCODE_WORKERS) -> np.ndarray:
 
         self.documents = documents
+        self.document_map = document_map(documents)
+        
+        self.chunk_metadata = load_chunk_metadata() if os.path.isfile("cache/chunk_embeddings.npy") else None
 
-        for doc in documents:
+        # Mapped rather than read, so rows are only paged in when scored.
+        if self.chunk_metadata is not None:
+            self.chunk_embeddings = np.load("cache/chunk_embeddings.npy", mmap_mode="r")
 
-            self.document_map[doc["id"]] = doc
-        
-        if not (os.path.isfile("cache/chunk_embeddings.npy") and os.path.isfile("cache/chunk_metadata.json")):
-            return self.build_chunk_embeddings(documents)
+        # Embeddings and metadata are replaced one after the other, so a
+        # build stopped between the two leaves them disagreeing.
+        if self.chunk_metadata is None or len(self.chunk_embeddings) != len(self.chunk_metadata):
+            return self.build_chunk_embeddings(documents, workers)
 
-        with open("cache/chunk_embeddings.npy", "rb") as file:
-            self.chunk_embeddings = np.load(file)
-        
-        with open("cache/chunk_metadata.json", "r") as file:
-            self.chunk_metadata = json.load(file)["chunks"]
+        self.load_chunk_codes()
         
         return self.chunk_embeddings
+
+    def load_chunk_codes(self):
+
+        self.chunk_matrix = None
+        self.chunk_movies = None
+        self.row_movies = self.chunk_metadata.movie_idx
+
+        # float32 rows are kept mapped either way; codes replace the
+        # chunk matrix for exact searches.
+        self.chunk_fingerprint = file_fingerprint("cache/chunk_embeddings.npy")
+        self.chunk_codes = load_or_encode("cache/chunk_embeddings.npy", CHUNK_CODES_PATH, self.codec, self.chunk_fingerprint)
+        self.chunk_embeddings = np.load("cache/chunk_embeddings.npy", mmap_mode="r")
+
+    def load_chunk_matrix(self):
+
+        if self.chunk_embeddings is None:
+            raise ValueError("No chunk embeddings loaded. Call `load_or_create_chunk_embeddings` first.")
+
+        if self.chunk_matrix is None:
+            self.chunk_matrix, self.chunk_movies = group_chunks(self.chunk_embeddings, self.chunk_metadata.movie_idx)
+
+        return self.chunk_matrix
     
-    def search_chunks(self, query: str, limit: int = 10):
-        embedded_query = embed_query_text(query)
-        chunk_scores = []
+    def load_or_build_hnsw(self, m=HNSW_M, ef_construction=HNSW_EF_CONSTRUCTION, rebuild=False):
 
-        for i in range(len(self.chunk_embeddings)):
-            dic = {}
-            cosine = cosine_similarity(embedded_query, self.chunk_embeddings[i])
-            dic["chunk_idx"] = self.chunk_metadata[i]["chunk_idx"]
-            dic["movie_idx"] = self.chunk_metadata[i]["movie_idx"]
-            dic["score"] = cosine
-            chunk_scores.append(dic)
-        
-        movie_scores = {}
+        self.load_chunk_matrix()
+
+        # A graph built from other embeddings than the loaded ones is
+        # rebuilt.
+        if not rebuild and os.path.isfile(HNSW_PATH):
+            self.hnsw = HNSWIndex.load(HNSW_PATH, self.chunk_matrix)
+
+            if self.hnsw is not None:
+                return self.hnsw
+
+        self.hnsw = HNSWIndex(self.chunk_matrix, m, ef_construction).build()
+        self.hnsw.save(HNSW_PATH)
+
+        return self.hnsw
+
+    def load_or_build_ivfpq(self, nlist=IVF_NLIST, subquantizers=IVF_SUBQUANTIZERS, rebuild=False):
+
+        if self.chunk_embeddings is None:
+            raise ValueError("No chunk embeddings loaded. Call `load_or_create_chunk_embeddings` first.")
+
+        # Built over the saved embeddings in file order, which is the order
+        # the exact re-scoring reads them in.
+        if not rebuild and os.path.isfile(IVFPQ_PATH):
+            self.ivfpq = IVFPQIndex.load(IVFPQ_PATH, self.chunk_fingerprint)
+
+            if self.ivfpq is not None:
+                return self.ivfpq
+
+        self.ivfpq = IVFPQIndex.build(self.chunk_embeddings, nlist, subquantizers)
+        self.ivfpq.fingerprint = self.chunk_fingerprint
+        self.ivfpq.save(IVFPQ_PATH)
+
+        return self.ivfpq
+
+    def load_or_build_pca(self, dimensions=None, rebuild=False):
+
+        if self.chunk_embeddings is None:
+            raise ValueError("No chunk embeddings loaded. Call `load_or_create_chunk_embeddings` first.")
+
+        dimensions = dimensions or self.pca_dimensions
+
+        # Fit again for other embeddings or another number of dimensions.
+        if not rebuild and os.path.isfile(PCA_PATH):
+            self.pca = PCAProjection.load(PCA_PATH, self.chunk_fingerprint)
+
+            if self.pca is not None and self.pca.dimensions == dimensions:
+                return self.pca
+
+        self.pca = PCAProjection.fit(self.chunk_embeddings, dimensions)
+        self.pca.fingerprint = self.chunk_fingerprint
+        self.pca.save(PCA_PATH)
+
+        return self.pca
+
+    def search_chunks(self, query: str, limit: int = 10, movie_idxs=None, mode=None, ef=HNSW_EF_SEARCH, nprobe=IVF_NPROBE):
+        mode = mode or self.vector_mode
 
-        for chunk_score in chunk_scores:
-            if chunk_score["movie_idx"] not in movie_scores:
-                movie_scores[chunk_score["movie_idx"]] = chunk_score["score"]
-            else:
-                if chunk_score["score"] > movie_scores[chunk_score["movie_idx"]]:
-                    movie_scores[chunk_score["movie_idx"]] = chunk_score["score"]
+        if mode not in VECTOR_MODES:
+            raise ValueError(f"Unknown vector mode: {mode}")
 
-        movie_scores = dict(sorted(movie_scores.items(), key=lambda item: item[1], reverse=True))
+        embedded_query = self.generate_embedding(query)
+        movies, scores = self.movie_scores(embedded_query, limit, movie_idxs, mode, ef, nprobe)
+
+        return self.chunk_results(movies, scores)
+
+    def search_chunks_batch(self, queries, limit=10, movie_idxs=None, mode=None, ef=HNSW_EF_SEARCH, nprobe=IVF_NPROBE):
+        mode = mode or self.vector_mode
+
+        if mode not in VECTOR_MODES:
+            raise ValueError(f"Unknown vector mode: {mode}")
+
+        # Encoded one by one, as in search_batch.
+        embedded_queries = self.generate_embeddings(queries)
+
+        # Exact float32 searches, filtered graph searches among them, are
+        # scored as matrix products; every other mode searches its index or
+        # codes one query at a time.
+        exact = mode == "exact" or (mode == "hnsw" and movie_idxs is not None)
+
+        if exact and (self.chunk_codes is None or self.chunk_codes.codec == "float32"):
+            self.load_chunk_matrix()
+            top = chunk_movie_scores_batch(embedded_queries, self.chunk_matrix, self.chunk_movies, limit, movie_idxs)
+        else:
+            top = [self.movie_scores(embedded_query, limit, movie_idxs, mode, ef, nprobe) for embedded_query in embedded_queries]
+
+        return [self.chunk_results(movies, scores) for movies, scores in top]
+
+    def movie_scores(self, embedded_query, limit, movie_idxs, mode, ef, nprobe):
+
+        # A filter is applied while scanning. The graph cannot skip the
+        # movies outside it, so filtered searches are always exact.
+        if mode == "ivfpq":
+            if self.ivfpq is None:
+                self.load_or_build_ivfpq()
+
+            movies, scores = ivfpq_movie_scores(self.ivfpq, self.chunk_embeddings, embedded_query, self.row_movies, limit, nprobe, movie_idxs)
+        elif mode == "pca":
+            if self.pca is None or self.pca.dimensions != self.pca_dimensions:
+                self.load_or_build_pca()
+
+            movies, scores = pca_movie_scores(self.pca, self.chunk_embeddings, embedded_query, self.row_movies, limit, self.pca_rerank, movie_idxs)
+        elif mode == "hnsw" and movie_idxs is None:
+            if self.hnsw is None:
+                self.load_or_build_hnsw()
+
+            movies, scores = hnsw_movie_scores(self.hnsw, embedded_query, self.chunk_movies, limit, ef)
+        elif self.chunk_codes is not None and self.chunk_codes.codec != "float32":
+            movies, scores = quantized_movie_scores(self.chunk_codes, self.chunk_embeddings, embedded_query, self.row_movies, limit, movie_idxs=movie_idxs)
+        else:
+            self.load_chunk_matrix()
+            movies, scores = chunk_movie_scores(embedded_query, self.chunk_matrix, self.chunk_movies, limit, movie_idxs)
+
+        return movies, scores
+
+    def chunk_results(self, movies, scores):
 
         results = []
-        result_len = limit
-        if len(movie_scores) < limit:
-            result_len = len(movie_scores)
-        
-        movie_id_list = list(movie_scores.keys())
-        movie_score_list = list(movie_scores.values())
 
-        for i in range(result_len):
+        for movie_idx, score in zip(movies.tolist(), scores):
             dic = {}
-            dic["id"] = movie_id_list[i]
+            dic["id"] = movie_idx
             dic["title"] = self.documents[dic["id"]]["title"]
             dic["document"] = self.documents[dic["id"]]["description"][:100]
-            dic["score"] = round(movie_score_list[i], SCORE_PRECISION)
+            dic["score"] = round(score, SCORE_PRECISION)
             dic["metadata"] = self.chunk_metadata[dic["id"]]
             results.append(dic)
         
         return results
     
+def document_chunks(doc):
+
+    if "description" not in doc:
+        return []
+    elif doc["description"] == None or doc["description"] == "":
+        return []
+
+    return semantic_chunk(doc["description"], 4, 1)
+
 def semantic_chunk(text, chunk_size, overlap):
     
     text = text.strip()
@@ -0,0 +1,171 @@
+import zlib
+import numpy as np
+from lib.analyzer import get_analyzer
+from constants import *
+
+# Symmetric-delete spelling correction over the index vocabulary.
+#
+# Every term is stored under the strings left after deleting up to
+# SPELL_MAX_DISTANCE characters from its first SPELL_PREFIX_LENGTH
+# characters. A misspelled word shares one of those strings with each term
+# close enough to it, so looking it up only takes the deletes of the word
+# itself, never a scan of the vocabulary. Deletes are kept as crc32 hashes
+# in one sorted array; a collision only adds a candidate that fails the
+# edit distance check.
+
+
+def deletes(word, distance):
+
+    # Deletes of word by level: level d holds the strings d deletes away.
+    levels = [{word}]
+
+    for _ in range(distance):
+        levels.append({variant[:i] + variant[i + 1:] for variant in levels[-1] if len(variant) > 1 for i in range(len(variant))} - set().union(*levels))
+
+    return levels
+
+def delete_hash(variant):
+    return zlib.crc32(variant.encode("utf-8"))
+
+def edit_distance(a, b, limit):
+
+    # Optimal string alignment distance, or limit + 1 once it is certain to
+    # exceed limit.
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+
+    # A shared prefix or suffix costs nothing, and a typo usually leaves
+    # only a few characters in between.
+    start = 0
+
+    while start < len(a) and start < len(b) and a[start] == b[start]:
+        start += 1
+
+    end = 0
+
+    while end < len(a) - start and end < len(b) - start and a[-1 - end] == b[-1 - end]:
+        end += 1
+
+    a = a[start:len(a) - end]
+    b = b[start:len(b) - end]
+
+    if len(a) == 0 or len(b) == 0:
+        return max(len(a), len(b))
+
+    previous_previous = None
+    previous = list(range(len(b) + 1))
+
+    for i in range(1, len(a) + 1):
+        current = [i] + [0] * len(b)
+
+        for j in range(1, len(b) + 1):
+            cost = 0 if a[i - 1] == b[j - 1] else 1
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + cost)
+
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                current[j] = min(current[j], previous_previous[j - 2] + 1)
+
+        if min(current) > limit:
+            return limit + 1
+
+        previous_previous = previous
+        previous = current
+
+    return previous[-1]
+
+
+class SpellingLexicon:
+    def __init__(self, terms, dfs, indexed=None, max_distance=SPELL_MAX_DISTANCE, prefix_length=SPELL_PREFIX_LENGTH):
+
+        # terms are the words corrections are drawn from, and indexed, if
+        # given, holds the analyzed terms a query can actually match.
+        self.terms = list(terms)
+        self.indexed = indexed
+        self.dfs = np.asarray(dfs, dtype=np.int64)
+        self.term_ids = {term: i for i, term in enumerate(self.terms)}
+        self.lengths = np.array([len(term) for term in self.terms], dtype=np.int64)
+        self.max_distance = max_distance
+        self.prefix_length = prefix_length
+
+        hashes = []
+        ids = []
+
+        for i, term in enumerate(self.terms):
+            for level in deletes(term[:prefix_length], max_distance):
+                for variant in level:
+                    hashes.append(delete_hash(variant))
+                    ids.append(i)
+
+        order = np.argsort(np.array(hashes, dtype=np.uint32), kind="stable")
+        self.hashes = np.array(hashes, dtype=np.uint32)[order]
+        self.ids = np.array(ids, dtype=np.int32)[order]
+
+    def lookup(self, word, max_distance=None):
+
+        max_distance = self.max_distance if max_distance is None else max_distance
+        best = max_distance
+        found = {}
+
+        # A term reached through level d of the word's deletes is at least
+        # d edits away, so stop once a level cannot beat the best so far.
+        for level, variants in enumerate(deletes(word[:self.prefix_length], max_distance)):
+            if level > best:
+                break
+
+            keys = np.array([delete_hash(variant) for variant in variants], dtype=np.uint32)
+            starts = np.searchsorted(self.hashes, keys, side="left")
+            ends = np.searchsorted(self.hashes, keys, side="right")
+
+            ids = np.concatenate([self.ids[start:end] for start, end in zip(starts.tolist(), ends.tolist())])
+
+            # Terms too much longer or shorter cannot be close enough.
+            ids = np.unique(ids[np.abs(self.lengths[ids] - len(word)) <= best])
+
+            for i in ids.tolist():
+                if i in found:
+                    continue
+
+                found[i] = edit_distance(word, self.terms[i], max_distance)
+                best = min(best, found[i])
+
+        # Closest first, then the most frequent.
+        candidates = [(distance, -int(self.dfs[i]), self.terms[i]) for i, distance in found.items() if distance <= max_distance]
+
+        return [(term, distance, -df) for distance, df, term in sorted(candidates)]
+
+    def correct_word(self, word):
+
+        analyzer = get_analyzer()
+        text = word.lower().translate(analyzer.translation)
+        tokens = analyzer.analyze(text)
+
+        # Stopwords, words that already match something and words too short
+        # to tell a typo from another word stay as they are.
+        if len(tokens) == 0 or text in self.term_ids or self.matches(tokens) or len(text) < SPELL_MIN_WORD_LENGTH:
+            return word
+
+        # Try the stem of the word as well as the word, which finds stems
+        # when the vocabulary is made of them. Short words get fewer edits,
+        # or nearly anything would match them.
+        candidates = []
+        max_distance = min(self.max_distance, max(1, (len(text) - 1) // 2))
+
+        for variant in dict.fromkeys([text] + tokens):
+            candidates.extend(self.lookup(variant, max_distance))
+
+        for term, _, _ in sorted(candidates, key=lambda candidate: (candidate[1], -candidate[2], candidate[0])):
+            # A correction has to find postings once it is analyzed in turn.
+            if self.matches(analyzer.analyze(term)):
+                return term
+
+        return word
+
+    def matches(self, tokens):
+
+        if self.indexed is None:
+            return all(token in self.term_ids for token in tokens)
+
+        return len(tokens) > 0 and all(token in self.indexed for token in tokens)
+
+    def correct(self, query):
+        return " ".join(self.correct_word(word) for word in query.split())
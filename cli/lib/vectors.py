@@ -0,0 +1,308 @@
+import os
+import numpy as np
+from constants import *
+
+# Cosine scoring over embedding matrices.
+#
+# Rows are scaled to unit length once, when embeddings are loaded, into one
+# contiguous float32 matrix. A query is then scored against every row by a
+# single matrix-vector product, and only the few best scores are ordered.
+# Chunks are kept grouped by movie, so the best chunk of each movie is one
+# np.maximum.reduceat over the chunk scores.
+#
+# Many queries are scored at once by a matrix-matrix product, a block of
+# queries against a tile of rows at a time. BLAS sums a product in a
+# different order for one query than for many, so neither scan is final:
+# the rows scoring near the best, within the rounding either order can
+# make, are scored again row by row, and those scores are the results. One
+# query and a batch therefore return the same results, bit for bit.
+
+
+def cosine_similarity(vec1, vec2):
+    dot_product = np.dot(vec1, vec2)
+    norm1 = np.linalg.norm(vec1)
+    norm2 = np.linalg.norm(vec2)
+
+    if norm1 == 0 or norm2 == 0:
+        return 0.0
+
+    return dot_product / (norm1 * norm2)
+
+def normalize_rows(embeddings):
+
+    matrix = np.array(embeddings, dtype=np.float32, order="C")
+
+    # Encoding nothing gives a flat empty array.
+    if matrix.size == 0:
+        return matrix.reshape(len(matrix), 0)
+
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+
+    # A row of zeros stays zero and scores 0, as in cosine_similarity.
+    np.divide(matrix, norms, out=matrix, where=norms > 0)
+
+    return matrix
+
+def normalize_vector(vector):
+    return normalize_rows(np.asarray(vector).reshape(1, -1))[0]
+
+def cosine_scores(matrix, query):
+
+    if matrix.shape[1] == 0:
+        return np.zeros(len(matrix), dtype=np.float32)
+
+    return matrix @ normalize_vector(query)
+
+def score_margin(dimensions):
+
+    # A float32 dot product of two unit vectors is within about
+    # dimensions * eps / 2 of the true cosine in any summation order, so
+    # the scan and the exact score differ by at most dimensions * eps. A
+    # row in the exact top scans within twice that of the limit-th best;
+    # the rest is room for rows being only about unit length.
+    return 3 * dimensions * float(np.finfo(np.float32).eps)
+
+def exact_scores(matrix, rows, query):
+
+    # Each row summed on its own, so a row scores the same whichever rows
+    # it is scored with. BLAS blocks rows, and its sums for a shortlist
+    # can differ in the last bit from those for the whole matrix.
+    return np.einsum("ij,j->i", matrix[rows], query)
+
+def rescore_top(matrix, scores, query, limit):
+
+    # The best rows by the scan, and every row within the margin of them,
+    # scored again exactly. query is already unit length.
+    limit = min(limit, len(scores))
+
+    if limit <= 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+
+    threshold = np.partition(scores, len(scores) - limit)[len(scores) - limit]
+    rows = np.flatnonzero(scores >= threshold - score_margin(matrix.shape[1]))
+    exact = exact_scores(matrix, rows, query)
+    best = top_indices(exact, limit)
+
+    return rows[best], exact[best]
+
+def cosine_top(matrix, embedded_query, limit):
+
+    query = normalize_vector(embedded_query)
+
+    return rescore_top(matrix, cosine_scores(matrix, query), query, limit)
+
+def cosine_top_batch(matrix, embedded_queries, limit, block_cells=SEARCH_BATCH_BLOCK_CELLS):
+
+    queries = [normalize_vector(query) for query in embedded_queries]
+    results = []
+
+    # As many queries at once as fit a block of block_cells scores.
+    block_size = max(1, block_cells // max(1, len(matrix)))
+
+    for block_start in range(0, len(queries), block_size):
+        block = np.stack(queries[block_start:block_start + block_size])
+        scores = block @ matrix.T
+
+        for query, row in zip(block, scores):
+            results.append(rescore_top(matrix, row, query, limit))
+
+    return results
+
+def top_indices(scores, limit):
+
+    limit = min(limit, len(scores))
+
+    if limit <= 0:
+        return np.zeros(0, dtype=np.int64)
+
+    # Everything tied with the limit-th best score is kept, so ties still
+    # go to the lowest index, as they would in a stable sort.
+    if limit < len(scores):
+        threshold = scores[np.argpartition(-scores, limit - 1)[limit - 1]]
+        candidates = np.flatnonzero(scores >= threshold)
+    else:
+        candidates = np.arange(len(scores))
+
+    order = np.lexsort((candidates, -scores[candidates]))
+
+    return candidates[order][:limit]
+
+def group_chunks(chunk_embeddings, movies):
+
+    # Normalized chunk rows in movie order, and the movie of each. Chunks
+    # are written movie by movie, so this is usually already the order.
+    movies = np.asarray(movies)
+
+    if np.all(movies[1:] >= movies[:-1]):
+        return normalize_rows(chunk_embeddings), movies
+
+    order = np.argsort(movies, kind="stable")
+
+    return normalize_rows(np.asarray(chunk_embeddings)[order]), movies[order]
+
+def movie_segments(chunk_movies, movie_idxs=None):
+
+    # The first row of each movie's chunks, and the movies to rank, as
+    # positions in it. Movies outside the filter are never ranked.
+    starts = np.flatnonzero(np.diff(chunk_movies, prepend=-1))
+    segments = np.arange(len(starts))
+
+    if movie_idxs is not None:
+        segments = segments[np.isin(chunk_movies[starts], np.fromiter(movie_idxs, dtype=np.int64, count=len(movie_idxs)))]
+
+    return starts, segments
+
+def rescore_movies(chunk_matrix, chunk_movies, starts, maxima, segments, query, limit):
+
+    # maxima[s] is the best scanned chunk of the movie starting at
+    # starts[s]. The movies near the best are scored again, every chunk.
+    limit = min(limit, len(segments))
+
+    if limit <= 0:
+        return chunk_movies[:0], np.zeros(0, dtype=np.float32)
+
+    candidates = maxima[segments]
+    threshold = np.partition(candidates, len(candidates) - limit)[len(candidates) - limit]
+    segments = segments[candidates >= threshold - score_margin(chunk_matrix.shape[1])]
+
+    ends = np.append(starts[1:], len(chunk_movies))
+    counts = ends[segments] - starts[segments]
+    offsets = np.cumsum(counts) - counts
+    rows = np.repeat(starts[segments] - offsets, counts) + np.arange(offsets[-1] + counts[-1])
+
+    exact = np.maximum.reduceat(exact_scores(chunk_matrix, rows, query), offsets)
+    best = top_indices(exact, limit)
+
+    return chunk_movies[starts[segments]][best], exact[best]
+
+def chunk_movie_scores(embedded_query, chunk_matrix, chunk_movies, limit, movie_idxs=None):
+
+    query = normalize_vector(embedded_query)
+    starts, segments = movie_segments(chunk_movies, movie_idxs)
+
+    if len(starts) == 0:
+        return chunk_movies, np.zeros(0, dtype=np.float32)
+
+    maxima = np.maximum.reduceat(cosine_scores(chunk_matrix, query), starts)
+
+    return rescore_movies(chunk_matrix, chunk_movies, starts, maxima, segments, query, limit)
+
+def chunk_movie_scores_batch(embedded_queries, chunk_matrix, chunk_movies, limit, movie_idxs=None, block_cells=SEARCH_BATCH_BLOCK_CELLS, tile_rows=SEARCH_BATCH_TILE_ROWS):
+
+    queries = [normalize_vector(query) for query in embedded_queries]
+    starts, segments = movie_segments(chunk_movies, movie_idxs)
+
+    if len(starts) == 0:
+        return [(chunk_movies, np.zeros(0, dtype=np.float32)) for _ in queries]
+
+    # Tiles of about tile_rows chunks, cut between movies, so the best
+    # chunk of a movie is found within one tile.
+    ends = np.append(starts[1:], len(chunk_movies))
+    tiles = []
+    first = 0
+
+    while first < len(starts):
+        last = max(first + 1, int(np.searchsorted(starts, starts[first] + tile_rows)))
+        tiles.append((first, last))
+        first = last
+
+    # As many queries at once as fit a block of block_cells scores: the
+    # chunks of one tile and the best chunk of every movie, per query.
+    block_size = max(1, block_cells // (tile_rows + len(starts)))
+    results = []
+
+    for block_start in range(0, len(queries), block_size):
+        block = np.stack(queries[block_start:block_start + block_size])
+        maxima = np.empty((len(block), len(starts)), dtype=np.float32)
+
+        for first, last in tiles:
+            scores = chunk_matrix[starts[first]:ends[last - 1]] @ block.T
+            maxima[:, first:last] = np.maximum.reduceat(scores, starts[first:last] - starts[first], axis=0).T
+
+        for query, row in zip(block, maxima):
+            results.append(rescore_movies(chunk_matrix, chunk_movies, starts, row, segments, query, limit))
+
+    return results
+
+def best_per_movie(movies, scores, limit):
+
+    if len(movies) == 0:
+        return movies, scores
+
+    # movies is sorted. A movie scores as its best chunk. Best movie first,
+    # ties in movie order.
+    starts = np.flatnonzero(np.diff(movies, prepend=-1))
+    maxima = np.maximum.reduceat(scores, starts)
+    best = top_indices(maxima, limit)
+
+    return movies[starts][best], maxima[best]
+
+def rows_movie_scores(rows, scores, row_movies, limit):
+
+    movies = row_movies[rows]
+    order = np.argsort(movies, kind="stable")
+
+    return best_per_movie(movies[order], scores[order], limit)
+
+def file_fingerprint(path):
+
+    # Size, modification time and inode, which a rewrite or a file swapped
+    # in by rename changes, without reading the file.
+    stat = os.stat(path)
+
+    return np.array([stat.st_size, stat.st_mtime_ns, stat.st_ino], dtype=np.int64)
+
+def check_vectors(count=3000, dimensions=32, movies=200, seed=0):
+
+    # Chunk rows for check_batch: movies with a handful of chunks and with
+    # hundreds, repeated rows, whose scores tie, and a row of zeros.
+    rng = np.random.default_rng(seed)
+    embeddings = rng.standard_normal((count, dimensions)).astype(np.float32)
+    embeddings[rng.choice(count, count // 20, replace=False)] = embeddings[rng.choice(count, count // 20, replace=False)]
+    embeddings[count // 2] = 0
+    chunk_movies = rng.integers(0, movies, count) ** 2 // movies
+
+    return embeddings, chunk_movies
+
+def check_queries(embeddings, count=50, seed=0):
+
+    # Rows of the matrix, which tie with their repeats, and a query of
+    # zeros, which ties with everything, as well as random queries.
+    rng = np.random.default_rng(seed)
+    queries = list(rng.standard_normal((count, embeddings.shape[1])).astype(np.float32))
+    rows = rng.choice(len(embeddings), min(len(embeddings), max(1, count // 5)), replace=False)
+
+    return queries + [np.asarray(embeddings[row], dtype=np.float32) for row in np.sort(rows)] + [np.zeros(embeddings.shape[1], dtype=np.float32)]
+
+def check_batch(embeddings, chunk_movies, queries, limit, seed=0):
+
+    # Raises on the first query whose batch results differ from a single
+    # search's in any row, movie, rank or bit of a score: unfiltered, with
+    # a filter and with an empty one, in one block and tile and in many.
+    rng = np.random.default_rng(seed)
+    matrix = normalize_rows(embeddings)
+    chunk_matrix, chunk_movies = group_chunks(embeddings, chunk_movies)
+    movies = np.unique(chunk_movies)
+    filters = [None, set(rng.choice(movies, max(1, len(movies) // 3), replace=False).tolist()), set()]
+    sizes = [(SEARCH_BATCH_BLOCK_CELLS, SEARCH_BATCH_TILE_ROWS), (max(1, len(matrix) * 3), 64)]
+
+    def same(result, expected):
+        return all(a.dtype == b.dtype and a.shape == b.shape and a.tobytes() == b.tobytes() for a, b in zip(result, expected))
+
+    for block_cells, tile_rows in sizes:
+        for i, result in enumerate(cosine_top_batch(matrix, queries, limit, block_cells)):
+            expected = cosine_top(matrix, queries[i], limit)
+
+            if not same(result, expected):
+                raise AssertionError(f"Batch cosine_top differs for query {i}: {result} != {expected}")
+
+        for movie_idxs in filters:
+            batch = chunk_movie_scores_batch(queries, chunk_matrix, chunk_movies, limit, movie_idxs, block_cells, tile_rows)
+
+            for i, result in enumerate(batch):
+                expected = chunk_movie_scores(queries[i], chunk_matrix, chunk_movies, limit, movie_idxs)
+
+                if not same(result, expected):
+                    raise AssertionError(f"Batch chunk_movie_scores differs for query {i}: {result} != {expected}")
+
+    return len(queries)
@@ -0,0 +1,155 @@
+import numpy as np
+from constants import *
+
+# Upper bounds are summed in a different order than document scores, so allow
+# for rounding before deciding a document cannot make the top-k.
+BOUND_EPSILON = 1e-9
+
+# Windows scored up front to establish a threshold, grown until they hold at
+# least `limit` matching documents.
+SEED_WINDOWS = 4
+
+# Documents are grouped into windows of BM25_BLOCK_SIZE consecutive rows. A
+# window is only scored if the upper bound of the query terms it contains can
+# beat the current k-th best score. "wand" bounds a window with each term's
+# maximum score over its whole postings list, "bmw" with the term's maximum
+# inside that window. Scoring inside a window is vectorized, which is where
+# CPython spends its time, instead of stepping cursors one document at a time.
+#
+# The postings of all query terms are laid end to end once, in query order,
+# each with its term's idf and window. A round of windows then keeps the
+# postings in them and turns only those into BM25 scores; postings in
+# skipped windows are decoded with their list but never scored.
+
+def pruned_top_k(index, terms, limit, block_max=False):
+
+    # The top documents, how many documents were scored and how many
+    # postings it took.
+    query_terms = [term for term in terms if term in index.postings]
+
+    if limit <= 0 or len(query_terms) == 0:
+        return [], 0, 0
+
+    window_count = (len(index.doc_ids) + BM25_BLOCK_SIZE - 1) // BM25_BLOCK_SIZE
+    bounds = np.zeros(window_count)
+    term_postings = {}
+
+    for term in dict.fromkeys(query_terms):
+        rows, tfs = index.postings[term]
+        term_postings[term] = (rows, tfs, np.full(len(rows), index.idfs[term]))
+
+        # A repeated query term counts once per occurrence, so its bounds do too.
+        count = query_terms.count(term)
+        windows, maxima = index.block_maxima[term]
+
+        if block_max:
+            bounds[windows] += maxima * count
+        else:
+            bounds[windows] += index.max_scores[term] * count
+
+    rows, tfs, idfs = (np.concatenate(parts) for parts in zip(*(term_postings[term] for term in query_terms)))
+    postings = (rows, tfs, idfs, rows // BM25_BLOCK_SIZE)
+
+    candidates = np.flatnonzero(bounds > 0)
+    candidates = candidates[np.argsort(-bounds[candidates], kind="stable")]
+
+    top_rows = np.zeros(0, dtype=np.int64)
+    top_scores = np.zeros(0)
+    scored = 0
+    scored_postings = 0
+    done = np.zeros(window_count, dtype=bool)
+
+    # Score the most promising windows first so the threshold starts high.
+    seed = SEED_WINDOWS
+
+    while True:
+        selected = np.zeros(window_count, dtype=bool)
+        selected[candidates[:seed]] = True
+        selected &= ~done
+
+        rows, scores, count = score_windows(index, postings, selected)
+        top_rows, top_scores = merge_top_k(top_rows, top_scores, rows, scores, limit)
+        scored += len(rows)
+        scored_postings += count
+        done |= selected
+
+        if len(top_rows) >= limit or seed >= len(candidates):
+            break
+
+        seed *= 4
+
+    if len(top_rows) >= limit:
+        threshold = top_scores[-1]
+
+        selected = (bounds + BOUND_EPSILON > threshold) & ~done
+
+        rows, scores, count = score_windows(index, postings, selected)
+        top_rows, top_scores = merge_top_k(top_rows, top_scores, rows, scores, limit)
+        scored += len(rows)
+        scored_postings += count
+
+    top = list(zip(top_rows.tolist(), top_scores.tolist()))
+
+    return top, scored, scored_postings
+
+def score_windows(index, postings, selected):
+
+    windows = np.flatnonzero(selected)
+
+    if len(windows) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0), 0
+
+    rows, tfs, idfs, posting_windows = postings
+    keep = selected[posting_windows]
+
+    # Copying out nearly every posting costs more than scoring the few
+    # left out, so those are scored and dropped instead. A document's
+    # postings are all in its window, so a dropped one never joins a sum.
+    if np.count_nonzero(keep) * 4 >= len(keep) * 3:
+        scores = np.where(keep, index.score_postings(rows, tfs, idfs), 0.0)
+    else:
+        rows = rows[keep]
+        scores = index.score_postings(rows, tfs[keep], idfs[keep])
+
+    # bincount accumulates in the order given, which is query order, so the
+    # sums are bit-for-bit those of the exhaustive path. Every contribution
+    # is positive, so matching documents are exactly the non-zero totals.
+    # Most windows are summed straight into their rows, up to the last one;
+    # a few are laid end to end first, so the totals never span the index.
+    if len(windows) * 2 >= len(selected):
+        totals = np.bincount(rows, weights=scores)
+        docs = np.flatnonzero(totals)
+
+        return docs, totals[docs], len(rows)
+
+    ranks = np.zeros(len(selected), dtype=np.int64)
+    ranks[windows] = np.arange(len(windows))
+    slots = ranks[rows // BM25_BLOCK_SIZE] * BM25_BLOCK_SIZE + rows % BM25_BLOCK_SIZE
+
+    totals = np.bincount(slots, weights=scores, minlength=len(windows) * BM25_BLOCK_SIZE)
+    slots = np.flatnonzero(totals)
+    docs = windows[slots // BM25_BLOCK_SIZE] * BM25_BLOCK_SIZE + slots % BM25_BLOCK_SIZE
+
+    return docs, totals[slots], len(rows)
+
+def merge_top_k(top_rows, top_scores, rows, scores, limit):
+
+    rows = np.concatenate([top_rows, rows])
+    scores = np.concatenate([top_scores, scores])
+
+    if len(scores) > limit:
+        # Keep everything above the k-th best score, then fill up with the
+        # lowest rows among the documents tied with it.
+        kth = np.partition(scores, len(scores) - limit)[len(scores) - limit]
+        above = np.flatnonzero(scores > kth)
+        tied = np.flatnonzero(scores == kth)
+        tied = tied[np.argsort(rows[tied], kind="stable")][:limit - len(above)]
+
+        keep = np.concatenate([above, tied])
+        rows = rows[keep]
+        scores = scores[keep]
+
+    # Highest score first, ties broken by row like the exhaustive path.
+    order = np.lexsort((rows, -scores))
+
+    return rows[order], scores[order]
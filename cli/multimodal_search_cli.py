@@ -11,6 +11,10 @@ def main():
     image_search_parser.add_argument("path", type=str, help="Path to image to search for.")
     image_search_parser.add_argument("--limit", type=int, nargs='?', default=5, help="Optional maximum number of results.")
 
+    text_search_parser = subparsers.add_parser("text_search", help="Search movies with a text query in the same embedding space as images.")
+    text_search_parser.add_argument("query", type=str, help="Search query")
+    text_search_parser.add_argument("--limit", type=int, nargs='?', default=5, help="Optional maximum number of results.")
+
     args = parser.parse_args()
 
     match args.command:
@@ -31,6 +35,18 @@ def main():
                 count += 1
             pass
 
+        case "text_search":
+
+            results = lib.multimodal_search.text_search_command(args.query, args.limit)
+
+            count = 1
+            for res in results:
+                print(f"{count}.\t{res['title']} (similarity: {res['score']:.3f})")
+                print(f"\t{res['description'][:100]}")
+                print()
+                count += 1
+            pass
+
         case _:
             parser.print_help()
 
@@ -1,7 +1,10 @@
 #!/usr/bin/env python3
 
-import argparse, re
+import argparse, os, re, time
+import numpy as np
 from lib.semantic_search import *
+from lib.document_source import load_documents
+from lib.vectors import check_vectors, check_queries, check_batch
 
 
 def main():
@@ -14,6 +17,8 @@ def main():
     embed_parser.add_argument("text", type=str, help="Text to embed.")
 
     verify_embeddings_parser = subparsers.add_parser("verify_embeddings", help="Verify embeddings.")
+    verify_embeddings_parser.add_argument("--codec", type=str, choices=EMBEDDING_CODECS, default=None, help="Store the embeddings with this codec. Defaults to the one recorded with them, or float32.")
+    verify_embeddings_parser.add_argument("--workers", type=int, default=ENCODE_WORKERS, help="Number of processes that encode documents in parallel.")
 
     embed_query_parser = subparsers.add_parser("embedquery", help="Embed a given user query as vectors.")
     embed_query_parser.add_argument("query", type=str, help="Query to embed.")
@@ -33,10 +38,33 @@ def main():
     semantic_chunk_parser.add_argument("--overlap", type=int, nargs='?', default=0, help="Optional number of sentences to overlap with preceeding chunk.")
     
     embed_chunk_parser = subparsers.add_parser("embed_chunks", help="Generate embeddings for chunks of movie data.")
+    embed_chunk_parser.add_argument("--codec", type=str, choices=EMBEDDING_CODECS, default=None, help="Store the chunk embeddings with this codec. Defaults to the one recorded with them, or float32.")
+    embed_chunk_parser.add_argument("--workers", type=int, default=ENCODE_WORKERS, help="Number of processes that encode chunks in parallel.")
 
     search_chunked_parser = subparsers.add_parser("search_chunked", help="Search movies using chunked semantic search.")
     search_chunked_parser.add_argument("query", type=str, help="Search query")
     search_chunked_parser.add_argument("--limit", type=int, nargs='?', default=5, help="Optional maximum number of results.")
+    search_chunked_parser.add_argument("--mode", type=str, choices=VECTOR_MODES, default="exact", help="exact scans every chunk, hnsw searches the HNSW graph, ivfpq the IVF-PQ index and pca the projected chunks, building them first if needed.")
+    search_chunked_parser.add_argument("--ef", type=int, default=HNSW_EF_SEARCH, help="Candidates explored per hnsw search. Higher is slower and more accurate.")
+    search_chunked_parser.add_argument("--nprobe", type=int, default=IVF_NPROBE, help="Lists scored per ivfpq search. Higher is slower and more accurate.")
+    search_chunked_parser.add_argument("--pca-dimensions", type=int, default=PCA_DIMENSIONS, help="Dimensions the chunks are projected onto for pca searches.")
+    search_chunked_parser.add_argument("--pca-rerank", type=int, default=PCA_RERANK, help="Movies shortlisted by the projection and scored exactly, per result.")
+
+    verify_batch_parser = subparsers.add_parser("verify_batch", help="Check that batched searches give single searches' results exactly, on generated vectors. Needs no model.")
+    verify_batch_parser.add_argument("--saved", action="store_true", help="Check the saved chunk embeddings instead, with rows of them among the queries.")
+    verify_batch_parser.add_argument("--queries", type=int, default=50, help="Number of random queries.")
+    verify_batch_parser.add_argument("--limit", type=int, default=10, help="Results per query.")
+
+    build_hnsw_parser = subparsers.add_parser("build_hnsw", help="Build the HNSW graph over the chunk embeddings and save it next to them.")
+    build_hnsw_parser.add_argument("--m", type=int, default=HNSW_M, help="Links per node on the upper levels, twice that on the bottom one.")
+    build_hnsw_parser.add_argument("--ef-construction", type=int, default=HNSW_EF_CONSTRUCTION, help="Candidates explored per insert. Higher builds slower and a better graph.")
+
+    build_ivfpq_parser = subparsers.add_parser("build_ivfpq", help="Build the IVF-PQ index over the chunk embeddings and save it next to them.")
+    build_ivfpq_parser.add_argument("--nlist", type=int, default=IVF_NLIST, help="Number of k-means lists the chunks are split into.")
+    build_ivfpq_parser.add_argument("--subquantizers", type=int, default=IVF_SUBQUANTIZERS, help="Bytes per chunk. Must divide the embedding dimensions.")
+
+    build_pca_parser = subparsers.add_parser("build_pca", help="Fit a PCA projection to the chunk embeddings and save the projected chunks next to them.")
+    build_pca_parser.add_argument("--dimensions", type=int, default=PCA_DIMENSIONS, help="Dimensions to project onto.")
 
     args = parser.parse_args()
 
@@ -59,7 +87,7 @@ def main():
         case "verify_embeddings":
 
             try:
-                verify_embeddings()
+                verify_embeddings(args.codec, args.workers)
             except Exception as e:
                 print(e)
                 return
@@ -80,10 +108,9 @@ def main():
 
             model = SemanticSearch()
 
-            with open("data/movies.json", "r") as file:
-                data = json.load(file)
+            documents = load_documents()
 
-            embeddings = model.load_or_create_embeddings(data["movies"])
+            embeddings = model.load_or_create_embeddings(documents)
 
             results = model.search(args.query, args.limit)
 
@@ -139,27 +166,95 @@ def main():
 
         case "embed_chunks":
 
-            with open("data/movies.json", "r") as file:
-                data = json.load(file)
+            documents = load_documents()
 
-            chunked_search = ChunkedSemanticSearch()
+            chunked_search = ChunkedSemanticSearch(codec=args.codec)
 
-            embeddings = chunked_search.load_or_create_chunk_embeddings(data["movies"])
+            embeddings = chunked_search.load_or_create_chunk_embeddings(documents, args.workers)
 
             print(f"Generated {len(embeddings)} chunked embeddings")
+            print(f"Codec: {chunked_search.chunk_codes.codec}, {chunked_search.chunk_codes.nbytes() / 2 ** 20:.2f} MB of codes")
 
             pass
 
-        case "search_chunked":
+        case "verify_batch":
+
+            if args.saved:
+                chunk_metadata = load_chunk_metadata() if os.path.isfile("cache/chunk_embeddings.npy") else None
+
+                if chunk_metadata is None:
+                    print("No chunk embeddings saved. Run embed_chunks first.")
+                    return
+
+                embeddings = np.load("cache/chunk_embeddings.npy", mmap_mode="r")
+                chunk_movies = chunk_metadata.movie_idx
+            else:
+                embeddings, chunk_movies = check_vectors()
+
+            # A mismatch raises, so the command fails.
+            checked = check_batch(embeddings, chunk_movies, check_queries(embeddings, args.queries), args.limit)
+
+            print(f"Batch search matches single search on {checked} queries over {len(embeddings)} chunks")
+
+            pass
+
+        case "build_hnsw":
+            model = ChunkedSemanticSearch()
+
+            documents = load_documents()
+
+            model.load_or_create_chunk_embeddings(documents)
+
+            start = time.perf_counter()
+            model.load_or_build_hnsw(args.m, args.ef_construction, rebuild=True)
+
+            print(f"Built HNSW graph over {len(model.chunk_matrix)} chunks in {time.perf_counter() - start:.2f}s, {model.hnsw.max_level + 1} levels")
+
+            pass
+
+        case "build_ivfpq":
             model = ChunkedSemanticSearch()
 
-            data = {}
-            with open("data/movies.json", "r") as file:
-                data = json.load(file)
+            documents = load_documents()
+
+            embeddings = model.load_or_create_chunk_embeddings(documents)
+
+            start = time.perf_counter()
+            index = model.load_or_build_ivfpq(args.nlist, args.subquantizers, rebuild=True)
+
+            print(f"Built IVF-PQ index over {len(embeddings)} chunks in {time.perf_counter() - start:.2f}s, {len(index.centroids)} lists")
+            print(f"Index size: {index.nbytes() / 2 ** 20:.1f} MB, {embeddings.nbytes / index.nbytes():.1f}x smaller than the embeddings")
+
+            pass
+
+        case "build_pca":
+            model = ChunkedSemanticSearch()
+
+            documents = load_documents()
+
+            embeddings = model.load_or_create_chunk_embeddings(documents)
+
+            start = time.perf_counter()
+
+            try:
+                projection = model.load_or_build_pca(args.dimensions, rebuild=True)
+            except ValueError as e:
+                print(e)
+                return
+
+            print(f"Fit PCA projection of {len(embeddings)} chunks onto {projection.dimensions} dimensions in {time.perf_counter() - start:.2f}s")
+            print(f"Projected chunks: {projection.nbytes() / 2 ** 20:.1f} MB, {embeddings.nbytes / projection.nbytes():.1f}x smaller than the embeddings")
+
+            pass
+
+        case "search_chunked":
+            model = ChunkedSemanticSearch(pca_dimensions=args.pca_dimensions, pca_rerank=args.pca_rerank)
+
+            documents = load_documents()
 
-            embeddings = model.load_or_create_chunk_embeddings(data["movies"])
+            embeddings = model.load_or_create_chunk_embeddings(documents)
 
-            results = model.search_chunks(args.query, args.limit)
+            results = model.search_chunks(args.query, args.limit, mode=args.mode, ef=args.ef, nprobe=args.nprobe)
 
             i = 1
             for result in results: